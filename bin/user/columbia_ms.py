@@ -31,7 +31,7 @@ before each archive interval.
  
 Installation
 
-Put this file in the bin/user directory.
+Put this file and columbia_ms_core.py in the bin/user directory.
 
 Driver Configuration
 
@@ -43,40 +43,220 @@ Add the following to weewx.conf:
     host = 192.168.0.50
     polls_per_minute = 4  # How many times per minute to poll the MicroServer
     poll_lead_seconds = 5  # Number of seconds to shift polling earlier
-    quick_retries = 3
-   
-TODO
-
-1. Implement a way to load historical data.
-
-The MicroServer by default logs one record per minute to a CSV file on a
-microSD card with a new CSV file started for each day. These CSV files are
-automatically pruned after one year so there's never more than about 365 
-files or days of data on the MicroServer.
-
-Probably the best way to import historical data is to implement a new import
-configuration class based on the Weather Underground wuimport.py implementation 
-used with the wee_import utility. This requires the following functionality:
-
-a. Option to download all or a date range of files from the MicroServer. 
-   This will require logging in as the admin user and screen-scraping the 
-   Data Logs page (/admin/logfiles.php) to retrieve the URL of each available 
-   file. Then, each file within the range would be downloaded. It would be 
-   preferable to point this to a known folder and avoid downloading any
-   file that was already downloaded. Note that the file for "today" is always
-   a partial file so it may be best not to download it.
-
-b. Import daily CSV files from a folder, optionally based on a date-range.
-   The import function needs to be separate from the download so it will be
-   possible to upload older archived files into WeeWX that are no longer 
-   on the MicroServer but were previously downloaded by other means.
- 
+    quick_retries = 3  # Failed polls in a row before backing off
+    max_backoff = 300  # Longest wait between polls during an outage
+    timeout = 4  # Seconds to wait for the MicroServer to respond
+    skip_unchanged = False  # Skip polls where mtSampTime has not changed
+    wind_poll_interval = 1.0  # Optional seconds between polls for fast wind
+
+Only wind packets are returned between the last polls of each minute, so
+the polls in between parse only the wind elements of the XML. To stream wind
+faster than once a second, set wind_poll_interval, which overrides
+polls_per_minute. Every poll asks the MicroServer whether the data has
+changed using the ETag and Last-Modified headers of the previous response.
+When the MicroServer answers that it hasn't, the previous data is used
+without downloading or parsing it again. MicroServers that ignore the
+headers simply return the data as before.
+
+When a MicroServer stops responding, it is polled again at the normal
+interval quick_retries times. After that the driver backs off, waiting twice
+as long after each failure up to max_backoff seconds, which defaults to
+the archive interval. A random part of each wait keeps several stations from
+retrying in step. Before each retry a plain TCP connection is opened to the
+MicroServer and the full request is only made if that succeeds. Once a poll
+succeeds, normal polling resumes and the length of the outage is logged.
+
+To poll more than one MicroServer, list each one in a stations section. Each
+station takes its settings from the [ColumbiaMicroServer] stanza unless set
+in its own section and may have its own sensor_map. The field_prefix is added
+to every field returned for a station to keep the fields from different
+stations apart. The stations are polled concurrently.
+
+[ColumbiaMicroServer]
+    driver = user.columbia_ms
+    polls_per_minute = 4
+    [[stations]]
+        [[[roof]]]
+            host = 192.168.0.50
+        [[[garden]]]
+            host = 192.168.0.51
+            field_prefix = garden_
+
+Measurements beyond the default set, such as mtWetBulbGlobeTemp, are read by
+naming their packet group in an input_elements section and mapping them to a
+field in the sensor_map. The packet group decides the units of the value and
+which poll of the minute returns it. unit_elements lists the elements whose
+unit attribute gives the units of each packet group.
+
+    [[input_elements]]
+        mtWetBulbGlobeTemp = temp
+        mtDegreeDay = generic
+    [[sensor_map]]
+        extraTemp4 = mtWetBulbGlobeTemp
+        growingDegreeDays = mtDegreeDay
+
+With watch_config set, the configuration file is checked for changes every
+watch_config_interval seconds and the sensor_map, input_elements and
+unit_elements of each station are reloaded between polls without restarting
+WeeWX. Rain totals carry on across a reload. Other settings and adding or
+removing stations still need a restart, and any of them that changed are
+logged. A file that can't be read is tried again at the next check.
+
+    watch_config = True
+    watch_config_interval = 10
+
+To keep slow network requests from delaying loop packets, the stations can be
+polled from a separate thread which keeps up to prefetch_depth polls ready
+for the driver. Each poll is started early by the time recent polls took,
+up to half the poll interval, so its data is ready at the deadline. Polls
+older than max_data_age seconds (default is the poll interval) are dropped
+rather than returned, though the once-a-minute data of a dropped poll is
+kept for the next one.
+
+    prefetch = True
+    prefetch_depth = 2
+    max_data_age = 15
+
+The time taken by each poll can be kept for the most recent stats_size polls
+of each station and summarized in the log every stats_interval seconds with
+the median, 95th percentile and maximum of the connect time (including the
+DNS lookup), transfer time, bytes, parse time, translate time, lateness of
+the poll and retries. With prefetch, the depth of the prefetch queue and age
+of each poll taken from it are summarized too, along with the number of
+polls dropped because the queue was full or the data was too old. The same
+figures can be written in Prometheus text format to metrics_file, such as
+for the node_exporter textfile collector, or served at
+http://metrics_address:metrics_port/metrics. Setting either of these turns
+on the stats.
+
+    stats = False
+    stats_size = 240
+    stats_interval = 300
+    metrics_file = /var/lib/node_exporter/columbia_ms.prom
+    metrics_port = 9106
+    metrics_address = 127.0.0.1
+
+Capturing and Replaying
+
+Rather than logging every response at debug level, the raw XML can be
+captured to a compressed file along with the time it was fetched. Responses
+that are the same as the one before are stored as a reference to it. When
+the file grows past capture_max_bytes it is renamed with a .1 suffix, older
+files moving up to capture_backups. With several stations, set capture_file
+in the section of each station.
+
+    capture_file = /var/tmp/columbia_ms.capture.gz
+    capture_max_bytes = 10000000
+    capture_backups = 5
+
+A capture file can be replayed in place of polling the MicroServer, such as
+for testing changes to the driver offline. A replay_speed of 0 returns the
+packets as fast as possible and 1 returns them at the rate they were
+captured. The packets have the time the data was captured and the driver
+stops returning packets at the end of the file.
+
+    replay_file = /var/tmp/columbia_ms.capture.gz
+    replay_speed = 0
+
+or from the command line:
+
+    PYTHONPATH=bin python bin/user/columbia_ms.py --replay=FILE [--speed=N]
+
+Sharing the Latest Data
+
+The MicroServer copes badly with more than one client polling it. To let
+wee_device --current and other programs on the same machine see the latest
+data without polling the MicroServer themselves, set share_file. After each
+poll the driver writes the latest packet groups of each station to it, so
+put it on a tmpfs such as /run rather than wearing out an SD card. Polls
+that only have the wind are written at most once every share_min_interval
+seconds.
+
+    share_file = /run/weewx/columbia_ms.json
+    share_max_age = 120  # Seconds before the shared data is too old to use
+    share_min_interval = 1
+
+The file is JSON with a seq number counting the polls published, the time
+of the last poll and the packet groups of each station, as returned by
+--test-parse, with the time they were fetched, their mtSampTime and the rain
+total before them. It is written to a temporary file and renamed, so a
+reader always sees a complete file, and removed when the driver stops. From
+the command line:
+
+    PYTHONPATH=bin python bin/user/columbia_ms.py --share=/run/weewx/columbia_ms.json
+
+Given the configuration file with --config, the command line also reads the
+shared data instead of polling the MicroServer when it is recent enough.
+
+Downloading Log Files
+
+The daily CSV log files can be downloaded from the MicroServer into a folder
+using the Data Logs page of the admin console, which needs the admin password
+in the driver stanza:
+
+    admin_user = admin
+    admin_password = secret
+    log_dir = /var/lib/weewx/columbia_ms
+    log_workers = 2  # Number of files to download at once
+
+then run:
+
+    wee_device --download-logs [--date-from=YYYY-MM-DD] [--date-to=YYYY-MM-DD]
+
+Files already downloaded are skipped, interrupted downloads are resumed and
+the partial file for today is never downloaded.
+
+Importing Log Files
+
+The daily CSV log files in log_dir can be imported into the archive with:
+
+    wee_device --import-logs [--date-from=YYYY-MM-DD] [--date-to=YYYY-MM-DD]
+
+The first row of each file must name the MicroServer measurement of each
+column, which is mapped to a WeeWX field using the sensor_map. The log files
+don't record their units so give the units of each packet group, using the
+same names as the MicroServer XML, if they are not the defaults shown:
+
+    log_time_column = mtSampTime
+    log_time_format = %Y/%m/%d %H:%M:%S
+    log_interval = 1  # Minutes between log records
+    import_batch_size = 5000  # Records inserted per transaction
+    use_numpy = True  # Convert whole columns with NumPy if it is installed
+    [[log_units]]
+        wind = mph
+        temp = degreeF
+        rain = inchesRain
+        pressure = inchesHg
+
+Records already in the archive are skipped and the daily summaries are
+rebuilt once all files have been imported.
+
+The records parsed from each log file are kept in a compact cache in the
+cache folder of log_dir so each file is only parsed again once it changes
+or the settings for reading it, such as log_units or sensor_map, change.
+Set log_cache = False to always parse the log files.
+
+Catching Up After Downtime
+
+When WeeWX starts, the archive records missed while it was not running are
+made from the log files, which are downloaded into log_dir, including the
+partial file for today. The one minute log records are averaged into
+records for each archive interval using the WeeWX accumulators. Catch-up
+needs admin_password and log_dir and goes back at most catchup_days days,
+leaving longer gaps to wee_device --import-logs. Each log file is parsed
+once and the records kept in a cache folder in log_dir, so restarting again
+only reads the files that have changed. Catch-up is only done for a single
+station, not when a stations section is used.
+
+    catchup = True
+    catchup_days = 7
+
 Non-goals
 
 The MicroServer does not have any API's to support the following functions:
 * Query of hardware status
 * Setting hardware configuration
-* Update historical data automatically within this driver.
+* Obtain historical data in the same format as the current data.
 
 Since there already exists a full-featured web-based administration console, 
 spending much effort to duplicate the console functionality is probably not 
@@ -88,26 +268,83 @@ done.
 from __future__ import with_statement
 from __future__ import absolute_import
 from __future__ import print_function
+import array
+import bisect
+import calendar
+import collections
+import csv
+import datetime
+import hashlib
+import json
+import math
+import os
+import random
+import re
 import time
 import socket
-from xml.etree import ElementTree
+import sys
+import threading
 
 DRIVER_NAME = 'ColumbiaMicroServer'
-DRIVER_VERSION = '1.0.0'
-DRIVER_SHORT_NAME = 'columbia_ms'
 
 try:
     # Python 3
-    from urllib.request import Request, urlopen
+    from urllib.request import Request
     from urllib.error import HTTPError, URLError
+    from urllib.request import build_opener, HTTPPasswordMgrWithDefaultRealm
+    from urllib.request import HTTPBasicAuthHandler, HTTPDigestAuthHandler
+    from urllib.parse import urlsplit, urljoin
+    from http.client import HTTPConnection, HTTPException
+    from http.server import BaseHTTPRequestHandler, HTTPServer
 except ImportError:
     # Python 2
-    from urllib2 import Request, urlopen, HTTPError, URLError
+    from urllib2 import Request, HTTPError, URLError
+    from urllib2 import build_opener, HTTPPasswordMgrWithDefaultRealm
+    from urllib2 import HTTPBasicAuthHandler, HTTPDigestAuthHandler
+    from urlparse import urlsplit, urljoin
+    from httplib import HTTPConnection, HTTPException
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    # Python 3
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+try:
+    # Python 3.3+
+    monotonic_time = time.monotonic
+except AttributeError:
+    # Python 2
+    monotonic_time = time.time
+
+try:
+    # Run from bin/user or with it on the path
+    import columbia_ms_core
+except ImportError:
+    # Loaded by WeeWX as part of the user package
+    import user.columbia_ms_core as columbia_ms_core
+
+if __name__ == '__main__' and [arg for arg in sys.argv[1:]
+                               if arg == '--version' or arg.split('=')[0] == '--test-parse']:
+    # These commands don't need WeeWX so run them without loading it
+    sys.exit(columbia_ms_core.main())
 
 import weewx
 import weewx.units
 import weewx.drivers
 import weewx.wxformulas
+import weeutil.weeutil
+
+# The parser, translation and capture files don't need WeeWX so they are
+# kept in columbia_ms_core.
+DRIVER_VERSION = columbia_ms_core.DRIVER_VERSION
+DRIVER_SHORT_NAME = columbia_ms_core.DRIVER_SHORT_NAME
+ColumbiaMicroServerTranslation = columbia_ms_core.ColumbiaMicroServerTranslation
+ColumbiaMicroServerRecorder = columbia_ms_core.ColumbiaMicroServerRecorder
+ColumbiaMicroServerParser = columbia_ms_core.ColumbiaMicroServerParser
+ColumbiaMicroServerStation = columbia_ms_core.ColumbiaMicroServerStation
 
 try:
     # Test for new-style weewx logging by trying to import weeutil.logger
@@ -124,6 +361,11 @@ try:
     def logerr(msg):
         log.error(msg)
 
+    def setup_logging(debug):
+        """Set up logging when run from the command line."""
+        weewx.debug = 1 if debug else 0
+        weeutil.logger.setup('wee_' + DRIVER_SHORT_NAME, {})
+
 except ImportError:
     # Old-style weewx logging
     import syslog
@@ -144,8 +386,55 @@ except ImportError:
     def logerr(msg):
         logmsg(syslog.LOG_ERR, msg)
 
+    def setup_logging(debug):
+        """Set up logging when run from the command line."""
+        weewx.debug = 1 if debug else 0
+        syslog.openlog('wee_' + DRIVER_SHORT_NAME, syslog.LOG_PID | syslog.LOG_CONS)
+        syslog.setlogmask(syslog.LOG_UPTO(syslog.LOG_DEBUG if debug else syslog.LOG_INFO))
+
+    # The core module logs through the logging module so send its messages
+    # to syslog instead.
+    columbia_ms_core.logdbg = logdbg
+    columbia_ms_core.loginf = loginf
+    columbia_ms_core.logerr = logerr
+
+def parse_date(value):
+    """Return a date from a YYYY-MM-DD string or None if not given."""
+    if not value:
+        return None
+    return datetime.date(*time.strptime(value, '%Y-%m-%d')[:3])
+
+def get_input_elements(stn_dict):
+    """Return the packet group of each input element and the list of unit
+    elements, which are the defaults with any input_elements section and
+    unit_elements option in stn_dict applied."""
+    input_elements = dict(ColumbiaMicroServerStation.XML_INPUT_ELEMENTS)
+    input_elements.update(stn_dict.get('input_elements', {}))
+    unit_elements = weeutil.weeutil.option_as_list(
+        stn_dict.get('unit_elements', ColumbiaMicroServerStation.XML_INPUT_UNIT_ELEMENTS))
+    return input_elements, list(unit_elements)
+
+def get_tool_stn_dict(stn_dict):
+    """Return the settings for a driver made by a tool such as wee_device
+    while WeeWX may be running, without the settings that would write to
+    the files or take the port of the running driver."""
+    tool_dict = dict(stn_dict)
+    for option in ('share_file', 'capture_file', 'metrics_file', 'metrics_port', 'watch_config'):
+        tool_dict.pop(option, None)
+    if stn_dict.get('stations'):
+        tool_dict['stations'] = dict((name, dict((option, value) for option, value in options.items()
+                                                 if option != 'capture_file'))
+                                     for name, options in stn_dict['stations'].items())
+    return tool_dict
+
 def loader(config_dict, engine):
-    return ColumbiaMicroServerDriver(**config_dict[DRIVER_NAME])
+    stn_dict = dict(config_dict[DRIVER_NAME])
+    # Where to look for changes when watch_config is set
+    stn_dict.setdefault('config_path', getattr(config_dict, 'filename', None))
+    # The archive interval isn't in the driver stanza but catch-up records
+    # and the longest backoff are based on it.
+    stn_dict.setdefault('archive_interval', config_dict.get('StdArchive', {}).get('archive_interval', 300))
+    return ColumbiaMicroServerDriver(**stn_dict)
 
 def configurator_loader(config_dict):
     return ColumbiaMicroServerConfigurator()
@@ -173,6 +462,10 @@ class ColumbiaMicroServerConfEditor(weewx.drivers.AbstractConfEditor):
 
     # Number of retries to perform a quick retry
     quick_retries = 3
+
+    # Longest wait in seconds between polls when the MicroServer is not
+    # responding. Defaults to the archive interval.
+    max_backoff = 300
 """
 
 
@@ -183,22 +476,77 @@ class ColumbiaMicroServerConfigurator(weewx.drivers.AbstractConfigurator):
                           help="display weather station configuration")
         parser.add_option("--current", dest="current", action="store_true",
                           help="get the current weather conditions")
+        parser.add_option("--download-logs", dest="download_logs", action="store_true",
+                          help="download the daily log files from the MicroServer")
+        parser.add_option("--log-dir", dest="log_dir", metavar="DIR",
+                          help="folder for the daily log files")
+        parser.add_option("--date-from", dest="date_from", metavar="YYYY-MM-DD",
+                          help="first date of the daily log files to use")
+        parser.add_option("--date-to", dest="date_to", metavar="YYYY-MM-DD",
+                          help="last date of the daily log files to use")
+        parser.add_option("--workers", dest="workers", type=int, metavar="N",
+                          help="number of log files to download at once")
+        parser.add_option("--import-logs", dest="import_logs", action="store_true",
+                          help="import the daily log files into the archive")
 
     def do_options(self, options, parser, config_dict, prompt):
-        station = ColumbiaMicroServerDriver(**config_dict[DRIVER_NAME])
+        if options.download_logs:
+            self.download_logs(config_dict[DRIVER_NAME], options)
+            return
+        if options.import_logs:
+            self.import_logs(config_dict, options)
+            return
+        stn_dict = config_dict[DRIVER_NAME]
+        station = ColumbiaMicroServerDriver(**get_tool_stn_dict(stn_dict))
         if options.current:
-            self.show_current(station)
+            shared = None
+            if stn_dict.get('share_file'):
+                shared = ColumbiaMicroServerShare.read(stn_dict['share_file'],
+                                                       float(stn_dict.get('share_max_age', 120)))
+            self.show_current(station, shared)
         else:
             self.show_info(station)
 
+    @staticmethod
+    def download_logs(stn_dict, options):
+        """Download the daily log files not already downloaded."""
+        downloader = ColumbiaMicroServerLogDownloader(
+            stn_dict.get('host', '192.168.0.50'),
+            int(stn_dict.get('port', 80)),
+            options.log_dir or stn_dict.get('log_dir', '.'),
+            stn_dict.get('admin_user', 'admin'),
+            stn_dict.get('admin_password'),
+            options.workers or int(stn_dict.get('log_workers', 2)))
+        downloaded, skipped, failed = downloader.download(
+            parse_date(options.date_from), parse_date(options.date_to))
+        print("%d downloaded, %d already downloaded, %d failed" % (downloaded, skipped, failed))
+
+    @staticmethod
+    def import_logs(config_dict, options):
+        """Import the daily log files into the archive."""
+        stn_dict = config_dict[DRIVER_NAME]
+        importer = ColumbiaMicroServerLogImporter(
+            config_dict, options.log_dir or stn_dict.get('log_dir', '.'), stn_dict)
+        added = importer.import_logs(parse_date(options.date_from), parse_date(options.date_to))
+        print("%d records added" % added)
+
     @staticmethod
     def show_info(station):
         """Query the station then display the settings."""
         # FIXME: implement show_info
 
     @staticmethod
-    def show_current(station):
-        """Display latest readings from the station."""
+    def show_current(station, shared=None):
+        """Display latest readings from the station, taking them from the
+        data shared by the running driver if there is any."""
+        if shared is not None:
+            for source in station.sources:
+                if source.name in shared['stations']:
+                    latest = shared['stations'][source.name]
+                    source.last_rain_total = latest.get('last_rain_total')
+                    for packet in source.gen_packets(latest['pkt_grp'], True, True, int(latest['time'] + 0.5)):
+                        print(packet)
+            return
         for packet in station.genLoopPackets():
             print(packet)
             break
@@ -230,6 +578,11 @@ class ColumbiaMicroServerDriver(weewx.drivers.AbstractDevice):
         'radiation': 'mtSolarRadiaton',
     }
 
+    # Settings that watch_config reloads without a restart
+    RELOADED_OPTIONS = ('sensor_map', 'input_elements', 'unit_elements')
+    # Settings added by the loader when they aren't in the driver stanza
+    LOADER_OPTIONS = ('config_path', 'archive_interval')
+
     # Map device units from XML attribute to WeeWX units.
     # See http://www.weewx.com/docs/customizing.htm#units
     UNITS_MAP = {
@@ -246,203 +599,2194 @@ class ColumbiaMicroServerDriver(weewx.drivers.AbstractDevice):
         'mph': weewx.US,
     }
 
+    # Fields converted from knots to mph when the MicroServer reports wind
+    # speed in knots.
+    KNOT_FIELDS = ('windSpeed', 'windGust')
+
     def __init__(self, **stn_dict):
         loginf('driver version is %s' % DRIVER_VERSION)
-        if 'station_url' in stn_dict:
-            self.station_url = stn_dict['station_url']
-        else:
-            host = stn_dict.get('host', '192.168.0.50')
-            port = int(stn_dict.get('port', 80))
-            self.station_url = "http://%s:%s/tmp/latestsampledata_u.xml" % (host, port)
-        loginf("station url is %s" % self.station_url)
-        self.polls_per_minute = int(stn_dict.get('polls_per_minute', 4))
+        self.polls_per_minute = float(stn_dict.get('polls_per_minute', 4))
+        if 'wind_poll_interval' in stn_dict:
+            self.polls_per_minute = 60.0 / float(stn_dict['wind_poll_interval'])
         loginf("polls_per_minute is %s" % self.polls_per_minute)
-        self.poll_interval = 60 / self.polls_per_minute
+        self.poll_interval = 60.0 / self.polls_per_minute
         loginf("poll interval is %s" % self.poll_interval)
-        self.poll_lead_seconds = int(stn_dict.get('poll_lead_seconds', 5))
+        self.poll_lead_seconds = float(stn_dict.get('poll_lead_seconds', 5))
         loginf("poll_lead_seconds is %s" % self.poll_lead_seconds)
-        self.sensor_map = dict(ColumbiaMicroServerDriver.DEFAULT_SENSOR_MAP)
-        if 'sensor_map' in stn_dict:
-            self.sensor_map.update(stn_dict['sensor_map'])
-        loginf("sensor map: %s" % self.sensor_map)
-        self.quick_retries = int(stn_dict.get('quick_retries', 3))
-        self.last_rain_total = None
+        self.scheduler = ColumbiaMicroServerScheduler(self.poll_interval, self.poll_lead_seconds)
+        self.archive_interval = int(stn_dict.get('archive_interval', 300))
+        # Return packets from a capture file rather than polling
+        self.replay_file = stn_dict.get('replay_file')
+        self.replay_speed = float(stn_dict.get('replay_speed', 0))
+        if self.replay_file:
+            loginf("replaying %s at speed %s" % (self.replay_file, self.replay_speed))
+        stations = stn_dict.get('stations')
+        self.source_dicts = self._get_source_dicts(stn_dict)
+        self.sources = [ColumbiaMicroServerSource(name, source_dict, self.poll_interval)
+                        for name, source_dict in self.source_dicts]
+        # Warn if stations would overwrite each other's fields
+        fields = set()
+        for source in self.sources:
+            overlap = fields.intersection(source.fields)
+            if overlap:
+                logerr("%s: fields also returned by another station: %s" % (source.name, sorted(overlap)))
+            fields.update(source.fields)
+        capture_files = [source.recorder.path for source in self.sources if source.recorder is not None]
+        if len(set(capture_files)) < len(capture_files):
+            logerr("stations must each have their own capture_file")
+        # Make the archive records missed while WeeWX was down from the logs
+        self.catchup = None
+        if stn_dict.get('admin_password') and stn_dict.get('log_dir') and \
+                weeutil.weeutil.to_bool(stn_dict.get('catchup', True)):
+            if stations:
+                loginf("catch-up from log files is not done with more than one station")
+            else:
+                self.catchup = ColumbiaMicroServerCatchup(stn_dict, self.archive_interval)
+                loginf("catch-up from log files in %s for up to %d days" %
+                       (self.catchup.log_dir, self.catchup.max_days))
+        # Poll from a separate thread so the network doesn't hold up packets
+        self.prefetch = weeutil.weeutil.to_bool(stn_dict.get('prefetch', False))
+        loginf("prefetch is %s" % self.prefetch)
+        self.prefetch_queue = queue.Queue(int(stn_dict.get('prefetch_depth', 2)))
+        self.max_data_age = float(stn_dict.get('max_data_age', self.poll_interval))
+        self.prefetch_thread = None
+        self.prefetch_stop = threading.Event()
+        self.prefetch_error = None
+        # Queue depth and age of the most recent poll taken from the queue
+        # and the number of polls dropped because the queue was full or the
+        # data was too old.
+        self.prefetch_depth = 0
+        self.prefetch_staleness = 0.0
+        self.prefetch_dropped_full = 0
+        self.prefetch_dropped_stale = 0
+        # How long the latest poll took and how far ahead of each deadline
+        # the prefetch thread starts polling.
+        self.poll_duration = 0.0
+        self.poll_ahead = 0.0
+        # Poll timings, only kept when stats are turned on
+        self.metrics_file = stn_dict.get('metrics_file')
+        self.metrics_port = stn_dict.get('metrics_port')
+        self.metrics_address = stn_dict.get('metrics_address', '127.0.0.1')
+        self.stats = None
+        # The metrics server is started with the first loop packet so tools
+        # such as wee_device don't take the port of the running driver.
+        self.metrics_server = None
+        if weeutil.weeutil.to_bool(stn_dict.get('stats', False)) or self.metrics_file or self.metrics_port:
+            self.stats = ColumbiaMicroServerStats(int(stn_dict.get('stats_size', 240)),
+                                                  float(stn_dict.get('stats_interval', 300)))
+            loginf("stats kept for the last %d polls, summarized every %ss" %
+                   (self.stats.size, self.stats.interval))
+        # Reload the sensor maps and input elements when the configuration
+        # file changes
+        self.config_path = None
+        self.config_mtime = None
+        self.config_check_interval = float(stn_dict.get('watch_config_interval', 10))
+        self.next_config_check = 0.0
+        if weeutil.weeutil.to_bool(stn_dict.get('watch_config', False)):
+            if stn_dict.get('config_path'):
+                self.config_path = stn_dict['config_path']
+                self.config_mtime = self._get_config_mtime()
+                loginf("watching %s for changes" % self.config_path)
+            else:
+                logerr("watch_config needs the path of the configuration file")
+        # Latest packet groups shared with other programs
+        self.share = None
+        if stn_dict.get('share_file'):
+            self.share = ColumbiaMicroServerShare(stn_dict['share_file'],
+                                                  float(stn_dict.get('share_min_interval', 1.0)))
+            loginf("sharing the latest data in %s" % self.share.path)
 
     @property
     def hardware_name(self):
         return "Columbia Weather Systems MicroServer"
 
+    @staticmethod
+    def _get_source_dicts(stn_dict):
+        """Return the name and settings of each station. Each station takes
+        its settings from the driver stanza, then from its own section with
+        the sensor maps and input elements merged. Without a stations
+        section, the one station has no name."""
+        stations = stn_dict.get('stations')
+        if not stations:
+            return [(None, stn_dict)]
+        source_dicts = []
+        for name, options in stations.items():
+            source_dict = dict(stn_dict)
+            del source_dict['stations']
+            source_dict.update(options)
+            for section in ('sensor_map', 'input_elements'):
+                source_dict[section] = dict(stn_dict.get(section, {}))
+                source_dict[section].update(options.get(section, {}))
+            source_dicts.append((name, source_dict))
+        return source_dicts
+
+    @staticmethod
+    def _changed_options(old_dict, new_dict):
+        """Return the names of the options that differ between two station
+        settings, other than those reloaded without a restart and those
+        the loader adds that aren't in the file."""
+        changed = []
+        for option in sorted(set(old_dict) | set(new_dict)):
+            if option in ColumbiaMicroServerDriver.RELOADED_OPTIONS:
+                continue
+            if option in ColumbiaMicroServerDriver.LOADER_OPTIONS and option not in new_dict:
+                continue
+            if old_dict.get(option) != new_dict.get(option):
+                changed.append(option)
+        return changed
+
+    def _get_config_mtime(self):
+        try:
+            return os.stat(self.config_path).st_mtime
+        except OSError as e:
+            logdbg("_get_config_mtime: %s: %s" % (self.config_path, e))
+            return None
+
+    def _check_config(self):
+        """Reload the sensor maps and input elements if the configuration
+        file has changed. This is done between polls and each station
+        switches to its new settings in one step, so every poll is parsed and
+        translated with either the old settings or the new ones."""
+        now = monotonic_time()
+        if now < self.next_config_check:
+            return
+        self.next_config_check = now + self.config_check_interval
+        mtime = self._get_config_mtime()
+        if mtime is None or mtime == self.config_mtime:
+            return
+        import configobj
+        try:
+            stn_dict = configobj.ConfigObj(self.config_path, file_error=True, encoding='utf-8')[DRIVER_NAME]
+            source_dicts = self._get_source_dicts(stn_dict)
+        except (configobj.ConfigObjError, IOError, KeyError) as e:
+            # The file may be part way through being saved so try again at
+            # the next check.
+            logerr("_check_config: %s not reloaded: %s" % (self.config_path, e))
+            return
+        self.config_mtime = mtime
+        loginf("_check_config: %s has changed" % self.config_path)
+        if [name for name, _ in source_dicts] != [name for name, _ in self.source_dicts]:
+            logerr("_check_config: restart to add or remove stations")
+        names = dict(source_dicts)
+        changed = set()
+        for name, source_dict in self.source_dicts:
+            if name in names:
+                changed.update(self._changed_options(source_dict, names[name]))
+        if changed:
+            logerr("_check_config: restart to use the new %s" % ', '.join(sorted(changed)))
+        for source, (name, _) in zip(self.sources, self.source_dicts):
+            if name in names:
+                source.reconfigure(names[name])
+
+    def closePort(self):
+        self.prefetch_stop.set()
+        for source in self.sources:
+            source.session.close()
+            if source.recorder is not None:
+                source.recorder.close()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+        if self.share is not None:
+            self.share.close()
+
+    def genStartupRecords(self, since_ts):
+        """Return the archive records after since_ts made from the MicroServer
+        log files. WeeWX uses this to catch up when it starts."""
+        if self.catchup is None:
+            raise NotImplementedError("catch-up needs admin_password and log_dir")
+        return self.catchup.gen_records(since_ts)
+
+    def genArchiveRecords(self, since_ts):
+        """The MicroServer has no archive records of its own, only the log
+        files which lag by a minute, so while running WeeWX makes the
+        archive records from the loop packets."""
+        raise NotImplementedError("archive records are made in software")
+
     def genLoopPackets(self):
-        pkt_grp = None
-        ntries = 0
+        if self.metrics_port and self.metrics_server is None:
+            self._start_metrics_server()
+        if self.replay_file:
+            for packet in self._gen_replay_packets():
+                yield packet
+        elif self.prefetch:
+            for packet in self._gen_prefetched_packets():
+                yield packet
+        else:
+            for results, last_poll_this_minute in self._gen_polls():
+                for packet in self._gen_packets(results, last_poll_this_minute):
+                    yield packet
+
+    def _start_metrics_server(self):
+        try:
+            self.metrics_server = ColumbiaMicroServerMetricsServer(self.metrics_address, int(self.metrics_port),
+                                                                   self.stats)
+        except (socket.error, OSError) as e:
+            logerr("metrics not served at %s:%s: %s" % (self.metrics_address, self.metrics_port, e))
+            return
+        self.metrics_server.start()
+        loginf("metrics served at http://%s:%s/metrics" % (self.metrics_address, self.metrics_port))
+
+    def _gen_polls(self):
+        """Poll the stations at each polling interval. Yields a list of the
+        source, packet groups and new sample flag for each station polled
+        successfully together with whether this is the last poll interval in
+        the minute."""
         # Assume the first time being called is the last polling interval for 
         # the minute so all packet types are returned from the first poll 
         # after startup. This is only an issue if loop packets are being  
         # returned to web pages for near real-time updates.
         last_poll_this_minute = True
         while True:
+            if self.config_path is not None:
+                self._check_config()
+            # Only the wind elements are parsed unless all packet types are
+            # returned from this poll.
+            start = monotonic_time()
+            polled, late = self._poll_sources(last_poll_this_minute)
+            self.poll_duration = monotonic_time() - start
+            results = []
+            for source in polled:
+                if source.error is None:
+                    source.breaker.success()
+                    source.ntries = 0
+                    results.append((source, source.pkt_grp, source.new_sample))
+                else:
+                    source.ntries += 1
+                    source.breaker.failure(source.error)
+            # A station still busy with a poll has failed this one
+            for source in late:
+                source.ntries += 1
+                source.breaker.failure(weewx.WeeWxIOError("no response within %s seconds" % source.timeout))
+            if self.stats is not None:
+                self._record_stats(polled)
+            if self.share is not None and results:
+                self.share.publish(results)
+            yield results, last_poll_this_minute
+            # Stations that are failing are skipped by _poll_sources until
+            # their breaker allows another try.
+            last_poll_this_minute = self._wait_for_next_poll_interval()
+
+    def _gen_packets(self, results, last_poll_this_minute):
+        for source, pkt_grp, new_sample in results:
+            for packet in source.gen_packets(pkt_grp, new_sample, last_poll_this_minute):
+                yield packet
+            if self.stats is not None:
+                self.stats.record(source.name, 'translate', source.translate_time)
+
+    def _gen_replay_packets(self):
+        """Return the packets from the responses in the replay file for the
+        first station. Packets are timed from when each response was
+        captured, either as fast as possible or scaled by replay_speed."""
+        source = self.sources[0]
+        start = None
+        lead = self.poll_lead_seconds
+        records = ColumbiaMicroServerRecorder.read(self.replay_file)
+        record = next(records, None)
+        # As when polling, everything is returned from the first response
+        first = True
+        while record is not None:
+            fetch_time, data = record
+            record = next(records, None)
+            # The last poll of each minute is the last one before the minute
+            # shifted by poll_lead_seconds changes.
+            last_poll_this_minute = first or (record is not None and
+                                              int((fetch_time + lead) // 60) != int((record[0] + lead) // 60))
+            first = False
+            if self.replay_speed > 0:
+                if start is None:
+                    start = (monotonic_time(), fetch_time)
+                delay = start[0] + (fetch_time - start[1]) / self.replay_speed - monotonic_time()
+                if delay > 0:
+                    time.sleep(delay)
             try:
-                data = ColumbiaMicroServerStation.get_data(self.station_url)
-                logdbg("genLoopPackets: raw data: %s" % data)
-                pkt_grp = ColumbiaMicroServerStation.parse_data(data)
-                ntries = 0
+                source.process(data, last_poll_this_minute)
             except weewx.WeeWxIOError as e:
-                logerr("genLoopPackets: failed attempt %s of %s: %s" % (ntries, self.quick_retries, e))
-                ntries += 1
-                # First few retries are made quickly then more slowly
-                if ntries <= self.quick_retries:
-                    self._wait_for_next_poll_interval()
-                else:
-                    # Wait until the next major poll interval this minute
-                    while not self._wait_for_next_poll_interval():
-                        pass
+                logerr("genLoopPackets: %s: replayed data at %s: %s" % (source.name, fetch_time, e))
                 continue
-            # Iterate over each packet group returning the packet type and dict
-            for pkt_type, pkt in pkt_grp.items():
-                logdbg("genLoopPackets: parsed packet: %s" % pkt)
-                packet_time = int(time.time() + 0.5)
-                # If not a wind packet type, don't returning the packet unless
-                # this is the last polling interval for the minute.
-                if pkt_type != 'wind' and not last_poll_this_minute:
-                    continue
-                packet = {'dateTime': packet_time}
-                # Translate from input packet field names to output names
-                for field in self.sensor_map:
-                    if self.sensor_map[field] in pkt:
-                        packet[field] = pkt[self.sensor_map[field]]
-                # Translate the base_units type to one of the WeeWX unit types
-                base_units = pkt['base_units']
-                if base_units in ColumbiaMicroServerDriver.UNITS_MAP:
-                    packet['usUnits'] = ColumbiaMicroServerDriver.UNITS_MAP[base_units]
-                else:
-                    # If wind speed is in knots, convert to mph which is a 
-                    # supported unit type.
-                    if pkt_type == 'wind' and base_units == 'knots':
-                        packet['usUnits'] = weewx.US
-                        packet['windSpeed'] = weewx.units.conversionDict['knot']['miles_per_hour'](packet['windSpeed'])
-                        packet['windGust'] = weewx.units.conversionDict['knot']['miles_per_hour'](packet['windGust'])
-                    # Else if a generic packet type, then it's not US or metric 
-                    # specific so pick one
-                    elif base_units == 'generic':
-                        packet['usUnits'] = weewx.US
-                    else:
-                        logerr("genLoopPackets: error with unknown base_units: %s" % base_units)
-                # For a rain packet group, calculate the delta from the last rain packet
-                if pkt_type == 'rain':
-                    self._calculate_rain_delta(packet)
+            for packet in source.gen_packets(source.pkt_grp, source.new_sample,
+                                             last_poll_this_minute, int(fetch_time + 0.5)):
                 yield packet
-            # Wait until the next polling interval
-            last_poll_this_minute = self._wait_for_next_poll_interval()
-            time.sleep(1.0)
+        loginf("genLoopPackets: end of replay file %s" % self.replay_file)
+
+    def _record_stats(self, polled):
+        """Keep the timings of the latest poll and log a summary and write
+        the metrics file when one is due."""
+        for source in polled:
+            self.stats.record_poll(source, self.scheduler.lateness)
+        if self.stats.summary_due():
+            for line in self.stats.summary():
+                loginf("stats: %s" % line)
+            if self.metrics_file:
+                self.stats.write_metrics(self.metrics_file)
+
+    def _gen_prefetched_packets(self):
+        """Return packets from the polls made by the prefetch thread, dropping
+        any that are older than max_data_age. As when the queue is full, a
+        dropped poll that was the last of the minute or had a new sample is
+        carried into the next poll returned so nothing is lost."""
+        if self.prefetch_thread is None:
+            self.prefetch_thread = threading.Thread(target=self._prefetch, name='%s-prefetch' % DRIVER_SHORT_NAME)
+            self.prefetch_thread.daemon = True
+            self.prefetch_thread.start()
+        carried = None
+        while True:
+            try:
+                fetch_time, results, last_poll_this_minute = self.prefetch_queue.get(timeout=1.0)
+            except queue.Empty:
+                if not self.prefetch_thread.is_alive():
+                    raise weewx.WeeWxIOError("prefetch thread stopped: %s" % self.prefetch_error)
+                continue
+            self.prefetch_depth = self.prefetch_queue.qsize()
+            self.prefetch_staleness = time.time() - fetch_time
+            stale = self.prefetch_staleness > self.max_data_age
+            if stale:
+                self.prefetch_dropped_stale += 1
+            if self.stats is not None:
+                self.stats.record_prefetch(self.prefetch_depth, self.prefetch_staleness,
+                                           self.prefetch_dropped_full, self.prefetch_dropped_stale)
+            if stale:
+                loginf("genLoopPackets: dropped poll data %.3fs old" % self.prefetch_staleness)
+                if carried is not None:
+                    results, last_poll_this_minute = self._carry_dropped(carried[0], carried[1], results,
+                                                                         last_poll_this_minute)
+                carried = (results, last_poll_this_minute)
+                continue
+            if carried is not None:
+                results, last_poll_this_minute = self._carry_dropped(carried[0], carried[1], results,
+                                                                     last_poll_this_minute)
+                carried = None
+            logdbg("genLoopPackets: prefetch depth %d staleness %.3fs dropped %d full %d stale" %
+                   (self.prefetch_depth, self.prefetch_staleness,
+                    self.prefetch_dropped_full, self.prefetch_dropped_stale))
+            for packet in self._gen_packets(results, last_poll_this_minute):
+                yield packet
+
+    def _prefetch(self):
+        """Poll the stations ahead of the packet generator, keeping the most
+        recent polls in a bounded queue. Each poll is started early by the
+        time the recent polls have taken so its data is ready at the
+        deadline rather than that much after it."""
+        durations = collections.deque(maxlen=10)
+        try:
+            for results, last_poll_this_minute in self._gen_polls():
+                if self.prefetch_stop.is_set():
+                    break
+                fetch_time = time.time()
+                durations.append(self.poll_duration)
+                self.poll_ahead = min(max(durations), self.poll_interval / 2.0)
+                while True:
+                    try:
+                        self.prefetch_queue.put_nowait((fetch_time, results, last_poll_this_minute))
+                        break
+                    except queue.Full:
+                        # Make room by dropping the oldest poll. If it was the
+                        # last poll of the minute or had a new sample, this
+                        # one takes its place so nothing is lost.
+                        try:
+                            _, dropped, dropped_last = self.prefetch_queue.get_nowait()
+                            self.prefetch_dropped_full += 1
+                        except queue.Empty:
+                            continue
+                        results, last_poll_this_minute = self._carry_dropped(dropped, dropped_last, results,
+                                                                             last_poll_this_minute)
+        except Exception as e:
+            self.prefetch_error = e
+            logerr("_prefetch: stopped by error: %s" % e)
+
+    @staticmethod
+    def _carry_dropped(dropped, dropped_last, results, last_poll_this_minute):
+        """Return the results and last poll flag of a poll taking the place
+        of an older poll that was dropped. If the dropped poll was the last
+        of the minute or had a new sample, this one takes that on."""
+        new_samples = set(source for source, _, new_sample in dropped if new_sample)
+        results = [(source, pkt_grp, new_sample or source in new_samples)
+                   for source, pkt_grp, new_sample in results]
+        if dropped_last:
+            # Only the last poll of the minute has every packet group so
+            # keep the ones this poll lacks.
+            results = ColumbiaMicroServerDriver._merge_dropped(dropped, results)
+        return results, last_poll_this_minute or dropped_last
+
+    @staticmethod
+    def _merge_dropped(dropped, results):
+        """Add the packet groups from a dropped poll to those of a newer poll
+        that doesn't have them."""
+        dropped_grps = dict((source, pkt_grp) for source, pkt_grp, _ in dropped)
+        merged = []
+        for source, pkt_grp, new_sample in results:
+            if source in dropped_grps:
+                pkt_grp_merged = dict(dropped_grps[source])
+                pkt_grp_merged.update(pkt_grp)
+                pkt_grp = pkt_grp_merged
+            merged.append((source, pkt_grp, new_sample))
+        return merged
+
+    def _poll_sources(self, full=True):
+        """Fetch and parse the data from every station and return the ones
+        that finished in time and the ones that didn't. With more than one
+        station, each is polled in its own thread so the time taken is that
+        of the slowest station rather than the sum of them all. A station
+        that doesn't respond within its timeout is left to finish in the
+        background and counted as late for this poll, as is one still busy
+        with an earlier poll, so it doesn't hold up the others. Stations
+        backing off after failures are only polled once their breaker
+        allows. Only the wind elements are parsed unless full is True."""
+        sources = [source for source in self.sources if source.breaker.allow()]
+        if len(sources) <= 1:
+            for source in sources:
+                source.poll(full)
+            return sources, []
+        started = []
+        late = []
+        for source in sources:
+            if source.thread is not None and source.thread.is_alive():
+                logdbg("_poll_sources: %s: still busy with the previous poll" % source.name)
+                late.append(source)
+                continue
+            source.thread = threading.Thread(target=source.poll, args=(full,),
+                                             name='%s-%s' % (DRIVER_SHORT_NAME, source.name))
+            source.thread.daemon = True
+            source.thread.start()
+            started.append(source)
+        limit = monotonic_time() + max(source.timeout for source in sources)
+        for source in started:
+            source.thread.join(max(0.0, limit - monotonic_time()))
+        late.extend(source for source in started if source.thread.is_alive())
+        return [source for source in started if not source.thread.is_alive()], late
 
     def _wait_for_next_poll_interval(self):
         """Wait until the next polling interval less poll leading seconds so 
         the last poll time is before the top of the minute enabling it to 
         complete just before each archive interval. Returns True if this is the
         last poll interval in the minute, otherwise false."""
-        while (int(time.time()) + self.poll_lead_seconds) % int(self.poll_interval) != 0:
-            time.sleep(0.5)
-        last_poll_time = 60 - self.poll_lead_seconds
-        return(time.gmtime(time.time()).tm_sec in range(last_poll_time-1, last_poll_time+2))
+        last_poll_this_minute = self.scheduler.wait(ahead=self.poll_ahead)
+        if self.scheduler.missed:
+            loginf("poll running %.3fs late after missing %d poll(s)" %
+                   (self.scheduler.lateness, self.scheduler.missed))
+        else:
+            logdbg("poll running %.3fs late" % self.scheduler.lateness)
+        return last_poll_this_minute
+
+
+class ColumbiaMicroServerSource(object):
+    """A single MicroServer polled by the driver.
+
+    Holds the connection, sensor map, parser and all per-station state such
+    as the last rain total so that several MicroServers can be polled by one
+    driver. Output field names are prefixed with field_prefix so fields from
+    different stations can be told apart."""
+
+    def __init__(self, name, stn_dict, poll_interval):
+        if 'station_url' in stn_dict:
+            self.station_url = stn_dict['station_url']
+        else:
+            host = stn_dict.get('host', '192.168.0.50')
+            port = int(stn_dict.get('port', 80))
+            self.station_url = "http://%s:%s/tmp/latestsampledata_u.xml" % (host, port)
+        self.name = name or urlsplit(self.station_url).hostname or self.station_url
+        loginf("%s: station url is %s" % (self.name, self.station_url))
+        self.poll_interval = poll_interval
+        self.field_prefix = stn_dict.get('field_prefix', '')
+        if self.field_prefix:
+            loginf("%s: field_prefix is %s" % (self.name, self.field_prefix))
+        # Sensor map, input elements and the parsers and translations built
+        # from them, replaced as a whole when the configuration is reloaded
+        self.field_map = ColumbiaMicroServerFieldMap(stn_dict, self.field_prefix)
+        loginf("%s: sensor map: %s" % (self.name, self.sensor_map))
+        self.timeout = float(stn_dict.get('timeout', 4))
+        self.session = ColumbiaMicroServerSession(self.station_url, self.timeout)
+        self.last_rain_total = None
+        # Skip polls where the MicroServer sample time has not changed
+        self.skip_unchanged = weeutil.weeutil.to_bool(stn_dict.get('skip_unchanged', False))
+        loginf("%s: skip_unchanged is %s" % (self.name, self.skip_unchanged))
+        self.last_sample_time = None
+        # Observed seconds between MicroServer samples
+        self.sample_interval = None
+        # Packet types already returned for the current sample
+        self.sample_pkt_types = set()
+        # Result of the most recent poll, whether it has every packet group
+        # or only wind, and the data it was parsed from
+        self.pkt_grp = None
+        self.pkt_grp_full = False
+        self.last_data = None
+        self.new_sample = False
+        self.error = None
+        self.ntries = 0
+        self.breaker = ColumbiaMicroServerBreaker(
+            self.name, int(stn_dict.get('quick_retries', 3)),
+            poll_interval, float(stn_dict.get('max_backoff', stn_dict.get('archive_interval', 300))))
+        # Capture of the raw responses
+        self.recorder = None
+        if stn_dict.get('capture_file'):
+            self.recorder = ColumbiaMicroServerRecorder(stn_dict['capture_file'],
+                                                        int(stn_dict.get('capture_max_bytes', 10000000)),
+                                                        int(stn_dict.get('capture_backups', 5)))
+            loginf("%s: capturing responses to %s" % (self.name, self.recorder.path))
+        # Size of the latest response and time taken to parse it, and the
+        # time taken to translate the latest packet groups.
+        self.bytes = 0
+        self.parse_time = 0.0
+        self.translate_time = 0.0
+        # Thread polling this station when there is more than one
+        self.thread = None
+
+    @property
+    def sensor_map(self):
+        return self.field_map.sensor_map
+
+    @property
+    def fields(self):
+        return self.field_map.fields
+
+    @property
+    def parser(self):
+        return self.field_map.parser
+
+    @property
+    def wind_parser(self):
+        return self.field_map.wind_parser
+
+    def reconfigure(self, stn_dict):
+        """Switch to the sensor map and input elements in stn_dict if they
+        have changed. The rain total and everything else about the station
+        are kept."""
+        field_map = ColumbiaMicroServerFieldMap(stn_dict, self.field_prefix)
+        if field_map.same_as(self.field_map):
+            return False
+        self.field_map = field_map
+        # Parse the latest data again at the next full poll, even if it is
+        # unchanged, so any new elements are returned.
+        self.pkt_grp_full = False
+        loginf("%s: sensor map: %s" % (self.name, self.sensor_map))
+        return True
+
+    def poll(self, full=True):
+        """Fetch and parse the latest data from the MicroServer, only parsing
+        the wind elements unless full is True. On failure, the error is saved
+        in error rather than raised so the poll can be run in a thread."""
+        self.bytes = 0
+        self.parse_time = 0.0
+        try:
+            # Check that an unresponsive MicroServer is back before waiting
+            # on a full request.
+            if self.breaker.state == ColumbiaMicroServerBreaker.HALF_OPEN and not self.session.probe():
+                raise weewx.WeeWxIOError("%s:%s is not accepting connections" %
+                                         (self.session.host, self.session.port))
+            data = self.session.get_data()
+            logdbg("poll: %s: connect %.3fs transfer %.3fs connections %d requests %d" %
+                   (self.name, self.session.connect_time, self.session.transfer_time,
+                    self.session.connects, self.session.requests))
+            # Nothing is returned when the data hasn't changed since the
+            # last request.
+            unchanged = data is None
+            if unchanged:
+                data = self.last_data
+                if data is None:
+                    self.session.clear_validators()
+                    raise weewx.WeeWxIOError("%s: data not modified but there is no earlier data" % self.name)
+            if self.recorder is not None:
+                self.recorder.record(time.time(), data)
+            try:
+                self.process(data, full, unchanged)
+            except weewx.WeeWxIOError:
+                # The MicroServer would say the data it can't parse is not
+                # modified, so make the next request in full.
+                self.session.clear_validators()
+                raise
+            self.last_data = data
+            self.error = None
+        except weewx.WeeWxIOError as e:
+            self.error = e
+
+    def process(self, data, full=True, unchanged=False):
+        """Parse the data fetched from the MicroServer, only parsing the wind
+        elements unless full is True. Data that is unchanged, or has the same
+        sample time as the last data parsed when skip_unchanged is set, is
+        not parsed again unless only the wind was parsed last time and full
+        is True."""
+        self.bytes = 0 if unchanged else len(data)
+        if weewx.debug:
+            logdbg("poll: %s: raw data: %s" % (self.name, data))
+        sample_time = None
+        if self.skip_unchanged:
+            sample_time = ColumbiaMicroServerParser.get_sample_time(data)
+            if sample_time is not None and sample_time == self.last_sample_time:
+                unchanged = True
+        if unchanged and (self.pkt_grp_full or not full):
+            # The MicroServer hasn't taken a new sample since the
+            # last poll so reuse what was parsed then.
+            logdbg("poll: %s: sample %s unchanged" % (self.name, sample_time))
+            self.new_sample = False
+            return
+        start = monotonic_time()
+        self.pkt_grp = ColumbiaMicroServerStation.parse_data(data, self.parser if full else self.wind_parser)
+        self.parse_time = monotonic_time() - start
+        self.pkt_grp_full = full
+        self.new_sample = not unchanged
+        if not unchanged:
+            self._track_sample_time(sample_time)
+
+    def gen_packets(self, pkt_grp, new_sample, last_poll_this_minute, packet_time=None):
+        """Translate the packet groups from a poll to loop packets. The
+        packets are given the current time unless packet_time is given."""
+        if new_sample:
+            self.sample_pkt_types = set()
+        self.translate_time = 0.0
+        # Use the same settings for every packet group of the poll
+        field_map = self.field_map
+        # Iterate over each packet group returning the packet type and dict
+        for pkt_type, pkt in pkt_grp.items():
+            if weewx.debug:
+                logdbg("gen_packets: %s: parsed packet: %s" % (self.name, pkt))
+            if packet_time is None:
+                packet_time = int(time.time() + 0.5)
+            # If not a wind packet type, don't returning the packet unless
+            # this is the last polling interval for the minute.
+            if pkt_type != 'wind' and not last_poll_this_minute:
+                continue
+            # Don't return the same sample twice
+            if pkt_type in self.sample_pkt_types:
+                continue
+            start = monotonic_time()
+            translation = self._get_translation(field_map, pkt_type, pkt.get('base_units'))
+            # Without units the packet can't be used so drop it
+            if translation.us_units is None:
+                continue
+            packet = translation.translate(pkt, packet_time)
+            # For a rain packet group, calculate the delta from the last rain packet
+            if pkt_type == 'rain':
+                self._calculate_rain_delta(packet)
+            self.translate_time += monotonic_time() - start
+            if self.skip_unchanged:
+                self.sample_pkt_types.add(pkt_type)
+            yield packet
+
+    def _track_sample_time(self, sample_time):
+        """Record the sample time of newly parsed data and track how often
+        the MicroServer takes samples."""
+        if sample_time is None:
+            return
+        if self.last_sample_time is not None:
+            try:
+                interval = int(time.mktime(time.strptime(sample_time, ColumbiaMicroServerParser.SAMPLE_TIME_FORMAT)) -
+                               time.mktime(time.strptime(self.last_sample_time, ColumbiaMicroServerParser.SAMPLE_TIME_FORMAT)))
+            except ValueError:
+                interval = None
+            # Intervals longer than a poll interval only mean samples were
+            # missed between polls.
+            if interval is not None and 0 < interval <= self.poll_interval and interval != self.sample_interval:
+                loginf("%s: MicroServer sample interval is %s seconds" % (self.name, interval))
+                self.sample_interval = interval
+        self.last_sample_time = sample_time
+
+    def _get_translation(self, field_map, pkt_type, base_units):
+        """Return the translation for a packet group in the given units,
+        building it the first time those units are seen."""
+        try:
+            return field_map.translations[(pkt_type, base_units)]
+        except KeyError:
+            pass
+        # Translate from input packet field names to output names
+        fields = [(field, name) for field, name in field_map.sensor_map.items()
+                  if field_map.input_elements.get(name) == pkt_type]
+        conversions = []
+        # Translate the base_units type to one of the WeeWX unit types
+        if base_units in ColumbiaMicroServerDriver.UNITS_MAP:
+            us_units = ColumbiaMicroServerDriver.UNITS_MAP[base_units]
+        # If wind speed is in knots, convert to mph which is a 
+        # supported unit type.
+        elif pkt_type == 'wind' and base_units == 'knots':
+            us_units = weewx.US
+            knot_to_mph = weewx.units.conversionDict['knot']['miles_per_hour']
+            conversions = [(field, knot_to_mph) for field, _ in fields
+                           if field in ColumbiaMicroServerDriver.KNOT_FIELDS]
+        # Else if a generic packet type, then it's not US or metric 
+        # specific so pick one
+        elif base_units == 'generic':
+            us_units = weewx.US
+        else:
+            logerr("%s: error with unknown base_units, %s packets dropped: %s" % (self.name, pkt_type, base_units))
+            us_units = None
+        loginf("%s: %s packets in %s units" % (self.name, pkt_type, base_units))
+        fields = [(self.field_prefix + field, name) for field, name in fields]
+        conversions = [(self.field_prefix + field, convert) for field, convert in conversions]
+        translation = ColumbiaMicroServerTranslation(fields, us_units, conversions)
+        field_map.translations[(pkt_type, base_units)] = translation
+        return translation
 
     def _calculate_rain_delta(self, packet):
         """Convert from rain total to rain delta."""
-        packet['rain'] = weewx.wxformulas.calculate_rain(packet['rainTotal'], self.last_rain_total)
-        self.last_rain_total = packet['rainTotal']
-
-class ColumbiaMicroServerStation(object):
-    # Map is used when parsing the MicroServer XML to determine if an input 
-    # element should be passed back or not, and if so, what packet group it
-    # belongs to. Each group can have it's own unit type as the MicroServer
-    # supports configuring each group with different units.
-    XML_INPUT_ELEMENTS = {
-        'mtWindSpeed': 'wind',
-        'mtAdjWindDir': 'wind',
-        'mt2MinWindGustSpeed': 'wind',
-        'mt2MinWindGustDir': 'wind',
-
-        'mtTemp1': 'temp',
-        'mtWindChill': 'temp',
-        'mtDewPoint': 'temp',
-        'mtHeatIndex': 'temp',
-        'mtTemp_2': 'temp',
-        'mtTemp_3': 'temp',
-        'mtTemp_4': 'temp',
-
-        'mtRainThisMonth': 'rain',
-        'mtRainRate': 'rain',
-
-        'mtAdjBaromPress': 'pressure',
-
-        'mtRelHumidity': 'generic',
-        'mtSolarRadiaton': 'generic',
-    }
+        rain_total = packet[self.field_prefix + 'rainTotal']
+        packet[self.field_prefix + 'rain'] = weewx.wxformulas.calculate_rain(rain_total, self.last_rain_total)
+        self.last_rain_total = rain_total
+
 
-    # List of input fields that should be used to determine which field should
-    # be used to return the unit type for the associated packet group.
-    XML_INPUT_UNIT_ELEMENTS = [
-        'mtWindSpeed','mtTemp1','mtRainRate','mtRelHumidity','mtAdjBaromPress'
-    ]
+class ColumbiaMicroServerFieldMap(object):
+    """The elements read from the XML of one station and the fields they
+    are returned as.
+
+    The input elements and their packet groups are compiled into the lookup
+    tables of the parsers when the map is built. Translations to loop
+    packets are added as each packet group and units are first seen."""
+
+    def __init__(self, stn_dict, field_prefix=''):
+        self.sensor_map = dict(ColumbiaMicroServerDriver.DEFAULT_SENSOR_MAP)
+        self.sensor_map.update(stn_dict.get('sensor_map', {}))
+        self.input_elements, self.unit_elements = get_input_elements(stn_dict)
+        unknown = sorted(name for name in self.sensor_map.values() if name not in self.input_elements)
+        if unknown:
+            logerr("sensor_map elements not in input_elements are not returned: %s" % unknown)
+        # Output field names including the rain field calculated from rainTotal
+        self.fields = set(field_prefix + field for field in self.sensor_map)
+        self.fields.add(field_prefix + 'rain')
+        self.parser = ColumbiaMicroServerParser(self.input_elements, self.unit_elements,
+                                                self.sensor_map.values())
+        # Parser for the polls that only return wind packets
+        self.wind_parser = ColumbiaMicroServerParser(
+            self.input_elements, self.unit_elements,
+            [name for name in self.sensor_map.values() if self.input_elements.get(name) == 'wind'])
+        # Translations from packet groups to loop packets keyed by packet
+        # group and units.
+        self.translations = dict()
+
+    def same_as(self, other):
+        return (self.sensor_map == other.sensor_map and self.input_elements == other.input_elements and
+                self.unit_elements == other.unit_elements)
+
+
+class ColumbiaMicroServerShare(object):
+    """The latest packet groups of each station in a local file for other
+    programs to read instead of polling the MicroServer.
+
+    The file is written in full to a temporary file that is then renamed over
+    the old one so readers never see a partly written file. seq counts the
+    polls published so a reader can tell when there is new data. Polls that
+    only parse the wind update the wind group and keep the other groups from
+    the last full poll. They are only written once min_interval seconds
+    have passed since the last write, so fast polling doesn't rewrite the
+    file many times a second."""
+
+    def __init__(self, path, min_interval=1.0):
+        self.path = path
+        self.min_interval = min_interval
+        self.seq = 0
+        self.stations = dict()
+        self.failed = False
+        # Fetch time of the poll last written
+        self.write_time = None
+
+    def publish(self, results, fetch_time=None):
+        """Write the packet groups from a poll."""
+        if fetch_time is None:
+            fetch_time = time.time()
+        for source, pkt_grp, _ in results:
+            station = self.stations.setdefault(source.name, {'pkt_grp': dict()})
+            station['pkt_grp'].update(pkt_grp)
+            station['time'] = fetch_time
+            station['sample_time'] = source.last_sample_time
+            # The rain total before this poll so readers can work out the rain
+            station['last_rain_total'] = source.last_rain_total
+        self.seq += 1
+        wind_only = all(list(pkt_grp) == ['wind'] for _, pkt_grp, _ in results)
+        if wind_only and self.write_time is not None and fetch_time - self.write_time < self.min_interval:
+            return
+        self.write_time = fetch_time
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'seq': self.seq, 'time': fetch_time, 'pid': os.getpid(),
+                           'stations': self.stations}, f)
+            # Renaming is atomic on POSIX, replacing the old file
+            os.rename(tmp_path, self.path)
+            self.failed = False
+        except (IOError, OSError) as e:
+            # Only log the first of a run of failures
+            if not self.failed:
+                logerr("publish: %s: %s" % (self.path, e))
+            self.failed = True
+
+    def close(self):
+        """Remove the file so readers don't use data that is no longer
+        being updated."""
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
 
     @staticmethod
-    def get_data(url):
+    def read(path, max_age=None):
+        """Return the shared data or None if there isn't any or it is more
+        than max_age seconds old."""
+        try:
+            with open(path) as f:
+                shared = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            logdbg("read: %s: %s" % (path, e))
+            return None
+        if max_age is not None and time.time() - shared.get('time', 0) > max_age:
+            logdbg("read: %s: data is older than %s seconds" % (path, max_age))
+            return None
+        return shared
+
+
+class ColumbiaMicroServerBreaker(object):
+    """Circuit breaker deciding when to poll a failing MicroServer.
+
+    While closed, every poll is made. After more than threshold failures in
+    a row the breaker opens and polls are skipped for a backoff that doubles
+    with each further failure up to max_delay, with a random part so that
+    stations don't retry in step. Once the backoff has passed the breaker is
+    half-open and one poll is allowed: success closes it again and failure
+    reopens it with a longer backoff. Only the start and end of an outage
+    are logged at error and info level."""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, threshold, base_delay, max_delay):
+        self.name = name
+        self.threshold = threshold
+        self.base_delay = base_delay
+        self.max_delay = max(max_delay, base_delay)
+        self.state = self.CLOSED
+        self.failures = 0
+        self.retry_at = 0.0
+        self.outage_start = None
+
+    def allow(self):
+        """Return True if the MicroServer should be polled now."""
+        if self.state == self.OPEN:
+            if monotonic_time() < self.retry_at:
+                return False
+            self.state = self.HALF_OPEN
+        return True
+
+    def success(self):
+        if self.outage_start is not None:
+            loginf("%s: responding again after an outage of %.0f seconds and %d failed polls" %
+                   (self.name, time.time() - self.outage_start, self.failures))
+        self.state = self.CLOSED
+        self.failures = 0
+        self.outage_start = None
+
+    def failure(self, error):
+        self.failures += 1
+        if self.outage_start is None:
+            self.outage_start = time.time()
+        if self.state == self.CLOSED and self.failures <= self.threshold:
+            logerr("%s: failed attempt %d of %d: %s" % (self.name, self.failures, self.threshold, error))
+            return
+        delay = self.backoff()
+        if self.state == self.CLOSED:
+            logerr("%s: not responding, backing off for up to %.0f seconds between polls: %s" %
+                   (self.name, self.max_delay, error))
+        else:
+            logdbg("%s: still not responding, next poll in %.1f seconds: %s" % (self.name, delay, error))
+        self.state = self.OPEN
+        self.retry_at = monotonic_time() + delay
+
+    def backoff(self):
+        """Return the delay before the next poll, doubling with each failure
+        past the threshold and randomized between half and all of that."""
+        exponent = min(self.failures - self.threshold - 1, 30)
+        delay = min(self.max_delay, self.base_delay * 2 ** exponent)
+        return delay * random.uniform(0.5, 1.0)
+
+
+class ColumbiaMicroServerScheduler(object):
+    """Schedule polls at fixed deadlines within each minute.
+
+    Deadlines are poll_interval seconds apart and counted back from the last
+    poll of each minute, which is poll_lead_seconds before the top of the
+    minute, so the interval need not divide the minute evenly. Each wait is a
+    single sleep measured on the monotonic clock. If the next deadline has
+    already passed, for example because a fetch was slow, the poll runs
+    immediately. When several deadlines have passed they are collapsed into
+    one poll which counts as the last poll of the minute if any of the missed
+    deadlines was, so the once-a-minute packets are never skipped."""
+
+    def __init__(self, poll_interval, poll_lead_seconds):
+        self.poll_interval = float(poll_interval)
+        self.poll_lead_seconds = float(poll_lead_seconds)
+        # Number of deadlines that fit in each minute
+        self.polls_per_minute = int(math.ceil(60.0 / self.poll_interval - 1e-9))
+        self.deadline = None
+        # How late the most recent poll started and how many deadlines were
+        # skipped to get there.
+        self.lateness = 0.0
+        self.missed = 0
+
+    def wait(self, ahead=0.0):
+        """Sleep until the next deadline, or ahead seconds before it. Returns
+        True if the deadline is the last one in the minute."""
+        # Waking early is the same as the clock being ahead
+        now = time.time() + ahead
+        if self.deadline is None:
+            deadline, is_last = self.next_deadline(now)
+        else:
+            deadline, is_last = self.next_deadline(self.deadline)
+        self.missed = 0
+        if deadline <= now:
+            if now - deadline > 60.0:
+                # A whole minute went by so its last poll was missed too.
+                self.missed += int((now - deadline) / self.poll_interval)
+                deadline, is_last = self.next_deadline(now - 60.0)
+                is_last = True
+            while True:
+                following, following_is_last = self.next_deadline(deadline)
+                if following > now:
+                    break
+                self.missed += 1
+                deadline = following
+                is_last = is_last or following_is_last
+        # Convert the wall clock deadline to the monotonic clock so the sleep
+        # is not thrown off if the system time is stepped meanwhile.
+        target = monotonic_time() + (deadline - now)
+        remaining = target - monotonic_time()
+        while remaining > 0:
+            # Python 2 can return early from sleep if interrupted
+            time.sleep(remaining)
+            remaining = target - monotonic_time()
+        self.lateness = -remaining
+        self.deadline = deadline
+        return is_last
+
+    def next_deadline(self, after):
+        """Return the first deadline later than the time after together with
+        a flag that is True when it is the last deadline of its minute."""
+        last = (math.floor((after + self.poll_lead_seconds) / 60.0) + 1) * 60.0 - self.poll_lead_seconds
+        k = min(int(math.ceil((last - after) / self.poll_interval)) - 1, self.polls_per_minute - 1)
+        # When after is itself a deadline, rounding errors can give back the
+        # same deadline so move on to the following one.
+        if k > 0 and last - k * self.poll_interval <= after + 1e-6:
+            k -= 1
+        return last - k * self.poll_interval, k == 0
+
+
+class ColumbiaMicroServerSession(object):
+    """Persistent HTTP/1.1 connection to the MicroServer.
+
+    The MicroServer is slow to accept new connections so a single connection
+    is opened and reused for every poll. If the MicroServer has dropped the
+    connection since the last poll, the request is retried once on a new
+    connection. The time spent connecting and transferring data for the most
+    recent request is kept in connect_time and transfer_time with connect_time
+    being zero when an existing connection was reused.
+
+    Requests are conditional on the ETag and Last-Modified headers of the
+    last response so a MicroServer that supports them need not send data
+    that hasn't changed."""
+
+    def __init__(self, url, timeout=4):
+        self.url = url
+        self.timeout = timeout
+        parts = urlsplit(url)
+        if parts.scheme == 'http':
+            self.host = parts.hostname
+            self.port = parts.port or 80
+            self.path = parts.path or '/'
+            if parts.query:
+                self.path += '?' + parts.query
+        else:
+            # Anything other than plain http, such as a file URL, is handed
+            # off to urllib one request at a time.
+            self.host = None
+        self.headers = {
+            'User-Agent': 'WeeWX/%s' % weewx.__version__,
+            'Connection': 'keep-alive',
+        }
+        self.connection = None
+        self.connect_time = 0.0
+        self.transfer_time = 0.0
+        self.connects = 0
+        self.requests = 0
+        self.not_modified = 0
+        # Validators from the last response
+        self.etag = None
+        self.last_modified = None
+
+    def get_data(self):
+        """Return the content of the URL, reusing the open connection if
+        there is one. Returns None if it hasn't changed since the last
+        request."""
+        if self.host is None:
+            return ColumbiaMicroServerStation.get_data(self.url)
+        self.connect_time = 0.0
+        self.transfer_time = 0.0
+        while True:
+            reused = self.connection is not None
+            try:
+                if not reused:
+                    self._connect()
+                return self._request()
+            except (HTTPException, socket.error, socket.timeout) as e:
+                self.close()
+                # A kept-alive connection that the MicroServer has since
+                # closed fails on first use so try again on a new one. A
+                # timeout means the MicroServer is slow, not that the
+                # connection went stale, so don't wait a second time.
+                if reused and not isinstance(e, socket.timeout):
+                    logdbg("get_data(): reconnecting after stale connection: %s" % e)
+                    continue
+                # Failed polls are logged by the breaker
+                logdbg("get_data(): Socket error or timeout for weather station %s or %s" % (self.url, e))
+                raise weewx.WeeWxIOError("get_data(): Socket error or timeout for weather station %s or %s" % (self.url, e))
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def clear_validators(self):
+        """Make the next request unconditional."""
+        self.etag = None
+        self.last_modified = None
+
+    def probe(self):
+        """Return True if a TCP connection can be opened to the MicroServer.
+        This is much quicker to fail than an HTTP request when the
+        MicroServer is down."""
+        if self.host is None:
+            return True
         try:
-            request = Request(url)
-            request.add_header('User-Agent', 'WeeWX/%s' % weewx.__version__)
-            response = urlopen(request, timeout=4)
-        except URLError as e:
-            logerr("get_data(): Unable to open weather station %s or %s" % (url, e))
-            raise weewx.WeeWxIOError("get_data(): Socket error or timeout for weather station %s or %s" % (url, e))
+            sock = socket.create_connection((self.host, self.port), min(self.timeout, 1.0))
+            sock.close()
+            return True
         except (socket.error, socket.timeout) as e:
-            logerr("get_data(): Socket error or timeout for weather station %s or %s" % (url, e))
-            raise weewx.WeeWxIOError("get_data(): Socket error or timeout for weather station %s or %s" % (url, e))
-        if response.getcode() != 200:
-            raise weewx.WeeWxIOError("get_data(): Bad response code returned: %d." % response.code)
-        content_length = int(response.info().get('Content-Length'))
-        return response.read(content_length).decode('utf-8')
+            logdbg("probe(): %s:%s: %s" % (self.host, self.port, e))
+            return False
+
+    def _connect(self):
+        start = monotonic_time()
+        self.connection = HTTPConnection(self.host, self.port, timeout=self.timeout)
+        self.connection.connect()
+        self.connect_time = monotonic_time() - start
+        self.connects += 1
+
+    def _request(self):
+        headers = self.headers
+        if self.etag is not None or self.last_modified is not None:
+            headers = dict(self.headers)
+            if self.etag is not None:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified is not None:
+                headers['If-Modified-Since'] = self.last_modified
+        start = monotonic_time()
+        self.connection.request('GET', self.path, headers=headers)
+        response = self.connection.getresponse()
+        data = response.read()
+        self.transfer_time = monotonic_time() - start
+        self.requests += 1
+        if response.will_close:
+            self.close()
+        if response.status == 304:
+            self.not_modified += 1
+            return None
+        if response.status != 200:
+            raise weewx.WeeWxIOError("get_data(): Bad response code returned: %d." % response.status)
+        self.etag = response.getheader('ETag')
+        self.last_modified = response.getheader('Last-Modified')
+        return data.decode('utf-8')
+
+
+class ColumbiaMicroServerStats(object):
+    """Timings of the most recent polls of each station.
+
+    Each metric of each station is kept in a ring of the last size values so
+    the memory used is fixed and recording a value is a single append. The
+    rings are summarized as the median, 95th percentile and maximum. When
+    polling from the prefetch thread, the queue depth and age of each poll
+    taken from the queue are kept the same way along with the number of
+    polls dropped."""
+
+    # Metrics kept with the format used to log them and their Prometheus
+    # name and help text.
+    METRICS = (
+        ('connect', '%.3fs', 'connect_seconds', 'Time to look up and connect to the MicroServer'),
+        ('transfer', '%.3fs', 'transfer_seconds', 'Time to request and read the XML'),
+        ('bytes', '%d', 'bytes', 'Size of the XML'),
+        ('parse', '%.4fs', 'parse_seconds', 'Time to parse the XML'),
+        ('translate', '%.4fs', 'translate_seconds', 'Time to translate packet groups to loop packets'),
+        ('lateness', '%.3fs', 'lateness_seconds', 'Time the poll started after its deadline'),
+        ('retries', '%d', 'retries', 'Failed polls in a row before this one'),
+    )
+
+    # Metrics of the prefetch queue, kept for each poll taken from it
+    PREFETCH_METRICS = (
+        ('depth', '%d', 'depth', 'Polls left in the prefetch queue'),
+        ('staleness', '%.3fs', 'staleness_seconds', 'Age of the poll data taken from the prefetch queue'),
+    )
+
+    # Reasons polls are dropped from the prefetch queue
+    PREFETCH_DROPS = ('full', 'stale')
+
+    QUANTILES = (0.5, 0.95)
+
+    def __init__(self, size=240, interval=300):
+        self.size = size
+        self.interval = interval
+        # Rings of values keyed by station then metric
+        self.rings = dict()
+        # Total polls and failed polls of each station
+        self.polls = dict()
+        self.errors = dict()
+        # Only kept when polling from the prefetch thread
+        self.prefetch_rings = None
+        self.prefetch_dropped = dict((reason, 0) for reason in self.PREFETCH_DROPS)
+        self.lock = threading.Lock()
+        self.next_summary = monotonic_time() + interval
+
+    def record(self, name, metric, value):
+        with self.lock:
+            if name not in self.rings:
+                self.rings[name] = dict((metric, collections.deque(maxlen=self.size))
+                                        for metric, _, _, _ in self.METRICS)
+                self.polls[name] = 0
+                self.errors[name] = 0
+            self.rings[name][metric].append(value)
+
+    def record_poll(self, source, lateness):
+        """Record the timings of the latest poll of source."""
+        self.record(source.name, 'lateness', lateness)
+        self.record(source.name, 'retries', source.ntries)
+        self.record(source.name, 'connect', source.session.connect_time)
+        self.record(source.name, 'transfer', source.session.transfer_time)
+        with self.lock:
+            self.polls[source.name] += 1
+            if source.error is not None:
+                self.errors[source.name] += 1
+        if source.error is None:
+            self.record(source.name, 'bytes', source.bytes)
+            if source.new_sample:
+                self.record(source.name, 'parse', source.parse_time)
+
+    def record_prefetch(self, depth, staleness, dropped_full, dropped_stale):
+        """Record the queue depth and age of a poll taken from the prefetch
+        queue together with the polls dropped so far."""
+        with self.lock:
+            if self.prefetch_rings is None:
+                self.prefetch_rings = dict((metric, collections.deque(maxlen=self.size))
+                                           for metric, _, _, _ in self.PREFETCH_METRICS)
+            self.prefetch_rings['depth'].append(depth)
+            self.prefetch_rings['staleness'].append(staleness)
+            self.prefetch_dropped['full'] = dropped_full
+            self.prefetch_dropped['stale'] = dropped_stale
+
+    def summary_due(self):
+        """Return True once every interval seconds."""
+        now = monotonic_time()
+        if now < self.next_summary:
+            return False
+        self.next_summary = now + self.interval
+        return True
+
+    def _summarize_rings(self, rings):
+        """Return the median, 95th percentile and maximum of each ring that
+        has values."""
+        metrics = dict()
+        for metric, ring in rings.items():
+            if ring:
+                values = sorted(ring)
+                metrics[metric] = [percentile(values, q) for q in self.QUANTILES] + [values[-1]]
+        return metrics
+
+    def summarize(self):
+        """Return a dictionary keyed by station of the number of polls and
+        errors and the median, 95th percentile and maximum of each metric."""
+        results = dict()
+        with self.lock:
+            for name, rings in self.rings.items():
+                results[name] = (self.polls[name], self.errors[name], self._summarize_rings(rings))
+        return results
+
+    def summarize_prefetch(self):
+        """Return the median, 95th percentile and maximum of the prefetch
+        metrics with the polls dropped for each reason, or None if nothing
+        has been taken from the prefetch queue."""
+        with self.lock:
+            if self.prefetch_rings is None:
+                return None
+            return self._summarize_rings(self.prefetch_rings), dict(self.prefetch_dropped)
+
+    @staticmethod
+    def _summary_parts(metric_formats, metrics):
+        parts = []
+        for metric, fmt, _, _ in metric_formats:
+            if metric in metrics:
+                parts.append(("%s p50 " + fmt + " p95 " + fmt + " max " + fmt) %
+                             tuple([metric] + metrics[metric]))
+        return parts
+
+    def summary(self):
+        """Return a line of text summarizing each station and the prefetch
+        queue."""
+        lines = []
+        for name, (polls, errors, metrics) in sorted(self.summarize().items()):
+            parts = ["%s: %d polls %d errors" % (name, polls, errors)]
+            parts.extend(self._summary_parts(self.METRICS, metrics))
+            lines.append('; '.join(parts))
+        prefetch = self.summarize_prefetch()
+        if prefetch is not None:
+            metrics, dropped = prefetch
+            parts = ["prefetch: dropped %d full %d stale" % (dropped['full'], dropped['stale'])]
+            parts.extend(self._summary_parts(self.PREFETCH_METRICS, metrics))
+            lines.append('; '.join(parts))
+        return lines
+
+    def prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        summary = sorted(self.summarize().items())
+        with self.lock:
+            totals = dict(((name, metric), (sum(ring), len(ring)))
+                          for name, rings in self.rings.items() for metric, ring in rings.items())
+        lines = []
+        for total, index in (('polls_total', 0), ('poll_errors_total', 1)):
+            lines.append('# TYPE %s_%s counter' % (DRIVER_SHORT_NAME, total))
+            for name, results in summary:
+                lines.append('%s_%s{station="%s"} %d' % (DRIVER_SHORT_NAME, total, name, results[index]))
+        # Each metric is a summary of the polls in the rings, with their sum
+        # and count, and a gauge of their maximum.
+        for metric, _, prom_name, help_text in self.METRICS:
+            prom_name = '%s_poll_%s' % (DRIVER_SHORT_NAME, prom_name)
+            stations = [(name, metrics[metric]) for name, (_, _, metrics) in summary if metric in metrics]
+            lines.append('# HELP %s %s over the last polls' % (prom_name, help_text))
+            lines.append('# TYPE %s summary' % prom_name)
+            for name, values in stations:
+                for q, value in zip(self.QUANTILES, values):
+                    lines.append('%s{station="%s",quantile="%s"} %s' % (prom_name, name, q, repr(float(value))))
+                total, count = totals[(name, metric)]
+                lines.append('%s_sum{station="%s"} %s' % (prom_name, name, repr(float(total))))
+                lines.append('%s_count{station="%s"} %d' % (prom_name, name, count))
+            lines.append('# HELP %s_max %s, the most over the last polls' % (prom_name, help_text))
+            lines.append('# TYPE %s_max gauge' % prom_name)
+            for name, values in stations:
+                lines.append('%s_max{station="%s"} %s' % (prom_name, name, repr(float(values[-1]))))
+        lines.extend(self._prometheus_prefetch())
+        return '\n'.join(lines) + '\n'
+
+    def _prometheus_prefetch(self):
+        """Return the lines of the prefetch metrics, which are summaries
+        like those of the stations but without the station label."""
+        prefetch = self.summarize_prefetch()
+        if prefetch is None:
+            return []
+        metrics, dropped = prefetch
+        with self.lock:
+            totals = dict((metric, (sum(ring), len(ring))) for metric, ring in self.prefetch_rings.items())
+        prom_name = '%s_prefetch_dropped_total' % DRIVER_SHORT_NAME
+        lines = ['# HELP %s Polls dropped from the prefetch queue because it was full or the data was too old'
+                 % prom_name,
+                 '# TYPE %s counter' % prom_name]
+        for reason in self.PREFETCH_DROPS:
+            lines.append('%s{reason="%s"} %d' % (prom_name, reason, dropped[reason]))
+        for metric, _, prom_name, help_text in self.PREFETCH_METRICS:
+            if metric not in metrics:
+                continue
+            prom_name = '%s_prefetch_%s' % (DRIVER_SHORT_NAME, prom_name)
+            values = metrics[metric]
+            lines.append('# HELP %s %s over the last polls' % (prom_name, help_text))
+            lines.append('# TYPE %s summary' % prom_name)
+            for q, value in zip(self.QUANTILES, values):
+                lines.append('%s{quantile="%s"} %s' % (prom_name, q, repr(float(value))))
+            total, count = totals[metric]
+            lines.append('%s_sum %s' % (prom_name, repr(float(total))))
+            lines.append('%s_count %d' % (prom_name, count))
+            lines.append('# HELP %s_max %s, the most over the last polls' % (prom_name, help_text))
+            lines.append('# TYPE %s_max gauge' % prom_name)
+            lines.append('%s_max %s' % (prom_name, repr(float(values[-1]))))
+        return lines
+
+    def write_metrics(self, path):
+        """Write the Prometheus metrics to path, replacing it in one step
+        so a reader never sees a partial file."""
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(self.prometheus())
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            logerr("write_metrics(): unable to write %s: %s" % (path, e))
+
+
+class ColumbiaMicroServerMetricsHandler(BaseHTTPRequestHandler):
+    """Serve the poll stats at /metrics."""
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        data = self.server.stats.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logdbg("metrics: %s" % (format % args))
+
+
+class ColumbiaMicroServerMetricsServer(object):
+    """Local HTTP server for the poll stats run in a background thread."""
+
+    def __init__(self, address, port, stats):
+        self.server = HTTPServer((address, port), ColumbiaMicroServerMetricsHandler)
+        self.server.stats = stats
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='%s-metrics' % DRIVER_SHORT_NAME)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ColumbiaMicroServerLogDownloader(object):
+    """Download the daily CSV log files from the MicroServer.
+
+    The list of available files is scraped from the admin Data Logs page,
+    /admin/logfiles.php, which requires the admin user and password. Files
+    are downloaded into log_dir by a small pool of worker threads since the
+    MicroServer is slow to serve each file. A manifest in log_dir records
+    the size and modification time of every completed file so it is not
+    downloaded again unless the file on disk changes. An interrupted
+    download is left as a .part file and resumed with a range request the
+    next time. The file for today is still being written by the MicroServer
+    so it is skipped unless asked for."""
+
+    LOGS_PATH = '/admin/logfiles.php'
+    MANIFEST = 'manifest.json'
+    # Links to the CSV log files on the Data Logs page
+    LINK_RE = re.compile(r"""href=["']?([^"' >]+\.csv)""", re.IGNORECASE)
+    # Date in a log file name, either as YYYYMMDD or with separators
+    DATE_RE = re.compile(r'(\d{4})[-_]?(\d{2})[-_]?(\d{2})')
+
+    def __init__(self, host, port=80, log_dir='.', user='admin', password=None, workers=2, timeout=30):
+        self.base_url = "http://%s:%s" % (host, port)
+        self.log_dir = log_dir
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        self.user = user
+        self.password = password
+        self.workers = max(1, int(workers))
+        self.timeout = timeout
+        self.manifest_lock = threading.Lock()
+        self.manifest = self._load_manifest()
+
+    def _open(self, url, headers=None):
+        """Open a URL on the MicroServer, authenticating if needed. A new
+        opener is built each time since openers keep authentication state
+        and are not shared between threads."""
+        password_mgr = HTTPPasswordMgrWithDefaultRealm()
+        password_mgr.add_password(None, self.base_url, self.user, self.password)
+        opener = build_opener(HTTPBasicAuthHandler(password_mgr), HTTPDigestAuthHandler(password_mgr))
+        request = Request(url)
+        request.add_header('User-Agent', 'WeeWX/%s' % weewx.__version__)
+        for name, value in (headers or {}).items():
+            request.add_header(name, value)
+        return opener.open(request, timeout=self.timeout)
+
+    def list_logs(self):
+        """Return a sorted list of (date, filename, url) for each log file on
+        the Data Logs page."""
+        url = urljoin(self.base_url, ColumbiaMicroServerLogDownloader.LOGS_PATH)
+        try:
+            page = self._open(url).read().decode('utf-8', 'replace')
+        except (URLError, socket.error, socket.timeout) as e:
+            raise weewx.WeeWxIOError("list_logs(): Unable to read %s: %s" % (url, e))
+        logs = dict()
+        for link in ColumbiaMicroServerLogDownloader.LINK_RE.findall(page):
+            filename = link.split('/')[-1]
+            log_date = ColumbiaMicroServerLogDownloader.log_date(filename)
+            if log_date is None:
+                logdbg("list_logs(): no date in log file name %s" % filename)
+                continue
+            logs[filename] = (log_date, filename, urljoin(url, link))
+        return sorted(logs.values())
+
+    @staticmethod
+    def log_date(filename):
+        """Return the date of a log file from its name or None."""
+        match = ColumbiaMicroServerLogDownloader.DATE_RE.search(filename)
+        if match is None:
+            return None
+        try:
+            return datetime.date(*[int(x) for x in match.groups()])
+        except ValueError:
+            return None
+
+    def download(self, start_date=None, end_date=None, include_today=False):
+        """Download the log files dated from start_date through end_date.
+        Returns a tuple of the number of files downloaded, skipped because
+        they were already downloaded and failed."""
+        today = datetime.date.today()
+        pending = queue.Queue()
+        skipped = 0
+        for log_date, filename, url in self.list_logs():
+            if start_date is not None and log_date < start_date:
+                continue
+            if end_date is not None and log_date > end_date:
+                continue
+            if log_date >= today and not include_today:
+                continue
+            if log_date < today and self._is_downloaded(filename):
+                skipped += 1
+                continue
+            pending.put((filename, url))
+        counts = {'downloaded': 0, 'failed': 0}
+        counts_lock = threading.Lock()
+
+        def worker():
+            while True:
+                try:
+                    filename, url = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    self._download_file(filename, url)
+                    result = 'downloaded'
+                except weewx.WeeWxIOError as e:
+                    logerr("download(): %s" % e)
+                    result = 'failed'
+                with counts_lock:
+                    counts[result] += 1
+
+        threads = [threading.Thread(target=worker) for _ in range(min(self.workers, pending.qsize()))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        loginf("download(): %d downloaded, %d already downloaded, %d failed" %
+               (counts['downloaded'], skipped, counts['failed']))
+        return counts['downloaded'], skipped, counts['failed']
+
+    def _is_downloaded(self, filename):
+        """True if the file is in the manifest and unchanged on disk."""
+        with self.manifest_lock:
+            entry = self.manifest.get(filename)
+        if entry is None:
+            return False
+        path = os.path.join(self.log_dir, filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return stat.st_size == entry['size'] and abs(stat.st_mtime - entry['mtime']) < 1
+
+    def _download_file(self, filename, url):
+        """Download one file, resuming from a partial download if there is
+        one, and record it in the manifest."""
+        path = os.path.join(self.log_dir, filename)
+        part_path = path + '.part'
+        # Today's file only grows so just fetch what was added since it was
+        # last downloaded.
+        log_date = ColumbiaMicroServerLogDownloader.log_date(filename)
+        growing = log_date is not None and log_date >= datetime.date.today()
+        if growing and os.path.exists(path) and not os.path.exists(part_path):
+            os.rename(path, part_path)
+        headers = dict()
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+        try:
+            response = self._open(url, headers)
+            # A server that ignores the range request sends the whole file
+            mode = 'ab' if offset and response.getcode() == 206 else 'wb'
+            received = 0
+            with open(part_path, mode) as f:
+                while True:
+                    chunk = response.read(65536)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    received += len(chunk)
+            # Reading in chunks doesn't notice the connection being closed
+            # before the end of the file.
+            length = response.info().get('Content-Length')
+            if length is not None and length.isdigit() and received < int(length):
+                raise weewx.WeeWxIOError("Unable to download %s: connection closed after %d of %s bytes" %
+                                         (url, received, length))
+        except HTTPError as e:
+            if e.code == 416 and growing:
+                # Nothing has been added to today's file
+                os.rename(part_path, path)
+                return
+            # The partial file can't be resumed so start over next time
+            if e.code == 416:
+                os.remove(part_path)
+            raise weewx.WeeWxIOError("Unable to download %s: %s" % (url, e))
+        except (URLError, HTTPException, socket.error, socket.timeout) as e:
+            # What was read so far is kept in the partial file to resume
+            raise weewx.WeeWxIOError("Unable to download %s: %s" % (url, e))
+        os.rename(part_path, path)
+        # Keep the time the MicroServer last changed the file, which is
+        # checked with the size to tell whether the file has changed since.
+        last_modified = response.info().get('Last-Modified')
+        if last_modified:
+            try:
+                mtime = calendar.timegm(time.strptime(last_modified, '%a, %d %b %Y %H:%M:%S GMT'))
+                os.utime(path, (mtime, mtime))
+            except (ValueError, OverflowError):
+                pass
+        entry = {
+            'size': os.path.getsize(path),
+            'mtime': os.path.getmtime(path),
+        }
+        logdbg("_download_file(): downloaded %s%s" % (filename, ' (resumed)' if mode == 'ab' else ''))
+        # Today's file is still growing so it is downloaded again next time
+        if growing:
+            return
+        with self.manifest_lock:
+            self.manifest[filename] = entry
+            self._save_manifest()
+
+    def _load_manifest(self):
+        path = os.path.join(self.log_dir, ColumbiaMicroServerLogDownloader.MANIFEST)
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return dict()
+
+    def _save_manifest(self):
+        """Write the manifest, replacing the old one only once the new one
+        is complete."""
+        path = os.path.join(self.log_dir, ColumbiaMicroServerLogDownloader.MANIFEST)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.rename(path + '.tmp', path)
+
+
+class ColumbiaMicroServerLogImporter(object):
+    """Import the daily CSV log files into the WeeWX archive.
+
+    The columns are mapped to WeeWX fields using the same sensor map as the
+    driver, so the first row of each file is expected to hold the MicroServer
+    measurement names. Since the log files don't say what units they are in,
+    the units of each packet group are taken from log_units which uses the
+    same unit names as the MicroServer XML. Each file is read and converted a
+    column at a time then inserted in batches of records per transaction
+    without updating the daily summaries, which are rebuilt once for the
+    whole date range at the end."""
+
+    # Units of each packet group in the log files if not configured
+    DEFAULT_LOG_UNITS = {
+        'wind': 'mph',
+        'temp': 'degreeF',
+        'rain': 'inchesRain',
+        'pressure': 'inchesHg',
+        'generic': 'generic',
+    }
+
+    def __init__(self, config_dict, log_dir, stn_dict=None, binding='wx_binding'):
+        stn_dict = stn_dict or dict()
+        self.config_dict = config_dict
+        self.log_dir = log_dir
+        self.binding = binding
+        self.sensor_map = dict(ColumbiaMicroServerDriver.DEFAULT_SENSOR_MAP)
+        self.sensor_map.update(stn_dict.get('sensor_map', {}))
+        self.input_elements, _ = get_input_elements(stn_dict)
+        self.log_units = dict(ColumbiaMicroServerLogImporter.DEFAULT_LOG_UNITS)
+        self.log_units.update(stn_dict.get('log_units', {}))
+        self.time_column = stn_dict.get('log_time_column', 'mtSampTime')
+        self.time_format = stn_dict.get('log_time_format', ColumbiaMicroServerParser.SAMPLE_TIME_FORMAT)
+        # Minutes between records in the log files
+        self.interval = int(stn_dict.get('log_interval', 1))
+        self.batch_size = int(stn_dict.get('import_batch_size', 5000))
+        self.last_rain_total = None
+        # Convert whole columns at once if NumPy is installed. It is only
+        # imported here so the driver doesn't load it otherwise.
+        self.numpy = None
+        if weeutil.weeutil.to_bool(stn_dict.get('use_numpy', True)):
+            try:
+                import numpy
+                self.numpy = numpy
+            except ImportError:
+                logdbg("NumPy is not installed, converting log files without it")
+        self.use_numpy = self.numpy is not None
+        # Column conversions keyed by the header of a file and the unit
+        # system of the database.
+        self.plans = dict()
+        self.cache = None
+        if weeutil.weeutil.to_bool(stn_dict.get('log_cache', True)):
+            # Days read with other settings are read again
+            settings = {
+                'sensor_map': self.sensor_map,
+                'input_elements': self.input_elements,
+                'log_units': self.log_units,
+                'time_column': self.time_column,
+                'time_format': self.time_format,
+                'interval': self.interval,
+            }
+            self.cache = ColumbiaMicroServerDayCache(os.path.join(log_dir, 'cache'), settings)
+
+    def log_files(self, start_date=None, end_date=None):
+        """Return a sorted list of (date, path) of the log files in log_dir
+        dated from start_date through end_date."""
+        files = []
+        for filename in os.listdir(self.log_dir):
+            if not filename.lower().endswith('.csv'):
+                continue
+            log_date = ColumbiaMicroServerLogDownloader.log_date(filename)
+            if log_date is None:
+                continue
+            if start_date is not None and log_date < start_date:
+                continue
+            if end_date is not None and log_date > end_date:
+                continue
+            files.append((log_date, os.path.join(self.log_dir, filename)))
+        return sorted(files)
+
+    def import_logs(self, start_date=None, end_date=None):
+        """Import the log files in the date range. Returns the number of
+        records added."""
+        # Only importing needs the database modules
+        import weewx.manager
+        files = self.log_files(start_date, end_date)
+        if not files:
+            loginf("import_logs(): no log files found in %s" % self.log_dir)
+            return 0
+        added = 0
+        first_ts = last_ts = None
+        with weewx.manager.open_manager_with_config(self.config_dict, self.binding, initialize=True) as dbmanager:
+            sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+                dbmanager.table_name, ', '.join(dbmanager.sqlkeys), ', '.join('?' * len(dbmanager.sqlkeys)))
+            batch = []
+            # Times in the batch not yet inserted
+            batch_times = set()
+            for path, records in self.read_logs(start_date, end_date, dbmanager.std_unit_system):
+                if not records:
+                    continue
+                # Skip records already in the archive
+                existing = set(row[0] for row in dbmanager.genSql(
+                    "SELECT dateTime FROM %s WHERE dateTime >= ? AND dateTime <= ?" % dbmanager.table_name,
+                    (records[0]['dateTime'], records[-1]['dateTime'])))
+                for record in records:
+                    if record['dateTime'] in existing:
+                        continue
+                    if record['dateTime'] in batch_times:
+                        # Also in the file before, keep the first
+                        loginf("import_logs(): %s: dropped repeated time %s" %
+                               (path, weeutil.weeutil.timestamp_to_string(record['dateTime'])))
+                        continue
+                    batch.append(tuple(record.get(key) for key in dbmanager.sqlkeys))
+                    batch_times.add(record['dateTime'])
+                    existing.add(record['dateTime'])
+                    if first_ts is None or record['dateTime'] < first_ts:
+                        first_ts = record['dateTime']
+                    if last_ts is None or record['dateTime'] > last_ts:
+                        last_ts = record['dateTime']
+                    if len(batch) >= self.batch_size:
+                        added += self._insert(dbmanager, sql, batch)
+                        batch = []
+                        batch_times = set()
+                loginf("import_logs(): read %s" % path)
+            if batch:
+                added += self._insert(dbmanager, sql, batch)
+            if added and hasattr(dbmanager, 'backfill_day_summary'):
+                loginf("import_logs(): rebuilding daily summaries")
+                try:
+                    # WeeWX 4
+                    dbmanager.backfill_day_summary(
+                        start_d=datetime.date.fromtimestamp(first_ts),
+                        stop_d=datetime.date.fromtimestamp(last_ts))
+                except TypeError:
+                    # WeeWX 3
+                    dbmanager.backfill_day_summary(start_ts=first_ts, stop_ts=last_ts)
+        loginf("import_logs(): %d records added" % added)
+        return added
+
+    @staticmethod
+    def _insert(dbmanager, sql, batch):
+        """Insert a batch of rows in a single transaction."""
+        import weedb
+        with weedb.Transaction(dbmanager.connection) as cursor:
+            for row in batch:
+                cursor.execute(sql, row)
+        return len(batch)
+
+    def read_logs(self, start_date, end_date, us_units, start_ts=None, stop_ts=None):
+        """Generate the path and records in us_units of each log file dated
+        from start_date through end_date, limited to the records after
+        start_ts and up to stop_ts if given. Each file is parsed on its own,
+        so the rain for the first record of a file is calculated from the
+        last rain total of the file for the day before. After a missing day
+        the rain of the first record is unknown, as it is for the first
+        packet after the driver is restarted."""
+        last_rain_total = None
+        last_date = None
+        for log_date, path in self.log_files(start_date, end_date):
+            if last_date is None or log_date - last_date != datetime.timedelta(days=1):
+                last_rain_total = None
+            last_date = log_date
+            if self.cache is None:
+                records = self._read_log(path, us_units)
+                first_ts = records[0]['dateTime'] if records else None
+                records = [record for record in records
+                           if (start_ts is None or record['dateTime'] > start_ts) and
+                           (stop_ts is None or record['dateTime'] <= stop_ts)]
+                file_rain_total = self.last_rain_total
+            else:
+                records = self.cache.get(path, us_units, self._read_log, start_ts, stop_ts)
+                # There is no entry if the day couldn't be saved
+                entry = self.cache.entry(path, us_units) or {'first': None, 'last_rain_total': None}
+                first_ts = entry['first']
+                file_rain_total = entry['last_rain_total']
+            if records and records[0]['dateTime'] == first_ts and last_rain_total is not None and \
+                    records[0].get('rainTotal') is not None:
+                records[0]['rain'] = rain_deltas([records[0]['rainTotal']], last_rain_total)[0][0]
+            last_rain_total = file_rain_total
+            yield path, records
+
+    def _read_log(self, path, us_units):
+        """Read a log file on its own, without the rain total from the file
+        read before."""
+        self.last_rain_total = None
+        return self.read_log(path, us_units)
+
+    def read_log(self, path, us_units):
+        """Read a daily log file and return a list of records in the unit
+        system us_units, sorted by time."""
+        with open(path) as f:
+            rows = csv.reader(f)
+            try:
+                header = tuple(name.strip() for name in next(rows))
+            except StopIteration:
+                return []
+            # Transpose the rows into columns, ignoring short rows which may
+            # be left at the end of a file that was still being written.
+            columns = list(zip(*[row for row in rows if len(row) == len(header)]))
+        if not columns:
+            return []
+        plan = self._get_plan(header, us_units)
+        if plan is None:
+            logerr("read_log(): no %s column in %s" % (self.time_column, path))
+            return []
+        times = [self._parse_time(text) for text in columns[plan['time']]]
+        if self.use_numpy:
+            fields = self._convert_columns_numpy(columns, plan)
+        else:
+            fields = self._convert_columns(columns, plan)
+        records = []
+        for i, ts in enumerate(times):
+            if ts is None:
+                continue
+            record = {'dateTime': ts, 'usUnits': us_units, 'interval': self.interval}
+            for field, values in fields:
+                if values[i] is not None:
+                    record[field] = values[i]
+            records.append(record)
+        records.sort(key=lambda record: record['dateTime'])
+        return self._drop_repeated(path, records)
 
     @staticmethod
-    def parse_data(data):
-        """Parse the XML data which is a flat non-hierarchical record and return 
-        a two-level dictionary hierarchy where each key is the field group and 
-        associated with that, a dictionary with the fields and values associated 
-        with that group."""
-        import re
-        pkt_grp = dict()
-        # If closing tag is truncated or has excess junk like null bytes, 
-        # fix before parsing.
-        if data.startswith('<oriondata') and not data.endswith('</oriondata>'):
-            data = re.sub('</ori(ondata)?.*$','</oriondata>', data)
-            logerr("parse_data(): attempted to correct truncated data: %s" % data[-19:-1])
+    def _drop_repeated(path, records):
+        """Return the sorted records keeping only the first of any with the
+        same time, such as the hour repeated when daylight saving time ends,
+        as the archive can't hold both."""
+        kept = []
+        for record in records:
+            if kept and record['dateTime'] == kept[-1]['dateTime']:
+                loginf("read_log(): %s: dropped repeated time %s" %
+                       (path, weeutil.weeutil.timestamp_to_string(record['dateTime'])))
+                continue
+            kept.append(record)
+        return kept
+
+    def _convert_columns(self, columns, plan):
+        """Return a list of the field name and list of converted values for
+        each mapped column plus the rain calculated from the rain total."""
+        fields = []
+        for field, index, convert in plan['columns']:
+            values = [to_float(text) for text in columns[index]]
+            if convert is not None:
+                values = [None if value is None else convert(value) for value in values]
+            fields.append((field, values))
+            if field == 'rainTotal':
+                rain, self.last_rain_total = rain_deltas(values, self.last_rain_total)
+                fields.append(('rain', rain))
+        return fields
+
+    def _convert_columns_numpy(self, columns, plan):
+        """Same as _convert_columns but converting each column as a whole
+        using NumPy arrays with NaN for missing values."""
+        numpy = self.numpy
+        fields = []
+        for field, index, convert in plan['columns']:
+            try:
+                values = numpy.array(columns[index], dtype=float)
+            except ValueError:
+                # Some values are empty or not numbers
+                values = numpy.array([numpy.nan if value is None else value
+                                      for value in map(to_float, columns[index])])
+            if convert is not None:
+                values = convert_array(numpy, convert, values)
+            fields.append((field, array_to_list(numpy, values)))
+            if field == 'rainTotal':
+                rain, self.last_rain_total = rain_deltas_numpy(numpy, values, self.last_rain_total)
+                fields.append(('rain', array_to_list(numpy, rain)))
+        return fields
+
+    def _get_plan(self, header, us_units):
+        """Work out which column holds each field and how to convert it to
+        us_units. Returns None if there is no time column."""
+        key = (header, us_units)
+        if key in self.plans:
+            return self.plans[key]
+        if self.time_column not in header:
+            self.plans[key] = None
+            return None
+        columns = []
+        for field, name in self.sensor_map.items():
+            pkt_type = self.input_elements.get(name)
+            if name not in header or pkt_type is None:
+                continue
+            columns.append((field, header.index(name), self._get_conversion(field, pkt_type, us_units)))
+        self.plans[key] = {'time': header.index(self.time_column), 'columns': columns}
+        return self.plans[key]
+
+    def _get_conversion(self, field, pkt_type, us_units):
+        """Return a function converting field from the log units to us_units
+        or None if no conversion is needed."""
+        log_units = self.log_units.get(pkt_type)
+        convert = None
+        if log_units == 'knots':
+            from_units = weewx.US
+            if field in ColumbiaMicroServerDriver.KNOT_FIELDS:
+                convert = weewx.units.conversionDict['knot']['miles_per_hour']
+        elif log_units == 'generic':
+            from_units = weewx.US
+        else:
+            from_units = ColumbiaMicroServerDriver.UNITS_MAP[log_units]
+        from_unit, _ = weewx.units.getStandardUnitType(from_units, field)
+        to_unit, _ = weewx.units.getStandardUnitType(us_units, field)
+        if from_unit is None or from_unit == to_unit:
+            return convert
+        to_us_units = weewx.units.conversionDict[from_unit][to_unit]
+        if convert is None:
+            return to_us_units
+        return lambda value: to_us_units(convert(value))
+
+    def _parse_time(self, text):
+        """Return the timestamp for a local time in the log file."""
         try:
-            elements = ElementTree.fromstring(data)
-            if elements.tag == 'oriondata' and elements[0].tag == 'meas':
-                for child in elements:
-                    name = child.attrib['name']
-                    # Ensure the correct tag and attribute is one to be recorded
-                    if child.tag == 'meas' and name in ColumbiaMicroServerStation.XML_INPUT_ELEMENTS:
-                        # Get the associated packet group for this field
-                        pkt_type = ColumbiaMicroServerStation.XML_INPUT_ELEMENTS[name]
-                        # Initialize a new dictionary for a packet group
-                        if not pkt_type in pkt_grp:
-                            pkt_grp[pkt_type] = dict()
-                        # If the field is in the list to use for the unit type,
-                        # save the unit type as the field 'base_units'.
-                        if name in ColumbiaMicroServerStation.XML_INPUT_UNIT_ELEMENTS:
-                            # If the packet type is 'generic' then it's a unit type that's
-                            # neither US or metric such as degrees for wind direction.
-                            if pkt_type == 'generic':
-                                pkt_grp[pkt_type]['base_units'] = 'generic'
-                            else:  
-                                pkt_grp[pkt_type]['base_units'] = child.attrib['unit']
-                        # Store the field and value in the dictionary for the associated packet type.
-                        pkt_grp[pkt_type][name] = float(child.text)
+            if self.time_format == ColumbiaMicroServerParser.SAMPLE_TIME_FORMAT:
+                # Much quicker than strptime for the usual format
+                time_tuple = (int(text[0:4]), int(text[5:7]), int(text[8:10]),
+                              int(text[11:13]), int(text[14:16]), int(text[17:19]), 0, 0, -1)
             else:
-                raise ElementTree.ParseError("invalid XML file. Missing <oriondata> and/or <meas/> tags detected.")
-        except ElementTree.ParseError as e:
-            logerr("ElementTree ParseError: %s for data: %s" % (e, data))
-            raise weewx.WeeWxIOError(e)
-        return pkt_grp
+                time_tuple = time.strptime(text.strip(), self.time_format)[:8] + (-1,)
+            return int(time.mktime(time_tuple))
+        except (ValueError, OverflowError):
+            return None
+
+
+class ColumbiaMicroServerCatchup(object):
+    """Archive records made from the MicroServer log files.
+
+    The log files from the day of the last archive record through today are
+    downloaded, then the one minute log records after the last archive
+    record are averaged over each archive interval with a WeeWX accumulator.
+    The interval still in progress is left for the loop packets. Parsed
+    records are kept in the importer's ColumbiaMicroServerDayCache so a
+    file that hasn't changed since the last catch-up is not parsed again."""
+
+    def __init__(self, stn_dict, archive_interval):
+        self.log_dir = stn_dict['log_dir']
+        self.archive_interval = archive_interval
+        self.max_days = int(stn_dict.get('catchup_days', 7))
+        self.downloader = ColumbiaMicroServerLogDownloader(
+            stn_dict.get('host', '192.168.0.50'),
+            int(stn_dict.get('port', 80)),
+            self.log_dir,
+            stn_dict.get('admin_user', 'admin'),
+            stn_dict.get('admin_password'),
+            int(stn_dict.get('log_workers', 2)))
+        self.importer = ColumbiaMicroServerLogImporter(None, self.log_dir, stn_dict)
+
+    def gen_records(self, since_ts, now=None):
+        now = now or time.time()
+        today = datetime.date.fromtimestamp(now)
+        start_date = today - datetime.timedelta(days=self.max_days - 1)
+        if since_ts is not None:
+            start_date = max(start_date, datetime.date.fromtimestamp(since_ts))
+        try:
+            self.downloader.download(start_date, today, include_today=True)
+        except weewx.WeeWxIOError as e:
+            # Catch up from whatever was downloaded before
+            logerr("catch-up: unable to download log files: %s" % e)
+        # Only the records in intervals after since_ts are needed
+        start_ts = None
+        if since_ts is not None:
+            start_ts = since_ts // self.archive_interval * self.archive_interval
+        records = []
+        for path, day_records in self.importer.read_logs(start_date, today, weewx.US, start_ts):
+            records.extend(day_records)
+        count = 0
+        for record in self.aggregate(records, since_ts, now):
+            count += 1
+            yield record
+        loginf("catch-up: %d archive records from %d log records" % (count, len(records)))
+
+    def aggregate(self, records, since_ts, now):
+        """Generate a record averaging the log records in each archive
+        interval after since_ts. Intervals that may still get more log
+        records are skipped."""
+        import weewx.accum
+        interval = self.archive_interval
+        last_complete = min(now, records[-1]['dateTime']) if records else now
+        accum = None
+        weight = self.importer.interval * 60
+        for record in records:
+            ts = record['dateTime']
+            stop = int(math.ceil(ts / float(interval))) * interval
+            if stop > last_complete:
+                break
+            if since_ts is not None and stop <= since_ts:
+                continue
+            if accum is not None and stop != accum.timespan.stop:
+                yield self._get_record(accum)
+                accum = None
+            if accum is None:
+                accum = weewx.accum.Accum(weeutil.weeutil.TimeSpan(stop - interval, stop))
+            accum.addRecord(record, weight=weight)
+        if accum is not None:
+            yield self._get_record(accum)
+
+    def _get_record(self, accum):
+        record = accum.getRecord()
+        record['interval'] = self.archive_interval // 60
+        return record
+
+
+class ColumbiaMicroServerDayCache(object):
+    """Columnar on-disk cache of the records parsed from each daily log file.
+
+    Each day is kept in a file of its own holding a JSON header line followed
+    by one array of little-endian doubles per column, dateTime first, with
+    NaN for missing values. Since dateTime is sorted, the rows in a time
+    range are found by bisecting it and only those rows of each column are
+    read. The index lists the size and modification time of the log file
+    each day was made from along with its first and last times, number of
+    rows and last rain total, so a day is only rebuilt when its log file
+    changes and days outside a time range are not opened at all. A day is
+    kept separately for each unit system it is read in, so catch-up, which
+    works in US units, and imports into a metric database share the cache
+    without throwing out each other's days. A day is also rebuilt when the
+    settings used to read the log files, such as the sensor map or log
+    units, are different from those it was made with."""
+
+    INDEX = 'index.json'
+    SUFFIX = '.col'
+    TYPECODE = 'd'
+    ITEM_SIZE = array.array(TYPECODE).itemsize
+
+    def __init__(self, cache_dir, settings=None):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Fingerprint of the settings the records are read with
+        self.settings = hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+        self.index = self._load_index()
+
+    def entry(self, path, us_units):
+        """Return the index entry for the log file at path in us_units."""
+        return self.index.get(self._name(path, us_units))
+
+    def get(self, path, us_units, read, start_ts=None, stop_ts=None):
+        """Return the records in us_units for the log file at path after
+        start_ts and up to stop_ts, calling read(path, us_units) to parse the
+        file if it isn't in the cache or has changed."""
+        name = self._name(path, us_units)
+        stat = os.stat(path)
+        entry = self.index.get(name)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime or \
+                entry.get('settings') != self.settings or not os.path.exists(self._path(name)):
+            records = read(path, us_units)
+            self._write(name, stat, us_units, records)
+            return [record for record in records
+                    if (start_ts is None or record['dateTime'] > start_ts) and
+                    (stop_ts is None or record['dateTime'] <= stop_ts)]
+        if not entry['rows'] or (start_ts is not None and entry['last'] <= start_ts) or \
+                (stop_ts is not None and entry['first'] > stop_ts):
+            return []
+        return self._read(name, start_ts, stop_ts)
+
+    @staticmethod
+    def _name(path, us_units):
+        """Return the name a log file in us_units is kept under."""
+        return '%s.%d' % (os.path.basename(path), us_units)
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, name + ColumbiaMicroServerDayCache.SUFFIX)
+
+    def _write(self, name, stat, us_units, records):
+        """Save the records of a day and add it to the index."""
+        fields = sorted(set(key for record in records for key in record) - {'dateTime', 'usUnits', 'interval'})
+        header = {
+            'rows': len(records),
+            'fields': fields,
+            'usUnits': us_units,
+            'interval': records[0].get('interval') if records else None,
+            'settings': self.settings,
+        }
+        last_rain_total = None
+        for record in records:
+            if record.get('rainTotal') is not None:
+                last_rain_total = record['rainTotal']
+        entry = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'usUnits': us_units,
+            'rows': len(records),
+            'first': records[0]['dateTime'] if records else None,
+            'last': records[-1]['dateTime'] if records else None,
+            'last_rain_total': last_rain_total,
+            'settings': self.settings,
+        }
+        nan = float('nan')
+        path = self._path(name)
+        try:
+            with open(path + '.tmp', 'wb') as f:
+                f.write((json.dumps(header) + '\n').encode('utf-8'))
+                for field in ['dateTime'] + fields:
+                    column = array.array(self.TYPECODE, [nan if record.get(field) is None else record[field]
+                                                         for record in records])
+                    if sys.byteorder != 'little':
+                        column.byteswap()
+                    column.tofile(f)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError) as e:
+            logerr("_write(): unable to write %s: %s" % (path, e))
+            self.index.pop(name, None)
+            return
+        self.index[name] = entry
+        self._save_index()
+
+    def _read(self, name, start_ts=None, stop_ts=None):
+        """Return the records of a day after start_ts and up to stop_ts."""
+        with open(self._path(name), 'rb') as f:
+            header_line = f.readline()
+            header = json.loads(header_line.decode('utf-8'))
+            rows = header['rows']
+            offset = len(header_line)
+            times = self._read_column(f, offset, 0, rows)
+            first = 0 if start_ts is None else bisect.bisect_right(times, start_ts)
+            last = rows if stop_ts is None else bisect.bisect_right(times, stop_ts)
+            if first >= last:
+                return []
+            records = []
+            for ts in times[first:last]:
+                record = {'dateTime': int(ts), 'usUnits': header['usUnits']}
+                if header['interval'] is not None:
+                    record['interval'] = header['interval']
+                records.append(record)
+            for i, field in enumerate(header['fields']):
+                column = self._read_column(f, offset + (i + 1) * rows * self.ITEM_SIZE, first, last - first)
+                for record, value in zip(records, column):
+                    # NaN marks a missing value
+                    if value == value:
+                        record[field] = value
+        return records
+
+    def _read_column(self, f, offset, first, count):
+        column = array.array(self.TYPECODE)
+        f.seek(offset + first * self.ITEM_SIZE)
+        column.fromfile(f, count)
+        if sys.byteorder != 'little':
+            column.byteswap()
+        return column
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.cache_dir, ColumbiaMicroServerDayCache.INDEX)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return dict()
+
+    def _save_index(self):
+        path = os.path.join(self.cache_dir, ColumbiaMicroServerDayCache.INDEX)
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self.index, f, indent=1, sort_keys=True)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError) as e:
+            logerr("_save_index(): unable to write %s: %s" % (path, e))
+
+
+def percentile(values, fraction):
+    """Return the value at fraction of the way through a sorted list."""
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def to_float(text):
+    """Return the value of a log file column or None if it is empty or not
+    a number."""
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def convert_array(numpy, convert, values):
+    """Apply a WeeWX unit conversion function to a NumPy array, numpy being
+    the module as imported by ColumbiaMicroServerLogImporter. The
+    conversion functions are simple arithmetic so they work on whole arrays,
+    but if one doesn't, it is applied to each value instead."""
+    try:
+        converted = convert(values)
+        if isinstance(converted, numpy.ndarray) and converted.shape == values.shape:
+            return converted
+    except (TypeError, ValueError):
+        pass
+    return numpy.array([value if value != value else convert(value) for value in values.tolist()])
+
+
+def array_to_list(numpy, values):
+    """Return a NumPy array as a list of floats with None for NaN."""
+    result = values.tolist()
+    for i in numpy.flatnonzero(numpy.isnan(values)).tolist():
+        result[i] = None
+    return result
+
+
+def rain_deltas_numpy(numpy, totals, last_total=None):
+    """Same as rain_deltas for a NumPy array of running rain totals with
+    NaN for missing values. Returns an array of rain with the last total."""
+    if not len(totals):
+        return totals, last_total
+    valid = ~numpy.isnan(totals)
+    # Index of the last valid total up to and including each position
+    last_index = numpy.maximum.accumulate(numpy.where(valid, numpy.arange(len(totals)), -1))
+    # The previous total for each position is the last valid one before it,
+    # or last_total for those before the first valid total.
+    previous_index = numpy.concatenate(([-1], last_index[:-1]))
+    previous = numpy.where(previous_index >= 0, totals[numpy.maximum(previous_index, 0)],
+                           numpy.nan if last_total is None else last_total)
+    with numpy.errstate(invalid='ignore'):
+        deltas = numpy.where(totals >= previous, totals - previous, numpy.nan)
+    deltas[~valid | numpy.isnan(previous)] = numpy.nan
+    if last_index[-1] >= 0:
+        last_total = float(totals[last_index[-1]])
+    return deltas, last_total
+
+
+def rain_deltas(totals, last_total=None):
+    """Return the rain for each of a list of running rain totals together
+    with the last total. When the total drops, such as when the monthly
+    total is reset, the rain is unknown the same as for loop packets."""
+    deltas = []
+    for total in totals:
+        deltas.append(weewx.wxformulas.calculate_rain(total, last_total))
+        if total is not None:
+            last_total = total
+    return deltas, last_total
+
 
 # Define a main entry point for basic testing of the station without weewx
 # engine and service overhead.  Invoke this as follows from the weewx root directory:
@@ -458,14 +2802,13 @@ if __name__ == '__main__':
     def main():
         import sys
         import json
-        syslog.openlog('wee_' + DRIVER_SHORT_NAME, syslog.LOG_PID | syslog.LOG_CONS)
         parser = optparse.OptionParser(usage=usage)
         parser.add_option('--version', dest='version', action='store_true',
                           help='display driver version')
         parser.add_option('--debug', dest='debug', action='store_true',
                           help='display diagnostic information while running')
         parser.add_option('--config', dest='cfgfn', type=str, metavar="FILE",
-                          help="Use configuration file FILE. Default is /etc/weewx/weewx.conf or /home/weewx/weewx.conf")
+                          help="Use configuration file FILE, reading the data shared by the running driver if it has a share_file")
         parser.add_option('--url', dest='url', metavar="URL",
                           help='Full URL of the MicroServer including path info to XML data')
         parser.add_option('--host', dest='host', metavar="HOST",
@@ -473,31 +2816,78 @@ if __name__ == '__main__':
         parser.add_option('--port', dest='port', type=int, metavar="PORT",
                           default=80,
                           help='port on which the MicroServer is listening')
+        parser.add_option('--share', dest='share_file', metavar='FILE',
+                          help='show the latest data shared by the running driver in FILE')
+        # Handled by columbia_ms_core before WeeWX is loaded, listed here for --help
         parser.add_option('--test-parse', dest='filename', metavar='FILENAME',
-                          help='test the xml parsing')
-        (options, _) = parser.parse_args()
-
-        if options.version:
-            print("%s driver version %s" % (DRIVER_SHORT_NAME, DRIVER_VERSION))
-            exit(1)
+                          help='test the xml parsing of FILENAME and any further files or directories')
+        parser.add_option('--download-logs', dest='log_dir', metavar='DIR',
+                          help='download the daily log files from the MicroServer to DIR')
+        parser.add_option('--user', dest='user', metavar='USER', default='admin',
+                          help='MicroServer admin user for downloading log files')
+        parser.add_option('--password', dest='password', metavar='PASSWORD',
+                          help='MicroServer admin password for downloading log files')
+        parser.add_option('--date-from', dest='date_from', metavar='YYYY-MM-DD',
+                          help='first date of the daily log files to use')
+        parser.add_option('--date-to', dest='date_to', metavar='YYYY-MM-DD',
+                          help='last date of the daily log files to use')
+        parser.add_option('--workers', dest='workers', type=int, metavar='N', default=2,
+                          help='number of log files to download at once')
+        parser.add_option('--replay', dest='replay_file', metavar='FILE',
+                          help='print the loop packets from a capture file')
+        parser.add_option('--speed', dest='speed', type=float, metavar='N', default=0,
+                          help='replay speed, 0 for as fast as possible, 1 for real time')
+        (options, args) = parser.parse_args()
+
+        setup_logging(options.debug)
+
+        if options.replay_file:
+            driver = ColumbiaMicroServerDriver(replay_file=options.replay_file, replay_speed=options.speed)
+            start = time.time()
+            count = 0
+            for packet in driver.genLoopPackets():
+                print(json.dumps(packet, sort_keys=True))
+                count += 1
+            elapsed = time.time() - start
+            sys.stderr.write("%d packets in %.3fs\n" % (count, elapsed))
+            exit(0)
 
-        weeutil.logger.setup(DRIVER_SHORT_NAME, {})
+        if options.share_file:
+            shared = ColumbiaMicroServerShare.read(options.share_file)
+            if shared is None:
+                print("no data shared in %s" % options.share_file)
+                exit(1)
+            for name in sorted(shared['stations']):
+                json.dump(shared['stations'][name]['pkt_grp'], sys.stdout)
+                print()
+            exit(0)
 
-        if options.debug is not None:
-            syslog.setlogmask(syslog.LOG_UPTO(syslog.LOG_DEBUG))
-            weewx.debug = 1
-        else:
-            syslog.setlogmask(syslog.LOG_UPTO(syslog.LOG_INFO))
-            weewx.debug = 0
-
-        if options.filename:
-            data = ''
-            with open(options.filename, "r") as f:
-                data = f.read()
-            record = ColumbiaMicroServerStation.parse_data(data)
-            json.dump(record, sys.stdout)
+        if options.log_dir:
+            if not options.host:
+                parser.error("--download-logs needs the --host of the MicroServer")
+            downloader = ColumbiaMicroServerLogDownloader(
+                options.host, options.port, options.log_dir,
+                options.user, options.password, options.workers)
+            downloaded, skipped, failed = downloader.download(
+                parse_date(options.date_from), parse_date(options.date_to))
+            print("%d downloaded, %d already downloaded, %d failed" % (downloaded, skipped, failed))
             exit(0)
 
+        # Use the data shared by the running driver rather than polling the
+        # MicroServer as well.
+        if options.cfgfn:
+            import configobj
+            stn_dict = configobj.ConfigObj(options.cfgfn, file_error=True, encoding='utf-8').get(DRIVER_NAME, {})
+            if stn_dict.get('share_file'):
+                shared = ColumbiaMicroServerShare.read(stn_dict['share_file'],
+                                                       float(stn_dict.get('share_max_age', 120)))
+                if shared is not None:
+                    print("get data from %s" % stn_dict['share_file'])
+                    for name in sorted(shared['stations']):
+                        json.dump(shared['stations'][name]['pkt_grp'], sys.stdout)
+                        print()
+                    exit(0)
+
         url = "http://%s:%s" % (options.host, options.port)
         if options.url:
             url = options.url
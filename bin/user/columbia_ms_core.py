@@ -0,0 +1,460 @@
+#!/usr/bin/env python
+# Copyright 2020 by William Burton
+# Distributed under the terms of the GNU Public License (GPLv3)
+
+"""Parsing and translation for the Columbia Weather Systems MicroServer
+driver that work without WeeWX.
+
+The XML parser, the translation of packet groups to loop packets and the
+capture file reader and writer are kept here so scripts can use them without
+loading WeeWX, which takes longer than parsing on small machines. WeeWX is
+only imported when fetching data from a MicroServer or to raise its I/O
+error for data that can't be parsed. The driver, columbia_ms.py, imports
+everything from here.
+
+Test the parser on one or more XML files, directories of them or capture
+files, printing one JSON line for each response:
+
+    python bin/user/columbia_ms_core.py --test-parse FILE|DIR [FILE|DIR ...]
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import gzip
+import json
+import logging
+import os
+import re
+import socket
+import struct
+import sys
+import zlib
+from xml.etree import ElementTree
+
+try:
+    # Python 3
+    from urllib.request import Request, urlopen
+    from urllib.error import URLError
+except ImportError:
+    # Python 2
+    from urllib2 import Request, urlopen, URLError
+
+DRIVER_VERSION = '1.0.0'
+DRIVER_SHORT_NAME = 'columbia_ms'
+
+# WeeWX 4 logs through the logging module. With older versions the driver
+# replaces these with its syslog functions.
+log = logging.getLogger(__name__)
+
+
+def logdbg(msg):
+    log.debug(msg)
+
+
+def loginf(msg):
+    log.info(msg)
+
+
+def logerr(msg):
+    log.error(msg)
+
+
+class ColumbiaMicroServerTranslation(object):
+    """Translation of one packet group in one set of units into a loop
+    packet. Everything that depends only on the sensor map and the units is
+    worked out when the translation is built so translating a packet is
+    just copying the mapped fields and applying any unit conversions."""
+
+    __slots__ = ('fields', 'us_units', 'conversions')
+
+    def __init__(self, fields, us_units, conversions):
+        # Pairs of output field name and input element name
+        self.fields = tuple(fields)
+        self.us_units = us_units
+        # Pairs of output field name and unit conversion function
+        self.conversions = tuple(conversions)
+
+    def translate(self, pkt, packet_time):
+        packet = {'dateTime': packet_time}
+        for field, name in self.fields:
+            if name in pkt:
+                packet[field] = pkt[name]
+        if self.us_units is not None:
+            packet['usUnits'] = self.us_units
+        for field, convert in self.conversions:
+            if field in packet:
+                packet[field] = convert(packet[field])
+        return packet
+
+
+class ColumbiaMicroServerRecorder(object):
+    """Capture of the raw responses from a MicroServer.
+
+    Each response is appended to a gzip file as a record header of the
+    fetch time, the kind of record and the length of the data, followed by
+    the data. A response that is the same as the one before is written as a
+    reference with no data. Each record is flushed so the file can be read
+    while it is being written. Once the file is larger than max_bytes it is
+    rotated to path.1, path.2 and so on, keeping backups old files."""
+
+    # Fetch time, kind of record and length of the data that follows
+    RECORD = struct.Struct('!dBI')
+    FULL = 0
+    SAME = 1
+
+    def __init__(self, path, max_bytes=10000000, backups=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.raw = None
+        self.file = None
+        self.last_data = None
+
+    def record(self, fetch_time, data):
+        try:
+            if self.file is None:
+                self._open()
+            if data == self.last_data:
+                self.file.write(self.RECORD.pack(fetch_time, self.SAME, 0))
+            else:
+                encoded = data.encode('utf-8')
+                self.file.write(self.RECORD.pack(fetch_time, self.FULL, len(encoded)))
+                self.file.write(encoded)
+                self.last_data = data
+            self.file.flush()
+            if self.raw.tell() >= self.max_bytes:
+                self.close()
+                self._rotate()
+        except (IOError, OSError) as e:
+            logerr("record(): unable to write %s: %s" % (self.path, e))
+            self.close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.raw.close()
+            self.file = None
+            self.raw = None
+        # A new file has to start with the full data
+        self.last_data = None
+
+    def _open(self):
+        self.raw = open(self.path, 'ab')
+        self.file = gzip.GzipFile(fileobj=self.raw, mode='ab')
+
+    def _rotate(self):
+        for n in range(self.backups - 1, 0, -1):
+            if os.path.exists('%s.%d' % (self.path, n)):
+                os.rename('%s.%d' % (self.path, n), '%s.%d' % (self.path, n + 1))
+        if self.backups > 0:
+            os.rename(self.path, '%s.1' % self.path)
+        else:
+            os.remove(self.path)
+
+    @staticmethod
+    def read(path, strict=False):
+        """Generate the fetch time and data of each response in a capture
+        file. A record cut short, such as by a crash while writing, ends
+        the file. A damaged record, or a file that isn't a capture at all,
+        also ends the file, raising IOError if strict."""
+        record = ColumbiaMicroServerRecorder.RECORD
+        data = None
+        with gzip.open(path, 'rb') as f:
+            while True:
+                try:
+                    header = f.read(record.size)
+                    if len(header) < record.size:
+                        break
+                    fetch_time, kind, length = record.unpack(header)
+                    if kind == ColumbiaMicroServerRecorder.FULL:
+                        encoded = f.read(length)
+                        if len(encoded) < length:
+                            break
+                        data = encoded.decode('utf-8')
+                    elif data is None:
+                        # A reference with nothing before it to refer to
+                        continue
+                except EOFError:
+                    # The end of the file was never written
+                    break
+                except (IOError, struct.error, zlib.error) as e:
+                    if strict:
+                        raise IOError("%s ends with a damaged record: %s" % (path, e))
+                    logerr("read(): %s ends with a damaged record: %s" % (path, e))
+                    break
+                yield fetch_time, data
+
+
+class ColumbiaMicroServerParser(object):
+    """Single pass scanner for the MicroServer enhanced XML.
+
+    The document is a flat list of roughly 80 <meas> elements of which only a
+    few are kept, so rather than building an element tree the text is scanned
+    for each element name which is looked up in a dispatch table built once
+    from the input elements. Elements not in the table are skipped without
+    looking any further at them and scanning stops once every wanted element
+    has been seen. Since nothing after the last wanted element is examined,
+    a truncated closing </oriondata> tag or trailing junk such as null bytes
+    does no harm."""
+
+    # Format of the mtSampTime element
+    SAMPLE_TIME_FORMAT = '%Y/%m/%d %H:%M:%S'
+
+    def __init__(self, input_elements, unit_elements, wanted=None):
+        """input_elements maps each element name to its packet group and
+        unit_elements lists the elements whose unit attribute gives the units
+        of their packet group. If wanted is given, only those elements plus
+        the unit elements of their packet groups are kept."""
+        if wanted is not None:
+            wanted = set(wanted)
+            groups = set(input_elements[name] for name in wanted if name in input_elements)
+            wanted.update(name for name in unit_elements
+                          if input_elements.get(name) in groups)
+        self.dispatch = dict()
+        for name, pkt_type in input_elements.items():
+            if wanted is None or name in wanted:
+                self.dispatch[name] = (pkt_type, name in unit_elements)
+
+    @staticmethod
+    def get_sample_time(data):
+        """Return the text of the mtSampTime element or None if not found.
+        This is much cheaper than a full parse so it can be used to tell if
+        the MicroServer has taken a new sample."""
+        name_pos = data.find('mtSampTime')
+        if name_pos < 0:
+            return None
+        tag_end = data.find('>', name_pos)
+        value_end = data.find('<', tag_end)
+        if tag_end < 0 or value_end < 0:
+            return None
+        return data[tag_end + 1:value_end]
+
+    def parse(self, data):
+        """Return the packet groups found in data. Raises ParseError if the
+        data is not a MicroServer document or a wanted element is damaged."""
+        dispatch = self.dispatch
+        remaining = len(dispatch)
+        pkt_grp = dict()
+        if not data.startswith('<oriondata'):
+            raise ElementTree.ParseError("invalid XML file. Missing <oriondata> and/or <meas/> tags detected.")
+        pos = data.find('<', data.find('>'))
+        if not data.startswith('<meas', pos):
+            raise ElementTree.ParseError("invalid XML file. Missing <oriondata> and/or <meas/> tags detected.")
+        while pos >= 0 and remaining:
+            name_pos = data.find('name=', pos) + 6
+            name_end = data.find(data[name_pos - 1], name_pos)
+            if name_pos < 6 or name_end < 0:
+                raise ElementTree.ParseError("truncated <meas> element at offset %d" % pos)
+            entry = dispatch.get(data[name_pos:name_end])
+            if entry is not None:
+                name = data[name_pos:name_end]
+                pkt_type, unit_element = entry
+                tag_end = data.find('>', name_end)
+                value_end = data.find('<', tag_end)
+                if tag_end < 0 or value_end < 0:
+                    raise ElementTree.ParseError("truncated <meas> element %s" % name)
+                if pkt_type not in pkt_grp:
+                    pkt_grp[pkt_type] = dict()
+                group = pkt_grp[pkt_type]
+                # If the field is in the list to use for the unit type,
+                # save the unit type as the field 'base_units'.
+                if unit_element:
+                    # If the packet type is 'generic' then it's a unit type that's
+                    # neither US or metric such as degrees for wind direction.
+                    if pkt_type == 'generic':
+                        group['base_units'] = 'generic'
+                    else:
+                        group['base_units'] = self._get_unit(data, name_end, tag_end, name)
+                if name not in group:
+                    remaining -= 1
+                try:
+                    group[name] = float(data[tag_end + 1:value_end])
+                except ValueError:
+                    raise ElementTree.ParseError("invalid value for <meas> element %s" % name)
+            pos = data.find('<meas', name_end)
+        return pkt_grp
+
+    @staticmethod
+    def _get_unit(data, start, end, name):
+        """Return the value of the unit attribute found between start and end."""
+        unit_pos = data.find('unit=', start, end) + 6
+        unit_end = data.find(data[unit_pos - 1], unit_pos, end)
+        if unit_pos < 6 or unit_end < 0:
+            raise ElementTree.ParseError("missing unit attribute for <meas> element %s" % name)
+        return data[unit_pos:unit_end]
+
+
+class ColumbiaMicroServerStation(object):
+    # Map is used when parsing the MicroServer XML to determine if an input 
+    # element should be passed back or not, and if so, what packet group it
+    # belongs to. Each group can have it's own unit type as the MicroServer
+    # supports configuring each group with different units.
+    XML_INPUT_ELEMENTS = {
+        'mtWindSpeed': 'wind',
+        'mtAdjWindDir': 'wind',
+        'mt2MinWindGustSpeed': 'wind',
+        'mt2MinWindGustDir': 'wind',
+
+        'mtTemp1': 'temp',
+        'mtWindChill': 'temp',
+        'mtDewPoint': 'temp',
+        'mtHeatIndex': 'temp',
+        'mtTemp_2': 'temp',
+        'mtTemp_3': 'temp',
+        'mtTemp_4': 'temp',
+
+        'mtRainThisMonth': 'rain',
+        'mtRainRate': 'rain',
+
+        'mtAdjBaromPress': 'pressure',
+
+        'mtRelHumidity': 'generic',
+        'mtSolarRadiaton': 'generic',
+    }
+
+    # List of input fields that should be used to determine which field should
+    # be used to return the unit type for the associated packet group.
+    XML_INPUT_UNIT_ELEMENTS = [
+        'mtWindSpeed','mtTemp1','mtRainRate','mtRelHumidity','mtAdjBaromPress'
+    ]
+
+    @staticmethod
+    def get_data(url):
+        # Only fetching needs WeeWX, for its version and I/O error
+        import weewx
+        try:
+            request = Request(url)
+            request.add_header('User-Agent', 'WeeWX/%s' % weewx.__version__)
+            response = urlopen(request, timeout=4)
+        except URLError as e:
+            logerr("get_data(): Unable to open weather station %s or %s" % (url, e))
+            raise weewx.WeeWxIOError("get_data(): Socket error or timeout for weather station %s or %s" % (url, e))
+        except (socket.error, socket.timeout) as e:
+            logerr("get_data(): Socket error or timeout for weather station %s or %s" % (url, e))
+            raise weewx.WeeWxIOError("get_data(): Socket error or timeout for weather station %s or %s" % (url, e))
+        # File URLs, used for testing, have no response code
+        if response.getcode() not in (200, None):
+            raise weewx.WeeWxIOError("get_data(): Bad response code returned: %d." % response.code)
+        content_length = response.info().get('Content-Length')
+        if content_length is None:
+            # Without a length the body ends when the connection is closed
+            return response.read().decode('utf-8')
+        return response.read(int(content_length)).decode('utf-8')
+
+    # Parser for the default set of input elements, built once at import.
+    PARSER = ColumbiaMicroServerParser(XML_INPUT_ELEMENTS, XML_INPUT_UNIT_ELEMENTS)
+
+    @staticmethod
+    def parse_data(data, parser=None):
+        """Parse the XML data which is a flat non-hierarchical record and return 
+        a two-level dictionary hierarchy where each key is the field group and 
+        associated with that, a dictionary with the fields and values associated 
+        with that group. If no parser is given, the one for the default set of
+        input elements is used."""
+        if parser is None:
+            parser = ColumbiaMicroServerStation.PARSER
+        try:
+            return parser.parse(data)
+        except ElementTree.ParseError as e:
+            import weewx
+            # The data is logged in full by poll at debug level
+            logerr("ElementTree ParseError: %s for %d bytes of data starting %r" % (e, len(data), data[:40]))
+            raise weewx.WeeWxIOError(e)
+
+
+def is_capture_file(path):
+    """Return True if path is named like a capture file or a rotated one."""
+    return re.search(r'\.gz(\.\d+)?$', path) is not None
+
+
+def gen_test_files(paths):
+    """Generate the files named in paths, listing the XML and capture files
+    in any directories in name order."""
+    for path in paths:
+        if os.path.isdir(path):
+            for dir_path, dir_names, file_names in os.walk(path):
+                dir_names.sort()
+                for file_name in sorted(file_names):
+                    if file_name.endswith('.xml') or is_capture_file(file_name):
+                        yield os.path.join(dir_path, file_name)
+        else:
+            yield path
+
+
+def gen_test_parse(paths):
+    """Parse the XML and capture files in paths, generating a dict for each
+    response with the file, the fetch time for capture files and either the
+    packet groups or the error."""
+    parser = ColumbiaMicroServerStation.PARSER
+    for path in gen_test_files(paths):
+        try:
+            if is_capture_file(path):
+                responses = ColumbiaMicroServerRecorder.read(path, strict=True)
+            else:
+                with open(path, 'r') as f:
+                    responses = [(None, f.read())]
+            for fetch_time, data in responses:
+                result = {'file': path}
+                if fetch_time is not None:
+                    result['fetch_time'] = fetch_time
+                try:
+                    result['pkt_grp'] = parser.parse(data)
+                except ElementTree.ParseError as e:
+                    result['error'] = str(e)
+                yield result
+        except (IOError, OSError, UnicodeDecodeError) as e:
+            yield {'file': path, 'error': str(e)}
+
+
+def test_parse(paths, out=sys.stdout):
+    """Print the packet groups parsed from a single XML file as JSON or, for
+    more than one file or any directories or capture files, one JSON line
+    for each response. Returns the exit status, which is 1 if any response
+    could not be parsed."""
+    status = 0
+    if len(paths) == 1 and os.path.isfile(paths[0]) and not is_capture_file(paths[0]):
+        with open(paths[0], 'r') as f:
+            data = f.read()
+        try:
+            json.dump(ColumbiaMicroServerStation.PARSER.parse(data), out)
+        except ElementTree.ParseError as e:
+            logerr("ElementTree ParseError: %s" % e)
+            status = 1
+        return status
+    for result in gen_test_parse(paths):
+        out.write(json.dumps(result, sort_keys=True))
+        out.write('\n')
+        if 'error' in result:
+            status = 1
+    return status
+
+
+def main(argv=None):
+    """Run the --version and --test-parse commands, which are also handed
+    here by columbia_ms.py so they run without loading WeeWX."""
+    import optparse
+    parser = optparse.OptionParser(usage="%prog [--version] [--debug] --test-parse FILE|DIR [FILE|DIR ...]")
+    parser.add_option('--version', dest='version', action='store_true',
+                      help='display driver version')
+    parser.add_option('--debug', dest='debug', action='store_true',
+                      help='display diagnostic information while running')
+    parser.add_option('--test-parse', dest='filename', metavar='FILENAME',
+                      help='test the xml parsing of FILENAME and any further files or directories')
+    (options, args) = parser.parse_args(argv)
+
+    if options.version:
+        print("%s driver version %s" % (DRIVER_SHORT_NAME, DRIVER_VERSION))
+        return 1
+
+    logging.basicConfig(level=logging.DEBUG if options.debug else logging.INFO)
+
+    if options.filename:
+        # Any further files or directories are parsed too
+        return test_parse([options.filename] + args)
+
+    parser.print_help()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,5 +15,6 @@ class ColumbiaMicroServerInstaller(ExtensionInstaller):
             description='Capture weather data from a Columbia Weather Systems MicroServer',
             author="William Burton",
             author_email="bburton@mail.com",
-            files=[('bin/user', ['bin/user/columbia_ms.py'])]
+            files=[('bin/user', ['bin/user/columbia_ms.py',
+                                 'bin/user/columbia_ms_core.py'])]
             )
@@ -0,0 +1,104 @@
+"""Benchmarks for the per-poll hot paths of the Columbia MicroServer driver.
+
+Needs pytest and pytest-benchmark and is skipped without them. Run from the
+top of the repository with WeeWX on the path:
+
+    PYTHONPATH=bin python -m pytest test/bench_columbia_ms.py
+
+Besides the timings reported by pytest-benchmark, the extra_info of each
+benchmark records the 50th, 95th and 99th percentile round times, the peak
+memory allocated by one call and, for parsing, the bytes parsed per second.
+See README.txt for saving a baseline and comparing against it.
+"""
+
+import glob
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(TEST_DIR), 'bin', 'user'))
+sys.path.insert(0, TEST_DIR)
+
+from columbia_ms import ColumbiaMicroServerStation, ColumbiaMicroServerSource
+import microserver_sim
+
+SAMPLES = sorted(os.path.basename(path) for path in
+                 glob.glob(os.path.join(TEST_DIR, 'latestsampledata_u_*.xml')))
+
+
+def read_sample(name):
+    with open(os.path.join(TEST_DIR, name)) as f:
+        return f.read()
+
+
+def make_source(url='http://localhost/tmp/latestsampledata_u.xml'):
+    return ColumbiaMicroServerSource(None, {'station_url': url}, 15.0)
+
+
+def record_stats(benchmark, func, *args):
+    """Add percentiles of the round times and the peak allocation of one
+    call of func to the extra_info of the benchmark."""
+    data = sorted(benchmark.stats.stats.data)
+    for name, fraction in (('p50', 0.50), ('p95', 0.95), ('p99', 0.99)):
+        benchmark.extra_info[name] = data[min(len(data) - 1, int(fraction * len(data)))]
+    if tracemalloc is not None:
+        tracemalloc.start()
+        func(*args)
+        benchmark.extra_info['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+
+@pytest.mark.parametrize('name', SAMPLES)
+def test_parse_data(benchmark, name):
+    data = read_sample(name)
+    benchmark(ColumbiaMicroServerStation.parse_data, data)
+    benchmark.extra_info['bytes_per_second'] = len(data) / benchmark.stats.stats.mean
+    record_stats(benchmark, ColumbiaMicroServerStation.parse_data, data)
+
+
+@pytest.mark.parametrize('name', ['latestsampledata_u_us1.xml',
+                                  'latestsampledata_u_metric1.xml',
+                                  'latestsampledata_u_metric3_knots.xml'])
+def test_translate(benchmark, name):
+    source = make_source()
+    pkt_grp = ColumbiaMicroServerStation.parse_data(read_sample(name), source.parser)
+
+    def translate():
+        return list(source.gen_packets(pkt_grp, True, True))
+
+    packets = benchmark(translate)
+    assert packets
+    record_stats(benchmark, translate)
+
+
+def test_calculate_rain_delta(benchmark):
+    source = make_source()
+    packet = {'rainTotal': 1.25}
+    source.last_rain_total = 1.0
+    benchmark(source._calculate_rain_delta, packet)
+    assert packet['rain'] == 0.0
+    record_stats(benchmark, source._calculate_rain_delta, packet)
+
+
+@pytest.mark.parametrize('units', ['us', 'metric', 'knots'])
+def test_fetch_and_parse(benchmark, units):
+    sim = microserver_sim.MicroServerSimulator(units=units)
+    sim.start()
+    source = make_source(sim.url)
+    try:
+        benchmark(source.poll)
+        assert source.error is None
+        record_stats(benchmark, source.poll)
+    finally:
+        source.session.close()
+        sim.stop()
@@ -0,0 +1,518 @@
+#!/usr/bin/env python
+# Copyright 2020 by William Burton
+# Distributed under the terms of the GNU Public License (GPLv3)
+
+"""Local stand-in for a Columbia Weather Systems MicroServer.
+
+Serves /tmp/latestsampledata_u.xml with synthetic values that change over
+time, the admin Data Logs page /admin/logfiles.php and the daily CSV log
+files it links to, so the driver can be tested and load tested without a
+MicroServer.
+
+The units can be set to match the 'us', 'metric' or 'knots' samples in
+this folder. The metric samples don't include the barometer so it is
+always in inchesHg.
+
+Faults seen from real MicroServers can be injected:
+* latency - seconds to wait before responding
+* truncate - fraction of responses cut short at '</ori', or for log files
+  the connection dropped half way through
+* nulls - fraction of responses with null bytes after the closing tag
+* no_content_length - leave out the Content-Length header
+* fail - fraction of responses that are HTTP 500 errors
+
+With conditional set, the XML is sent with ETag and Last-Modified headers
+and requests conditional on them get a 304 Not Modified response until the
+next sample is taken.
+
+Run a simulator:
+
+    python test/microserver_sim.py --port 8080 --units metric --latency 0.2
+
+Load test the driver against it, which needs WeeWX on the PYTHONPATH:
+
+    PYTHONPATH=bin python test/microserver_sim.py --load 200 --polls-per-minute 600
+    PYTHONPATH=bin python test/microserver_sim.py --load 200 --wind-poll-interval 0.25 --conditional
+    PYTHONPATH=bin python test/microserver_sim.py --download /tmp/logs
+"""
+
+from __future__ import print_function
+import base64
+import datetime
+import email.utils
+import math
+import random
+import socket
+import threading
+import time
+
+try:
+    # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+XML_PATH = '/tmp/latestsampledata_u.xml'
+LOGS_PATH = '/admin/logfiles.php'
+
+# Units of each kind of measurement for each unit configuration
+UNITS = {
+    'us': {'temp': 'degreeF', 'speed': 'mph', 'rain': 'inchesRain',
+           'rate': 'inchesPerHour', 'pressure': 'inchesHg'},
+    'metric': {'temp': 'degreeC', 'speed': 'kmPerHour', 'rain': 'mmRain',
+               'rate': 'mmPerHour', 'pressure': 'inchesHg'},
+    'knots': {'temp': 'degreeC', 'speed': 'knots', 'rain': 'mmRain',
+              'rate': 'mmPerHour', 'pressure': 'inchesHg'},
+}
+
+# Conversions from US units to the other units
+CONVERSIONS = {
+    'degreeC': lambda x: (x - 32.0) * 5.0 / 9.0,
+    'kmPerHour': lambda x: x * 1.609344,
+    'knots': lambda x: x * 0.868976,
+    'mmRain': lambda x: x * 25.4,
+    'mmPerHour': lambda x: x * 25.4,
+}
+
+# Measurements served in the XML in document order as the name, kind of
+# units and number of decimals. A kind of None means there is no unit
+# attribute and a kind starting with '=' is a fixed unit attribute.
+MEASUREMENTS = [
+    ('mtTemp1', 'temp', 1),
+    ('mtWindChill', 'temp', 1),
+    ('mtHeatIndex', 'temp', 1),
+    ('mtDewPoint', 'temp', 1),
+    ('mtDegreeDay', 'temp', 1),
+    ('mtDensityAltitude', '=feetAlt', 0),
+    ('mtAvgTempToday', 'temp', 1),
+    ('mtWetBulbGlobeTemp', 'temp', 1),
+    ('mtSaturatedVaporPressure', '=inchesHg', 2),
+    ('mtVaporPressure', '=inchesHg', 2),
+    ('mtDryAirPressure', '=inchesHg', 2),
+    ('mtDryAirDensity', '=poundsPerFt3', 4),
+    ('mtAbsoluteHumidity', '=poundsPerFt3', 4),
+    ('mtAirDensityRatio', '=percent', 0),
+    ('mtAdjustedAltitude', '=feetAlt', 0),
+    ('mtSAECorrectionFactor', None, 3),
+    ('mtWetAirDensity', '=poundsPerFt3', 4),
+    ('mtWetBulbTemp', 'temp', 1),
+    ('mtEvapotranspiration', 'rain', 4),
+    ('mtRelHumidity', '=percent', 0),
+    ('mtWindSpeed', 'speed', 1),
+    ('mtRawWindDir', '=degrees', 0),
+    ('mtAdjWindDir', '=degrees', 0),
+    ('mt3SecRollAvgWindSpeed', 'speed', 1),
+    ('mt3SecRollAvgWindDir', '=degrees', 0),
+    ('mt2MinRollAvgWindSpeed', 'speed', 1),
+    ('mt2MinRollAvgWindDir', '=degrees', 0),
+    ('mt10MinRollAvgWindSpeed', 'speed', 1),
+    ('mt10MinRollAvgWindDir', '=degrees', 0),
+    ('mt60MinRollAvgWindSpeed', 'speed', 1),
+    ('mt60MinRollAvgWindDir', '=degrees', 0),
+    ('mt60MinWindGustDir', '=degrees', 0),
+    ('mt60MinWindGustSpeed', 'speed', 1),
+    ('mt10MinWindGustDir', '=degrees', 0),
+    ('mt10MinWindGustSpeed', 'speed', 1),
+    ('mt2MinWindGustDir', '=degrees', 0),
+    ('mt2MinWindGustSpeed', 'speed', 1),
+    ('mtRainToday', 'rain', 4),
+    ('mtRainThisWeek', 'rain', 4),
+    ('mtRainThisMonth', 'rain', 4),
+    ('mtRainThisYear', 'rain', 4),
+    ('mtRainRate', 'rate', 4),
+    ('mtRainLastHr', 'rate', 4),
+    ('mtPrecipType', None, 3),
+    ('mtRawBaromPress', 'pressure', 2),
+    ('mtAdjBaromPress', 'pressure', 2),
+    ('mtPressureTendency', '=unitless_0', 0),
+    ('mtTemp_2', 'temp', 1),
+    ('mtTemp_3', 'temp', 1),
+    ('mtTemp_4', 'temp', 1),
+    ('mtSolarRadiaton', '=wattsPerMeter2', 0),
+]
+
+# Time format of mtSampTime and the log files
+TIME_FORMAT = '%Y/%m/%d %H:%M:%S'
+
+
+def us_values(ts):
+    """Return the synthetic value of each measurement in US units at time
+    ts. Temperatures follow a daily cycle, wind varies over minutes and it
+    rains a little in the afternoon, so the values are repeatable for any
+    given time."""
+    day = 2 * math.pi * (ts % 86400) / 86400.0
+    temp = 50.0 - 15.0 * math.cos(day)
+    speed = 6.0 + 5.0 * math.sin(ts / 37.0) + 2.0 * math.sin(ts / 5.0)
+    direction = (200 + 90 * math.sin(ts / 300.0)) % 360
+    month_start = time.mktime(datetime.date.fromtimestamp(ts).replace(day=1).timetuple())
+    # 0.01 inches an hour between 1pm and 5pm every day
+    hours = (ts - month_start) / 3600.0
+    rain_month = 0.04 * math.floor(hours / 24) + 0.01 * min(max(hours % 24 - 13, 0), 4)
+    rate = 0.01 if 13 <= (ts % 86400) / 3600.0 < 17 else 0.0
+    values = dict((name, 0.0) for name, _, _ in MEASUREMENTS)
+    values.update({
+        'mtTemp1': temp,
+        'mtWindChill': temp - speed / 10.0,
+        'mtHeatIndex': temp + 0.3,
+        'mtDewPoint': temp - 8.0,
+        'mtAvgTempToday': 50.0,
+        'mtWetBulbTemp': temp - 3.0,
+        'mtTemp_2': temp + 20.0,
+        'mtTemp_3': temp + 1.0,
+        'mtTemp_4': temp - 1.0,
+        'mtRelHumidity': 60 + 20 * math.cos(day),
+        'mtWindSpeed': max(speed, 0.0),
+        'mtRawWindDir': direction,
+        'mtAdjWindDir': direction,
+        'mt2MinWindGustSpeed': max(speed, 0.0) + 3.0,
+        'mt2MinWindGustDir': (direction + 10) % 360,
+        'mt10MinWindGustSpeed': max(speed, 0.0) + 5.0,
+        'mt60MinWindGustSpeed': max(speed, 0.0) + 7.0,
+        'mtRainToday': 0.01 * min(max(hours % 24 - 13, 0), 4),
+        'mtRainThisMonth': rain_month,
+        'mtRainThisYear': 3.0 + rain_month,
+        'mtRainRate': rate,
+        'mtRainLastHr': rate,
+        'mtRawBaromPress': 30.0 + 0.2 * math.sin(ts / 7200.0),
+        'mtAdjBaromPress': 30.0 + 0.2 * math.sin(ts / 7200.0),
+        'mtSolarRadiaton': max(0.0, -800 * math.cos(day)),
+    })
+    return values
+
+
+def measurement_values(ts, units):
+    """Return a list of (name, unit attribute, formatted value) for each
+    measurement at time ts in the given unit configuration."""
+    unit_names = UNITS[units]
+    values = us_values(ts)
+    result = []
+    for name, kind, decimals in MEASUREMENTS:
+        value = values[name]
+        if kind is None:
+            unit = None
+        elif kind.startswith('='):
+            unit = kind[1:]
+        else:
+            unit = unit_names[kind]
+            if unit in CONVERSIONS:
+                value = CONVERSIONS[unit](value)
+        result.append((name, unit, '%.*f' % (decimals, value)))
+    return result
+
+
+def make_xml(ts, units='us'):
+    """Return the enhanced XML document for time ts, on one line as the
+    MicroServer sends it."""
+    parts = ["<oriondata version='1.1' station='Simulated %s units'>" % units,
+             "<meas name='mtSampTime'>%s</meas>" % time.strftime(TIME_FORMAT, time.localtime(ts))]
+    for name, unit, value in measurement_values(ts, units):
+        if unit is None:
+            parts.append("<meas name='%s'>%s</meas>" % (name, value))
+        else:
+            parts.append("<meas name='%s' unit='%s' >%s</meas>" % (name, unit, value))
+    parts.append('</oriondata>')
+    return ''.join(parts)
+
+
+def make_log(log_date, units='us', until=None):
+    """Return the CSV log file for a day with one record per minute up to
+    the time until if given."""
+    start = int(time.mktime(log_date.timetuple()))
+    lines = [','.join(['mtSampTime'] + [name for name, _, _ in MEASUREMENTS])]
+    for ts in range(start, start + 86400, 60):
+        if until is not None and ts > until:
+            break
+        values = [value for _, _, value in measurement_values(ts, units)]
+        lines.append(','.join([time.strftime(TIME_FORMAT, time.localtime(ts))] + values))
+    return '\r\n'.join(lines) + '\r\n'
+
+
+class MicroServerHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # Send the headers and body without waiting for an acknowledgement
+        # which otherwise adds 40ms to every request on a kept-alive
+        # connection.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):
+        sim = self.server.simulator
+        sim.count_request()
+        if sim.latency:
+            time.sleep(sim.latency)
+        path = self.path.split('?')[0]
+        if path == XML_PATH:
+            self.send_xml(sim)
+        elif path == LOGS_PATH:
+            if self.check_auth(sim):
+                self.send_body(sim.logs_page().encode('utf-8'), 'text/html')
+        elif path.startswith('/logs/') and path.endswith('.csv'):
+            if self.check_auth(sim):
+                self.send_log(sim, path.split('/')[-1])
+        else:
+            self.send_error(404)
+
+    def send_xml(self, sim):
+        if sim.fail and random.random() < sim.fail:
+            self.send_error(500)
+            return
+        sample_time = sim.sample_time()
+        headers = []
+        if sim.conditional:
+            etag = '"%d"' % sample_time
+            last_modified = email.utils.formatdate(sample_time, usegmt=True)
+            if etag == self.headers.get('If-None-Match') or last_modified == self.headers.get('If-Modified-Since'):
+                sim.count_not_modified()
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            headers = [('ETag', etag), ('Last-Modified', last_modified)]
+        data = make_xml(sample_time, sim.units)
+        if sim.truncate and random.random() < sim.truncate:
+            data = data[:-len('</oriondata>')] + '</ori'
+        elif sim.nulls and random.random() < sim.nulls:
+            data += '\x00' * 8
+        self.send_body(data.encode('utf-8'), 'text/xml', sim.content_length, headers)
+
+    def send_log(self, sim, filename):
+        log_date = sim.log_dates().get(filename)
+        if log_date is None:
+            self.send_error(404)
+            return
+        until = time.time() if log_date == datetime.date.today() else None
+        data = make_log(log_date, sim.units, until).encode('utf-8')
+        range_header = self.headers.get('Range')
+        if range_header and range_header.startswith('bytes='):
+            offset = int(range_header[6:].split('-')[0])
+            if offset >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (offset, len(data) - 1, len(data)))
+            data = data[offset:]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', '"%s-%d"' % (filename, len(data)))
+        self.end_headers()
+        if sim.truncate and random.random() < sim.truncate:
+            # Drop the connection part way through the file
+            self.wfile.write(data[:len(data) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(data)
+
+    def send_body(self, data, content_type, content_length=True, headers=()):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        for name, value in headers:
+            self.send_header(name, value)
+        if content_length:
+            self.send_header('Content-Length', str(len(data)))
+        else:
+            # Without a length, the end of the body is when the connection
+            # is closed.
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(data)
+
+    def check_auth(self, sim):
+        """Ask for basic authentication if the simulator has a password."""
+        if sim.password is None:
+            return True
+        expected = 'Basic ' + base64.b64encode(('%s:%s' % (sim.user, sim.password)).encode('utf-8')).decode('ascii')
+        if self.headers.get('Authorization') == expected:
+            return True
+        self.send_response(401)
+        self.send_header('WWW-Authenticate', 'Basic realm="MicroServer"')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return False
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MicroServerSimulator(object):
+    """A simulated MicroServer listening on localhost. A port of 0 picks
+    a free port which is then available as port."""
+
+    def __init__(self, port=0, units='us', latency=0.0, truncate=0.0, nulls=0.0,
+                 content_length=True, fail=0.0, log_days=7, user='admin', password=None,
+                 sample_interval=5, conditional=False):
+        self.units = units
+        self.latency = latency
+        self.truncate = truncate
+        self.nulls = nulls
+        self.content_length = content_length
+        self.fail = fail
+        self.log_days = log_days
+        self.user = user
+        self.password = password
+        self.sample_interval = sample_interval
+        self.conditional = conditional
+        self.requests = 0
+        self.not_modified = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), MicroServerHandler)
+        self.server.simulator = self
+        self.port = self.server.server_address[1]
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d%s' % (self.port, XML_PATH)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def count_not_modified(self):
+        with self.lock:
+            self.not_modified += 1
+
+    def sample_time(self):
+        """Time of the latest sample, which like the MicroServer only
+        changes every sample_interval seconds."""
+        now = int(time.time())
+        return now - now % self.sample_interval
+
+    def log_dates(self):
+        """Return the log files available keyed by file name."""
+        today = datetime.date.today()
+        dates = [today - datetime.timedelta(days=n) for n in range(self.log_days)]
+        return dict((log_date.strftime('%Y%m%d.csv'), log_date) for log_date in dates)
+
+    def logs_page(self):
+        links = ['<tr><td><a href="/logs/%s">%s</a></td></tr>' % (filename, filename)
+                 for filename in sorted(self.log_dates())]
+        return '<html><body><table>%s</table></body></html>' % ''.join(links)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def load_test(sim, packets, polls_per_minute, prefetch=False, wind_poll_interval=None):
+    """Run the driver against the simulator until it has returned the given
+    number of packets and print the packet rate and poll timings."""
+    import columbia_ms
+    stn_dict = dict(station_url=sim.url, polls_per_minute=polls_per_minute,
+                    poll_lead_seconds=0, prefetch=prefetch)
+    if wind_poll_interval:
+        stn_dict['wind_poll_interval'] = wind_poll_interval
+    driver = columbia_ms.ColumbiaMicroServerDriver(**stn_dict)
+    source = driver.sources[0]
+    transfer_times = []
+    count = 0
+    requests = source.session.requests
+    start = time.time()
+    for _ in driver.genLoopPackets():
+        count += 1
+        if source.session.requests != requests:
+            requests = source.session.requests
+            transfer_times.append(source.session.transfer_time)
+        if count >= packets:
+            break
+    elapsed = time.time() - start
+    driver.closePort()
+    print("%d packets in %.1fs, %.1f packets/s" % (count, elapsed, count / elapsed))
+    print("%d requests on %d connections, %d not modified" % (
+        source.session.requests, source.session.connects, source.session.not_modified))
+    print("transfer p50 %.4fs p95 %.4fs max %.4fs" % (
+        percentile(transfer_times, 0.5), percentile(transfer_times, 0.95), max(transfer_times or [0.0])))
+
+
+def download_test(sim, log_dir, workers):
+    """Download the simulator's log files and print how long it took."""
+    import columbia_ms
+    downloader = columbia_ms.ColumbiaMicroServerLogDownloader(
+        '127.0.0.1', sim.port, log_dir, sim.user, sim.password, workers)
+    start = time.time()
+    downloaded, skipped, failed = downloader.download()
+    print("%d downloaded, %d skipped, %d failed in %.1fs" % (downloaded, skipped, failed, time.time() - start))
+
+
+if __name__ == '__main__':
+    import optparse
+
+    def main():
+        parser = optparse.OptionParser(usage="%prog [options]")
+        parser.add_option('--port', type=int, default=8080,
+                          help='port to listen on, default 8080')
+        parser.add_option('--units', choices=sorted(UNITS), default='us',
+                          help='unit configuration: us, metric or knots')
+        parser.add_option('--latency', type=float, default=0.0,
+                          help='seconds to wait before each response')
+        parser.add_option('--truncate', type=float, default=0.0,
+                          help='fraction of responses to truncate')
+        parser.add_option('--nulls', type=float, default=0.0,
+                          help='fraction of responses with trailing null bytes')
+        parser.add_option('--no-content-length', dest='content_length', action='store_false',
+                          default=True, help='leave out the Content-Length header')
+        parser.add_option('--fail', type=float, default=0.0,
+                          help='fraction of responses that are HTTP 500 errors')
+        parser.add_option('--log-days', type=int, default=7,
+                          help='number of daily log files available')
+        parser.add_option('--password', help='admin password for the log files')
+        parser.add_option('--load', type=int, metavar='PACKETS',
+                          help='load test the driver for PACKETS loop packets')
+        parser.add_option('--polls-per-minute', type=float, default=600,
+                          help='polls per minute for the load test')
+        parser.add_option('--wind-poll-interval', type=float,
+                          help='seconds between wind polls for the load test')
+        parser.add_option('--conditional', action='store_true',
+                          help='answer conditional requests with 304 Not Modified')
+        parser.add_option('--prefetch', action='store_true',
+                          help='use the prefetch thread for the load test')
+        parser.add_option('--download', metavar='DIR',
+                          help='load test downloading the log files into DIR')
+        parser.add_option('--workers', type=int, default=2,
+                          help='number of log files to download at once')
+        (options, _) = parser.parse_args()
+
+        port = 0 if options.load or options.download else options.port
+        sim = MicroServerSimulator(port, options.units, options.latency, options.truncate,
+                                   options.nulls, options.content_length, options.fail,
+                                   options.log_days, password=options.password,
+                                   conditional=options.conditional).start()
+        if options.load:
+            load_test(sim, options.load, options.polls_per_minute, options.prefetch,
+                      options.wind_poll_interval)
+        elif options.download:
+            download_test(sim, options.download, options.workers)
+        else:
+            print("serving %s" % sim.url)
+            try:
+                while True:
+                    time.sleep(60)
+            except KeyboardInterrupt:
+                pass
+        sim.stop()
+
+    main()
@@ -1,18 +1,1183 @@
+"""Tests for the Columbia MicroServer driver.
+
+Run from the top of the repository with WeeWX on the path:
+
+    PYTHONPATH=bin:bin/user:test python -m unittest discover test
+"""
+
+import ast
+import datetime
+import itertools
+import json
+import os
+import shutil
+import socket
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import unittest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(TEST_DIR), 'bin', 'user'))
+sys.path.insert(0, TEST_DIR)
+
+try:
+    # Python 3
+    from urllib.request import urlopen
+except ImportError:
+    # Python 2
+    from urllib2 import urlopen
+
+try:
+    # Python 3
+    from io import StringIO
+except ImportError:
+    # Python 2
+    from StringIO import StringIO
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import configobj
+except ImportError:
+    configobj = None
+
+import weewx
+import weewx.manager
+import weewx.units
 import columbia_ms
+import columbia_ms_core
+from columbia_ms import ColumbiaMicroServerStation, ColumbiaMicroServerParser, \
+    ColumbiaMicroServerScheduler, ColumbiaMicroServerSession
+import microserver_sim
+
+
+def read_sample(name):
+    with open(os.path.join(TEST_DIR, name)) as f:
+        return f.read()
+
+
+def file_url(name):
+    return 'file://' + os.path.join(TEST_DIR, name)
+
 
 class TestColumbiaMicroServerStation(unittest.TestCase):
 
-    def setUp(self):
-        pass
-    
     def test_get_data_method_returns_results(self):
-        results = ColumbiaMicroServerStation.get_data('file://./latestsampledata_u_us1_fmt.xml')
-        assertTrue(results.startswith('<oriondata'), msg='XML content prefix matches')
-        
-    def test_test(self):
-        pass 
+        results = ColumbiaMicroServerStation.get_data(file_url('latestsampledata_u_us1_fmt.xml'))
+        self.assertTrue(results.startswith('<oriondata'), msg='XML content prefix matches')
+
+    def test_parse_us_sample(self):
+        pkt_grp = ColumbiaMicroServerStation.parse_data(read_sample('latestsampledata_u_us1.xml'))
+        self.assertEqual(pkt_grp['temp']['base_units'], 'degreeF')
+        self.assertEqual(pkt_grp['temp']['mtTemp1'], 7.7)
+        self.assertEqual(pkt_grp['wind']['base_units'], 'mph')
+        self.assertEqual(pkt_grp['rain']['mtRainThisMonth'], 0.6756)
+        self.assertEqual(pkt_grp['pressure']['mtAdjBaromPress'], 30.09)
+        self.assertEqual(pkt_grp['generic']['base_units'], 'generic')
+
+    def test_parse_matches_pretty_printed_sample(self):
+        for name in ('us1', 'us2', 'metric1', 'metric2', 'metric3_knots'):
+            raw = ColumbiaMicroServerStation.parse_data(read_sample('latestsampledata_u_%s.xml' % name))
+            fmt = ColumbiaMicroServerStation.parse_data(read_sample('latestsampledata_u_%s_fmt.xml' % name))
+            self.assertEqual(raw, fmt, msg=name)
+
+    def test_parse_knots_sample(self):
+        pkt_grp = ColumbiaMicroServerStation.parse_data(read_sample('latestsampledata_u_metric3_knots.xml'))
+        self.assertEqual(pkt_grp['wind']['base_units'], 'knots')
+
+    def test_parse_ignores_truncated_closing_tag_and_nulls(self):
+        data = read_sample('latestsampledata_u_us1.xml').rstrip()
+        expected = ColumbiaMicroServerStation.parse_data(data)
+        self.assertEqual(ColumbiaMicroServerStation.parse_data(data[:-len('data>')]), expected)
+        self.assertEqual(ColumbiaMicroServerStation.parse_data(data + '\0' * 16), expected)
+
+    def test_parse_rejects_other_documents(self):
+        self.assertRaises(weewx.WeeWxIOError, ColumbiaMicroServerStation.parse_data, '<html></html>')
+        data = read_sample('latestsampledata_u_us1.xml')
+        self.assertRaises(weewx.WeeWxIOError, ColumbiaMicroServerStation.parse_data,
+                          data[:data.find('mtTemp1') + 20])
+
+    def test_parse_wanted_elements(self):
+        parser = ColumbiaMicroServerParser(ColumbiaMicroServerStation.XML_INPUT_ELEMENTS,
+                                           ColumbiaMicroServerStation.XML_INPUT_UNIT_ELEMENTS,
+                                           wanted=['mtWindSpeed'])
+        pkt_grp = parser.parse(read_sample('latestsampledata_u_us1.xml'))
+        self.assertEqual(list(pkt_grp), ['wind'])
+        self.assertEqual(pkt_grp['wind']['mtWindSpeed'], 0.4)
+        self.assertEqual(pkt_grp['wind']['base_units'], 'mph')
+
+    def test_get_sample_time(self):
+        data = microserver_sim.make_xml(1600000000)
+        self.assertEqual(ColumbiaMicroServerParser.get_sample_time(data), '2020/09/13 12:26:40')
+
+
+class TestColumbiaMicroServerCore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_batch_test_parse(self):
+        shutil.copy(os.path.join(TEST_DIR, 'latestsampledata_u_us1.xml'), self.tmp_dir)
+        with open(os.path.join(self.tmp_dir, 'bad.xml'), 'w') as f:
+            f.write('<html></html>')
+        with open(os.path.join(self.tmp_dir, 'notes.txt'), 'w') as f:
+            f.write('not parsed')
+        recorder = columbia_ms.ColumbiaMicroServerRecorder(os.path.join(self.tmp_dir, 'capture.gz'))
+        recorder.record(1.0, read_sample('latestsampledata_u_metric1.xml'))
+        recorder.record(2.0, read_sample('latestsampledata_u_metric1.xml'))
+        recorder.close()
+        results = list(columbia_ms_core.gen_test_parse([self.tmp_dir]))
+        self.assertEqual([os.path.basename(result['file']) for result in results],
+                         ['bad.xml', 'capture.gz', 'capture.gz', 'latestsampledata_u_us1.xml'])
+        self.assertIn('error', results[0])
+        self.assertEqual([result.get('fetch_time') for result in results], [None, 1.0, 2.0, None])
+        self.assertEqual(results[3]['pkt_grp'],
+                         ColumbiaMicroServerStation.parse_data(read_sample('latestsampledata_u_us1.xml')))
+
+    def test_test_parse_damaged_capture(self):
+        path = os.path.join(self.tmp_dir, 'capture.gz')
+        with open(path, 'wb') as f:
+            f.write(b'not a capture file')
+        results = list(columbia_ms_core.gen_test_parse([path]))
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['file'], path)
+        self.assertIn('error', results[0])
+        out = StringIO()
+        self.assertEqual(columbia_ms_core.test_parse([path], out), 1)
+        # A capture still being written is not damaged
+        recorder = columbia_ms.ColumbiaMicroServerRecorder(path + '.1')
+        recorder.record(1.0, read_sample('latestsampledata_u_metric1.xml'))
+        results = list(columbia_ms_core.gen_test_parse([path + '.1']))
+        recorder.close()
+        self.assertEqual([result.get('fetch_time') for result in results], [1.0])
+        self.assertNotIn('error', results[0])
+
+    def test_imports_without_weewx(self):
+        code = "import sys, columbia_ms_core; sys.exit('weewx' in sys.modules)"
+        env = dict(os.environ, PYTHONPATH=os.path.join(os.path.dirname(TEST_DIR), 'bin', 'user'))
+        self.assertEqual(subprocess.call([sys.executable, '-c', code], env=env), 0)
+
+    def run_driver(self, args, path):
+        script = os.path.join(os.path.dirname(TEST_DIR), 'bin', 'user', 'columbia_ms.py')
+        proc = subprocess.Popen([sys.executable, script] + args, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, env=dict(os.environ, PYTHONPATH=path))
+        out, err = proc.communicate()
+        return proc.returncode, out.decode('utf-8'), err.decode('utf-8')
+
+    def test_command_line(self):
+        path = os.pathsep.join([p for p in sys.path if p])
+        status, out, err = self.run_driver(['--version'], path)
+        self.assertEqual((status, out.strip()), (1, "%s driver version %s" % (
+            columbia_ms_core.DRIVER_SHORT_NAME, columbia_ms_core.DRIVER_VERSION)), err)
+        status, out, err = self.run_driver(
+            ['--test-parse', os.path.join(TEST_DIR, 'latestsampledata_u_us1.xml')], path)
+        self.assertEqual(status, 0, err)
+        self.assertIn('temp', json.loads(out))
+
+    def test_command_line_without_weewx(self):
+        # The script's own directory is on the path, WeeWX is not
+        status, out, err = self.run_driver(
+            ['--test-parse=' + os.path.join(TEST_DIR, 'latestsampledata_u_us1.xml')], '')
+        self.assertEqual(status, 0, err)
+        self.assertIn('temp', json.loads(out))
+
+
+class TestColumbiaMicroServerFieldMap(unittest.TestCase):
+
+    INPUT_ELEMENTS = {'mtWetBulbGlobeTemp': 'temp', 'mtDegreeDay': 'generic'}
+    SENSOR_MAP = {'extraTemp4': 'mtWetBulbGlobeTemp', 'growingDegreeDays': 'mtDegreeDay'}
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def get_packet(self, source):
+        source.poll()
+        packet = dict()
+        for pkt in source.gen_packets(source.pkt_grp, True, True):
+            packet.update(pkt)
+        return packet
+
+    def test_input_elements_from_config(self):
+        source = columbia_ms.ColumbiaMicroServerSource(None, {
+            'station_url': file_url('latestsampledata_u_us1.xml'),
+            'input_elements': self.INPUT_ELEMENTS, 'sensor_map': self.SENSOR_MAP}, 15.0)
+        packet = self.get_packet(source)
+        self.assertEqual(packet['extraTemp4'], 26.4)
+        self.assertEqual(packet['growingDegreeDays'], 5237.3)
+        self.assertEqual(packet['outTemp'], 7.7)
+
+    def test_reconfigure_keeps_rain_total(self):
+        stn_dict = {'station_url': file_url('latestsampledata_u_us1.xml')}
+        source = columbia_ms.ColumbiaMicroServerSource(None, stn_dict, 15.0)
+        self.assertNotIn('extraTemp4', self.get_packet(source))
+        rain_total = source.last_rain_total
+        self.assertIsNotNone(rain_total)
+        self.assertFalse(source.reconfigure(stn_dict))
+        self.assertTrue(source.reconfigure(dict(stn_dict, input_elements=self.INPUT_ELEMENTS,
+                                                sensor_map=self.SENSOR_MAP)))
+        self.assertEqual(source.last_rain_total, rain_total)
+        packet = self.get_packet(source)
+        self.assertEqual(packet['extraTemp4'], 26.4)
+        self.assertEqual(packet['rain'], 0.0)
+
+    @unittest.skipIf(configobj is None, "needs configobj")
+    def test_driver_reloads_changed_config(self):
+        path = os.path.join(self.tmp_dir, 'weewx.conf')
+        config = configobj.ConfigObj(path)
+        config['ColumbiaMicroServer'] = {'station_url': file_url('latestsampledata_u_us1.xml')}
+        config.write()
+        driver = columbia_ms.ColumbiaMicroServerDriver(config_path=path, watch_config=True,
+                                                      **config['ColumbiaMicroServer'])
+        source = driver.sources[0]
+        config['ColumbiaMicroServer']['input_elements'] = self.INPUT_ELEMENTS
+        config['ColumbiaMicroServer']['sensor_map'] = self.SENSOR_MAP
+        config.write()
+        os.utime(path, (driver.config_mtime + 10, driver.config_mtime + 10))
+        driver.next_config_check = 0.0
+        driver._check_config()
+        self.assertIs(driver.sources[0], source)
+        self.assertIn('extraTemp4', source.fields)
+
+    @unittest.skipIf(configobj is None, "needs configobj")
+    def test_driver_retries_damaged_config(self):
+        path = os.path.join(self.tmp_dir, 'weewx.conf')
+        config = configobj.ConfigObj(path)
+        config['ColumbiaMicroServer'] = {'station_url': file_url('latestsampledata_u_us1.xml')}
+        config.write()
+        driver = columbia_ms.ColumbiaMicroServerDriver(config_path=path, watch_config=True,
+                                                      **config['ColumbiaMicroServer'])
+        mtime = driver.config_mtime
+        with open(path, 'a') as f:
+            f.write('[[input_elements\n')
+        os.utime(path, (mtime + 10, mtime + 10))
+        driver.next_config_check = 0.0
+        driver._check_config()
+        # The file is read again at the next check once it is whole
+        self.assertEqual(driver.config_mtime, mtime)
+        config['ColumbiaMicroServer']['input_elements'] = self.INPUT_ELEMENTS
+        config['ColumbiaMicroServer']['sensor_map'] = self.SENSOR_MAP
+        config.write()
+        os.utime(path, (mtime + 10, mtime + 10))
+        driver.next_config_check = 0.0
+        driver._check_config()
+        self.assertEqual(driver.config_mtime, mtime + 10)
+        self.assertIn('extraTemp4', driver.sources[0].fields)
+
+    def test_changed_options_need_restart(self):
+        running = {'station_url': 'http://a/', 'poll_interval': '15', 'config_path': '/etc/weewx/weewx.conf',
+                   'archive_interval': 300, 'sensor_map': {'outTemp': 'mtTemp1'}}
+        reloaded = {'station_url': 'http://a/', 'poll_interval': '5', 'sensor_map': self.SENSOR_MAP,
+                    'input_elements': self.INPUT_ELEMENTS}
+        self.assertEqual(columbia_ms.ColumbiaMicroServerDriver._changed_options(running, reloaded),
+                         ['poll_interval'])
+        reloaded['archive_interval'] = '600'
+        del reloaded['station_url']
+        self.assertEqual(columbia_ms.ColumbiaMicroServerDriver._changed_options(running, reloaded),
+                         ['archive_interval', 'poll_interval', 'station_url'])
+
+
+class TestColumbiaMicroServerTranslation(unittest.TestCase):
+
+    def get_packets(self, source, name):
+        pkt_grp = ColumbiaMicroServerStation.parse_data(read_sample(name))
+        return list(source.gen_packets(pkt_grp, True, True, 1600000000))
+
+    def test_knots_converted_to_mph(self):
+        source = columbia_ms.ColumbiaMicroServerSource(None, {'station_url': file_url('x.xml')}, 15.0)
+        packets = self.get_packets(source, 'latestsampledata_u_metric3_knots.xml')
+        wind = [packet for packet in packets if 'windSpeed' in packet][0]
+        self.assertEqual(wind['usUnits'], weewx.US)
+        self.assertAlmostEqual(wind['windSpeed'], 0.7 * 1.15077945, places=6)
+        self.assertAlmostEqual(wind['windGust'], 1.5 * 1.15077945, places=6)
+        # Directions aren't speeds
+        self.assertEqual(wind['windDir'], 111.0)
+        # The temperatures in this sample have no units so they are dropped
+        self.assertFalse([packet for packet in packets if 'outTemp' in packet])
+
+    def test_translation_built_once_per_units(self):
+        source = columbia_ms.ColumbiaMicroServerSource(
+            None, {'station_url': file_url('x.xml'), 'field_prefix': 'roof_'}, 15.0)
+        self.get_packets(source, 'latestsampledata_u_us1.xml')
+        translations = dict(source.field_map.translations)
+        packets = self.get_packets(source, 'latestsampledata_u_us2.xml')
+        for key, translation in source.field_map.translations.items():
+            self.assertIs(translation, translations[key])
+        self.assertIn('roof_outTemp', [field for packet in packets for field in packet])
+        # New units get a translation of their own
+        self.get_packets(source, 'latestsampledata_u_metric1.xml')
+        self.assertGreater(len(source.field_map.translations), len(translations))
+        self.assertEqual(source.field_map.translations[('wind', 'kmPerHour')].us_units, weewx.METRIC)
+
+
+class TestColumbiaMicroServerSkipUnchanged(unittest.TestCase):
+
+    def get_packets(self, source, data, full=True):
+        source.process(data, full)
+        return list(source.gen_packets(source.pkt_grp, source.new_sample, full, 1600000000))
+
+    def test_unchanged_sample_not_returned_again(self):
+        source = columbia_ms.ColumbiaMicroServerSource(
+            None, {'station_url': file_url('x.xml'), 'skip_unchanged': True}, 15.0)
+        self.assertTrue(self.get_packets(source, microserver_sim.make_xml(1600000000)))
+        self.assertTrue(source.new_sample)
+        self.assertEqual(self.get_packets(source, microserver_sim.make_xml(1600000000)), [])
+        self.assertFalse(source.new_sample)
+        # A new sample is parsed and returned
+        packets = self.get_packets(source, microserver_sim.make_xml(1600000005))
+        self.assertTrue(source.new_sample)
+        self.assertTrue(any('outTemp' in packet for packet in packets))
+
+    def test_full_poll_after_wind_parses_again(self):
+        source = columbia_ms.ColumbiaMicroServerSource(
+            None, {'station_url': file_url('x.xml'), 'skip_unchanged': True}, 15.0)
+        data = microserver_sim.make_xml(1600000000)
+        packets = self.get_packets(source, data, full=False)
+        self.assertFalse(any('outTemp' in packet for packet in packets))
+        # The same sample at the last poll of the minute still has to give
+        # everything besides the wind already returned.
+        packets = self.get_packets(source, data)
+        self.assertTrue(any('outTemp' in packet for packet in packets))
+        self.assertFalse(any('windSpeed' in packet for packet in packets))
+
+    def test_off_by_default(self):
+        source = columbia_ms.ColumbiaMicroServerSource(None, {'station_url': file_url('x.xml')}, 15.0)
+        data = microserver_sim.make_xml(1600000000)
+        first = self.get_packets(source, data)
+        again = self.get_packets(source, data)
+        self.assertEqual([sorted(packet) for packet in again], [sorted(packet) for packet in first])
+
+
+class TestColumbiaMicroServerScheduler(unittest.TestCase):
+
+    def test_next_deadline_last_poll_leads_minute(self):
+        scheduler = ColumbiaMicroServerScheduler(15.0, 5.0)
+        self.assertEqual(scheduler.next_deadline(1200.0), (1210.0, False))
+        self.assertEqual(scheduler.next_deadline(1210.0), (1225.0, False))
+        self.assertEqual(scheduler.next_deadline(1240.0), (1255.0, True))
+        self.assertEqual(scheduler.next_deadline(1250.0), (1255.0, True))
+
+    def test_next_deadline_always_advances(self):
+        for interval in (0.05, 0.1, 1.0, 60.0 / 7, 15.0, 60.0):
+            scheduler = ColumbiaMicroServerScheduler(interval, 5.0)
+            after = 1600000000.123
+            lasts = 0
+            for _ in range(int(round(180 / interval))):
+                deadline, last = scheduler.next_deadline(after)
+                self.assertTrue(deadline > after, msg='interval %s' % interval)
+                lasts += last
+                after = deadline
+            self.assertEqual(lasts, 3, msg='interval %s' % interval)
+
+
+class TestColumbiaMicroServerBreaker(unittest.TestCase):
+
+    def test_opens_after_quick_retries(self):
+        breaker = columbia_ms.ColumbiaMicroServerBreaker('roof', 2, 15.0, 300.0)
+        for _ in range(2):
+            self.assertTrue(breaker.allow())
+            breaker.failure('timed out')
+            self.assertEqual(breaker.state, breaker.CLOSED)
+        breaker.failure('timed out')
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertFalse(breaker.allow())
+
+    def test_half_open_then_closed(self):
+        breaker = columbia_ms.ColumbiaMicroServerBreaker('roof', 0, 15.0, 300.0)
+        breaker.failure('timed out')
+        breaker.retry_at = 0.0
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        breaker.failure('timed out')
+        self.assertEqual(breaker.state, breaker.OPEN)
+        breaker.retry_at = 0.0
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        self.assertEqual(breaker.failures, 0)
+        self.assertTrue(breaker.allow())
+
+    def test_backoff_is_capped(self):
+        breaker = columbia_ms.ColumbiaMicroServerBreaker('roof', 3, 15.0, 300.0)
+        breaker.failures = 4
+        self.assertTrue(7.5 <= breaker.backoff() <= 15.0)
+        breaker.failures = 100
+        self.assertTrue(150.0 <= breaker.backoff() <= 300.0)
+
+
+class TestColumbiaMicroServerStations(unittest.TestCase):
+
+    def test_stations_polled_concurrently(self):
+        roof = microserver_sim.MicroServerSimulator(latency=0.3).start()
+        garden = microserver_sim.MicroServerSimulator(latency=0.3, units='metric').start()
+        try:
+            driver = columbia_ms.ColumbiaMicroServerDriver(
+                polls_per_minute=4, poll_lead_seconds=0,
+                stations={'roof': {'station_url': roof.url},
+                          'garden': {'station_url': garden.url, 'field_prefix': 'garden_',
+                                     'sensor_map': {'extraTemp1': 'mtTemp1'}}})
+            self.assertEqual([source.name for source in driver.sources], ['roof', 'garden'])
+            start = time.time()
+            results, last_poll_this_minute = next(driver._gen_polls())
+            # The two stations are waited on together
+            self.assertLess(time.time() - start, 0.55)
+            self.assertTrue(last_poll_this_minute)
+            self.assertEqual(len(results), 2)
+            packets = list(driver._gen_packets(results, last_poll_this_minute))
+            fields = set(field for packet in packets for field in packet)
+            self.assertIn('outTemp', fields)
+            self.assertIn('garden_outTemp', fields)
+            self.assertIn('garden_extraTemp1', fields)
+            # Each station keeps its own units
+            self.assertEqual([packet['usUnits'] for packet in packets if 'outTemp' in packet], [weewx.US])
+            self.assertEqual([packet['usUnits'] for packet in packets if 'garden_outTemp' in packet],
+                             [weewx.METRICWX])
+            driver.closePort()
+        finally:
+            roof.stop()
+            garden.stop()
+
+    def test_station_that_never_responds_fails(self):
+        roof = microserver_sim.MicroServerSimulator().start()
+        garden = microserver_sim.MicroServerSimulator(latency=5.0).start()
+        try:
+            driver = columbia_ms.ColumbiaMicroServerDriver(
+                polls_per_minute=600, poll_lead_seconds=0, timeout=0.3, quick_retries=1,
+                stations={'roof': {'station_url': roof.url},
+                          'garden': {'station_url': garden.url, 'field_prefix': 'garden_'}})
+            roof_source, garden_source = driver.sources
+            polls = driver._gen_polls()
+            for _ in range(2):
+                results, _ = next(polls)
+                self.assertEqual([source for source, _, _ in results], [roof_source])
+            self.assertEqual(garden_source.ntries, 2)
+            self.assertEqual(garden_source.breaker.state, garden_source.breaker.OPEN)
+            self.assertEqual(roof_source.breaker.state, roof_source.breaker.CLOSED)
+            driver.closePort()
+        finally:
+            roof.stop()
+            garden.stop()
+
+
+class TestColumbiaMicroServerPrefetch(unittest.TestCase):
+
+    def make_driver(self, **stn_dict):
+        driver = columbia_ms.ColumbiaMicroServerDriver(
+            station_url=file_url('latestsampledata_u_us1.xml'), prefetch=True, **stn_dict)
+        source = driver.sources[0]
+        source.poll()
+        # Stand in for the prefetch thread so the test fills the queue
+        driver.prefetch_thread = threading.current_thread()
+        return driver, source
+
+    def test_stale_last_poll_carried_into_next(self):
+        driver, source = self.make_driver(max_data_age=5, stats=True)
+        full = source.pkt_grp
+        now = time.time()
+        driver.prefetch_queue.put((now - 60, [(source, full, True)], True))
+        driver.prefetch_queue.put((now, [(source, {'wind': full['wind']}, False)], False))
+        packets = list(itertools.islice(driver._gen_prefetched_packets(), len(full)))
+        self.assertEqual(driver.prefetch_dropped_stale, 1)
+        self.assertEqual(driver.stats.summarize_prefetch()[1], {'full': 0, 'stale': 1})
+        # The once-a-minute data of the dropped poll is returned with the
+        # wind of the next one.
+        self.assertTrue(any('outTemp' in packet for packet in packets))
+        self.assertTrue(any('rain' in packet for packet in packets))
+        self.assertTrue(any('windSpeed' in packet for packet in packets))
+
+    def test_full_queue_keeps_last_poll(self):
+        driver, source = self.make_driver(prefetch_depth=1)
+        full = source.pkt_grp
+        wind = {'wind': full['wind']}
+        polls = iter([([(source, full, True)], True), ([(source, wind, False)], False)])
+        driver._gen_polls = lambda: polls
+        driver._prefetch()
+        self.assertEqual(driver.prefetch_dropped_full, 1)
+        _, results, last_poll_this_minute = driver.prefetch_queue.get_nowait()
+        self.assertTrue(last_poll_this_minute)
+        self.assertEqual(sorted(results[0][1]), sorted(full))
+        self.assertTrue(results[0][2])
+
+    def test_polls_ahead_of_deadline(self):
+        sim = microserver_sim.MicroServerSimulator(latency=0.2).start()
+        try:
+            driver = columbia_ms.ColumbiaMicroServerDriver(
+                station_url=sim.url, polls_per_minute=60, poll_lead_seconds=0, prefetch=True)
+            packets = driver.genLoopPackets()
+            lateness = []
+            # The first poll is made at once, the rest at their deadlines
+            for _ in range(4):
+                packet = next(packets)
+                while 'windSpeed' not in packet:
+                    packet = next(packets)
+                # How long after its deadline each poll is returned
+                if driver.scheduler.deadline is not None:
+                    lateness.append(time.time() - driver.scheduler.deadline)
+            driver.closePort()
+        finally:
+            sim.stop()
+        self.assertGreaterEqual(driver.poll_ahead, 0.2)
+        # Once the time a poll takes is known, it is ready at the deadline
+        # rather than the 0.2s the MicroServer takes after it.
+        self.assertEqual(len(lateness), 3)
+        self.assertLess(max(lateness), 0.1)
+
+    def test_scheduler_wakes_ahead(self):
+        scheduler = ColumbiaMicroServerScheduler(0.5, 0.0)
+        scheduler.wait()
+        scheduler.wait(ahead=0.2)
+        self.assertAlmostEqual(time.time(), scheduler.deadline - 0.2, delta=0.05)
+
+
+class TestColumbiaMicroServerSession(unittest.TestCase):
+
+    def setUp(self):
+        self.sim = microserver_sim.MicroServerSimulator()
+        self.sim.start()
+
+    def tearDown(self):
+        self.sim.stop()
+
+    def test_connection_is_kept_alive(self):
+        session = ColumbiaMicroServerSession(self.sim.url)
+        for _ in range(3):
+            self.assertTrue(session.get_data().startswith('<oriondata'))
+        self.assertEqual(session.connects, 1)
+        self.assertEqual(session.requests, 3)
+        session.close()
+
+    def test_reconnects_after_connection_dropped(self):
+        session = ColumbiaMicroServerSession(self.sim.url)
+        session.get_data()
+        session.connection.sock.close()
+        self.assertTrue(session.get_data().startswith('<oriondata'))
+        self.assertEqual(session.connects, 2)
+        session.close()
+
+    def test_probe(self):
+        session = ColumbiaMicroServerSession(self.sim.url)
+        self.assertTrue(session.probe())
+        self.sim.stop()
+        self.assertFalse(session.probe())
+
+    def test_server_error(self):
+        self.sim.fail = 1.0
+        session = ColumbiaMicroServerSession(self.sim.url)
+        self.assertRaises(weewx.WeeWxIOError, session.get_data)
+        session.close()
+
+    def test_truncated_response_parses(self):
+        self.sim.truncate = 1.0
+        session = ColumbiaMicroServerSession(self.sim.url)
+        pkt_grp = ColumbiaMicroServerStation.parse_data(session.get_data())
+        self.assertIn('mtAdjBaromPress', pkt_grp['pressure'])
+        session.close()
+
+    def test_urlopen_without_content_length(self):
+        self.sim.content_length = False
+        data = ColumbiaMicroServerStation.get_data(self.sim.url)
+        self.assertTrue(data.rstrip().endswith('</oriondata>'))
+
+    def test_conditional_request_not_modified(self):
+        self.sim.conditional = True
+        self.sim.sample_interval = 3600
+        session = ColumbiaMicroServerSession(self.sim.url)
+        self.assertTrue(session.get_data().startswith('<oriondata'))
+        self.assertIsNone(session.get_data())
+        self.assertEqual(session.not_modified, 1)
+        self.assertEqual(self.sim.not_modified, 1)
+        session.close()
+
+    def test_not_modified_after_damaged_response(self):
+        self.sim.conditional = True
+        self.sim.sample_interval = 3600
+        source = columbia_ms.ColumbiaMicroServerSource(None, {'station_url': self.sim.url}, 1.0)
+        get_data = source.session.get_data
+        # Cut short in the middle of a wanted element
+        source.session.get_data = lambda: get_data().split("mtWindSpeed' unit=")[0] + "mtWindSpeed' unit="
+        source.poll()
+        self.assertIsInstance(source.error, weewx.WeeWxIOError)
+        # The next request is not conditional on the damaged response
+        source.session.get_data = get_data
+        source.poll()
+        self.assertIsNone(source.error)
+        self.assertEqual(self.sim.not_modified, 0)
+        self.assertIn('temp', source.pkt_grp)
+        source.session.close()
+
+    def test_not_modified_without_earlier_data(self):
+        self.sim.conditional = True
+        self.sim.sample_interval = 3600
+        source = columbia_ms.ColumbiaMicroServerSource(None, {'station_url': self.sim.url}, 1.0)
+        source.session.get_data()
+        source.poll()
+        self.assertIsInstance(source.error, weewx.WeeWxIOError)
+        self.assertIsNone(source.session.etag)
+        source.poll()
+        self.assertIsNone(source.error)
+        source.session.close()
+
+    def test_wind_only_polls(self):
+        self.sim.conditional = True
+        self.sim.sample_interval = 3600
+        source = columbia_ms.ColumbiaMicroServerSource(None, {'station_url': self.sim.url}, 1.0)
+        source.poll(False)
+        self.assertEqual(list(source.pkt_grp), ['wind'])
+        self.assertTrue(source.new_sample)
+        # Not modified, so the full parse is made from the previous data
+        source.poll(True)
+        self.assertEqual(source.bytes, 0)
+        self.assertFalse(source.new_sample)
+        self.assertTrue(set(['wind', 'temp', 'rain']) <= set(source.pkt_grp))
+        packets = list(source.gen_packets(source.pkt_grp, source.new_sample, True))
+        self.assertEqual(len(packets), len(source.pkt_grp))
+        # and reused by the next wind poll without parsing again
+        pkt_grp = source.pkt_grp
+        source.poll(False)
+        self.assertIs(source.pkt_grp, pkt_grp)
+        source.session.close()
+
+
+class TestColumbiaMicroServerStats(unittest.TestCase):
+
+    def test_ring_keeps_last_values(self):
+        stats = columbia_ms.ColumbiaMicroServerStats(size=10)
+        for value in range(100):
+            stats.record('roof', 'parse', value / 1000.0)
+        _, _, metrics = stats.summarize()['roof']
+        self.assertEqual(metrics['parse'], [0.095, 0.099, 0.099])
+
+    def test_prometheus(self):
+        stats = columbia_ms.ColumbiaMicroServerStats()
+        stats.record('roof', 'bytes', 2979)
+        text = stats.prometheus()
+        self.assertIn('columbia_ms_polls_total{station="roof"} 0', text)
+        self.assertIn('columbia_ms_poll_bytes{station="roof",quantile="0.95"} 2979.0', text)
+        self.assertIn('columbia_ms_poll_bytes_max{station="roof"} 2979.0', text)
+        self.assertIn('# TYPE columbia_ms_poll_bytes summary', text)
+        self.assertIn('columbia_ms_poll_bytes_count{station="roof"} 1', text)
+        self.assertIn('# TYPE columbia_ms_poll_bytes_max gauge', text)
+        self.assertIn('# HELP columbia_ms_poll_bytes_max ', text)
+
+    def test_prefetch(self):
+        stats = columbia_ms.ColumbiaMicroServerStats()
+        self.assertEqual(stats.summary(), [])
+        self.assertNotIn('prefetch', stats.prometheus())
+        stats.record_prefetch(1, 0.25, 0, 0)
+        stats.record_prefetch(0, 20.0, 2, 1)
+        self.assertEqual(stats.summary(), ['prefetch: dropped 2 full 1 stale; '
+                                           'depth p50 1 p95 1 max 1; staleness p50 20.000s p95 20.000s max 20.000s'])
+        text = stats.prometheus()
+        self.assertIn('columbia_ms_prefetch_dropped_total{reason="full"} 2', text)
+        self.assertIn('columbia_ms_prefetch_dropped_total{reason="stale"} 1', text)
+        self.assertIn('# TYPE columbia_ms_prefetch_staleness_seconds summary', text)
+        self.assertIn('columbia_ms_prefetch_staleness_seconds_count 2', text)
+        self.assertIn('columbia_ms_prefetch_staleness_seconds_max 20.0', text)
+        self.assertIn('columbia_ms_prefetch_depth_sum 1.0', text)
+
+    def test_metrics_server_starts_with_loop_packets(self):
+        sim = microserver_sim.MicroServerSimulator().start()
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        try:
+            stn_dict = {'station_url': sim.url, 'metrics_port': port}
+            driver = columbia_ms.ColumbiaMicroServerDriver(**stn_dict)
+            next(driver.genLoopPackets())
+            self.assertIsNotNone(driver.metrics_server)
+            # Another driver, such as one made by wee_device, doesn't need the port
+            tool = columbia_ms.ColumbiaMicroServerDriver(**stn_dict)
+            self.assertIsNone(tool.metrics_server)
+            tool.closePort()
+            text = urlopen('http://127.0.0.1:%d/metrics' % port).read().decode('utf-8')
+            self.assertIn('columbia_ms_polls_total', text)
+            driver.closePort()
+        finally:
+            sim.stop()
+
+
+class TestColumbiaMicroServerShare(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'share.json')
+        self.sim = microserver_sim.MicroServerSimulator()
+        self.sim.start()
+
+    def tearDown(self):
+        self.sim.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_publish_and_read(self):
+        share = columbia_ms.ColumbiaMicroServerShare(self.path)
+        source = columbia_ms.ColumbiaMicroServerSource('roof', {'station_url': self.sim.url}, 15.0)
+        source.poll()
+        share.publish([(source, source.pkt_grp, True)], 1000.0)
+        # A wind-only poll keeps the other groups
+        share.publish([(source, {'wind': {'mtWindSpeed': 1.5}}, True)], 1015.0)
+        source.session.close()
+        shared = columbia_ms.ColumbiaMicroServerShare.read(self.path)
+        self.assertEqual(shared['seq'], 2)
+        latest = shared['stations']['roof']
+        self.assertEqual(latest['time'], 1015.0)
+        self.assertEqual(latest['pkt_grp']['wind'], {'mtWindSpeed': 1.5})
+        self.assertEqual(latest['pkt_grp']['temp'], source.pkt_grp['temp'])
+        self.assertIsNone(columbia_ms.ColumbiaMicroServerShare.read(self.path, max_age=60))
+
+    def test_wind_only_polls_written_at_most_once_a_second(self):
+        share = columbia_ms.ColumbiaMicroServerShare(self.path)
+        source = columbia_ms.ColumbiaMicroServerSource('roof', {'station_url': self.sim.url}, 15.0)
+        source.poll()
+        source.session.close()
+        share.publish([(source, source.pkt_grp, True)], 1000.0)
+        share.publish([(source, {'wind': {'mtWindSpeed': 1.5}}, False)], 1000.5)
+        self.assertEqual(columbia_ms.ColumbiaMicroServerShare.read(self.path)['seq'], 1)
+        share.publish([(source, {'wind': {'mtWindSpeed': 2.5}}, False)], 1001.0)
+        shared = columbia_ms.ColumbiaMicroServerShare.read(self.path)
+        self.assertEqual((shared['seq'], shared['stations']['roof']['pkt_grp']['wind']), (3, {'mtWindSpeed': 2.5}))
+        # A full poll is always written
+        share.publish([(source, source.pkt_grp, True)], 1001.1)
+        self.assertEqual(columbia_ms.ColumbiaMicroServerShare.read(self.path)['seq'], 4)
+        share.close()
+        self.assertIsNone(columbia_ms.ColumbiaMicroServerShare.read(self.path))
+
+    def test_driver_publishes(self):
+        driver = columbia_ms.ColumbiaMicroServerDriver(station_url=self.sim.url, share_file=self.path)
+        next(driver.genLoopPackets())
+        shared = columbia_ms.ColumbiaMicroServerShare.read(self.path, max_age=60)
+        self.assertEqual(shared['seq'], 1)
+        self.assertEqual(list(shared['stations']), [driver.sources[0].name])
+        driver.closePort()
+        self.assertFalse(os.path.exists(self.path))
+
+
+    def test_current_from_share(self):
+        driver = columbia_ms.ColumbiaMicroServerDriver(station_url=self.sim.url, share_file=self.path)
+        source = driver.sources[0]
+        next(driver.genLoopPackets())
+        rain_total = source.pkt_grp['rain']['mtRainThisMonth']
+        source.last_rain_total = rain_total - 0.25
+        driver.share.publish([(source, source.pkt_grp, True)])
+        shared = columbia_ms.ColumbiaMicroServerShare.read(self.path)
+        tool = columbia_ms.ColumbiaMicroServerDriver(**columbia_ms.get_tool_stn_dict(
+            {'station_url': self.sim.url, 'share_file': self.path}))
+        self.assertIsNone(tool.share)
+        stdout = sys.stdout
+        sys.stdout = output = StringIO()
+        try:
+            columbia_ms.ColumbiaMicroServerConfigurator.show_current(tool, shared)
+        finally:
+            sys.stdout = stdout
+        packets = [ast.literal_eval(line) for line in output.getvalue().splitlines()]
+        self.assertAlmostEqual([packet['rain'] for packet in packets if 'rain' in packet][0], 0.25)
+        self.assertEqual(tool.sources[0].last_rain_total, rain_total)
+        # The tool's own poll when the shared data is too old leaves the share alone
+        next(tool.genLoopPackets())
+        self.assertEqual(columbia_ms.ColumbiaMicroServerShare.read(self.path)['seq'], 2)
+        tool.closePort()
+        driver.closePort()
+
+
+class TestColumbiaMicroServerRecorder(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'capture.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_read_back(self):
+        recorder = columbia_ms.ColumbiaMicroServerRecorder(self.path)
+        first = microserver_sim.make_xml(1600000000)
+        second = microserver_sim.make_xml(1600000005)
+        for fetch_time, data in ((1.0, first), (2.0, first), (3.0, second)):
+            recorder.record(fetch_time, data)
+        recorder.close()
+        records = list(columbia_ms.ColumbiaMicroServerRecorder.read(self.path))
+        self.assertEqual(records, [(1.0, first), (2.0, first), (3.0, second)])
+
+    def test_rotate(self):
+        recorder = columbia_ms.ColumbiaMicroServerRecorder(self.path, max_bytes=2000, backups=2)
+        for n in range(100):
+            recorder.record(float(n), microserver_sim.make_xml(1600000000 + n * 5))
+        recorder.close()
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['capture.gz', 'capture.gz.1', 'capture.gz.2'])
+        # Every file starts with a full record
+        for name in os.listdir(self.tmp_dir):
+            records = list(columbia_ms.ColumbiaMicroServerRecorder.read(os.path.join(self.tmp_dir, name)))
+            self.assertTrue(records[0][1].startswith('<oriondata'))
+
+    def test_replay(self):
+        recorder = columbia_ms.ColumbiaMicroServerRecorder(self.path)
+        for n in range(4):
+            recorder.record(1600000000.0 + n * 15, microserver_sim.make_xml(1600000000 + n * 15))
+        recorder.close()
+        driver = columbia_ms.ColumbiaMicroServerDriver(replay_file=self.path)
+        packets = list(driver.genLoopPackets())
+        # Everything from the first response, then only wind as the capture
+        # ends before the last poll of the next minute.
+        self.assertEqual([packet['dateTime'] for packet in packets if 'windSpeed' in packet],
+                         [1600000000, 1600000015, 1600000030, 1600000045])
+        self.assertEqual(len([packet for packet in packets if 'outTemp' in packet]), 1)
+
+
+class TestColumbiaMicroServerCatchup(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_aggregate(self):
+        catchup = columbia_ms.ColumbiaMicroServerCatchup(
+            {'log_dir': self.tmp_dir, 'admin_password': 'secret'}, 300)
+        start = 1600000200
+        records = [{'dateTime': ts, 'usUnits': weewx.US, 'interval': 1, 'outTemp': float(ts - start)}
+                   for ts in range(start + 60, start + 960, 60)]
+        archive = list(catchup.aggregate(records, start + 300, start + 1000))
+        # The interval ending at since_ts is skipped as is the one at the
+        # end that the log records don't yet fill.
+        self.assertEqual([record['dateTime'] for record in archive], [start + 600, start + 900])
+        self.assertEqual(archive[0]['interval'], 5)
+        self.assertAlmostEqual(archive[0]['outTemp'], 480.0)
+
+    def test_catchup_only_at_startup(self):
+        sim = microserver_sim.MicroServerSimulator(log_days=2, password='secret').start()
+        try:
+            driver = columbia_ms.ColumbiaMicroServerDriver(
+                station_url=sim.url, host='127.0.0.1', port=sim.port, admin_password='secret',
+                log_dir=self.tmp_dir, archive_interval=300)
+            now = int(time.time())
+            records = list(driver.genStartupRecords(now - 3600))
+            self.assertTrue(records)
+            self.assertTrue(all(record['dateTime'] > now - 3600 for record in records))
+            requests = sim.requests
+            # At the end of each archive period WeeWX makes the record itself
+            self.assertRaises(NotImplementedError, driver.genArchiveRecords, records[-1]['dateTime'])
+            self.assertEqual(sim.requests, requests)
+            driver.closePort()
+        finally:
+            sim.stop()
+
+    def test_day_cache(self):
+        cache = columbia_ms.ColumbiaMicroServerDayCache(os.path.join(self.tmp_dir, 'cache'))
+        path = os.path.join(self.tmp_dir, '20200913.csv')
+        with open(path, 'w') as f:
+            f.write('mtSampTime\n')
+        records = [{'dateTime': 1600000000 + n * 60, 'usUnits': weewx.US, 'interval': 1, 'outTemp': 60.0 + n}
+                   for n in range(10)]
+        del records[3]['outTemp']
+        reads = []
+
+        def read(read_path, us_units):
+            reads.append(read_path)
+            return records
+
+        self.assertEqual(cache.get(path, weewx.US, read), records)
+        self.assertEqual(cache.get(path, weewx.US, read), records)
+        self.assertEqual(len(reads), 1)
+        self.assertEqual(cache.get(path, weewx.US, read, 1600000120, 1600000300), records[3:6])
+        self.assertEqual(cache.get(path, weewx.US, read, 1600000540), [])
+        self.assertEqual(cache.entry(path, weewx.US)['last'], 1600000540)
+        # A new cache finds the day through the index
+        cache = columbia_ms.ColumbiaMicroServerDayCache(os.path.join(self.tmp_dir, 'cache'))
+        self.assertEqual(cache.get(path, weewx.US, read), records)
+        self.assertEqual(len(reads), 1)
+        with open(path, 'a') as f:
+            f.write('2020/09/13 12:26:40\n')
+        cache.get(path, weewx.US, read)
+        self.assertEqual(len(reads), 2)
+
+    def test_day_cache_per_unit_system(self):
+        cache = columbia_ms.ColumbiaMicroServerDayCache(os.path.join(self.tmp_dir, 'cache'))
+        path = os.path.join(self.tmp_dir, '20200913.csv')
+        with open(path, 'w') as f:
+            f.write('mtSampTime\n')
+        reads = []
+
+        def read(read_path, us_units):
+            reads.append(us_units)
+            return [{'dateTime': 1600000000, 'usUnits': us_units, 'interval': 1,
+                     'outTemp': 60.0 if us_units == weewx.US else 15.6}]
+
+        # As when catch-up and an import into a metric database take turns
+        for _ in range(2):
+            self.assertEqual(cache.get(path, weewx.US, read)[0]['outTemp'], 60.0)
+            self.assertEqual(cache.get(path, weewx.METRICWX, read)[0]['outTemp'], 15.6)
+        self.assertEqual(reads, [weewx.US, weewx.METRICWX])
+        self.assertEqual(cache.get(path, weewx.METRICWX, read)[0]['usUnits'], weewx.METRICWX)
+
+
+class TestColumbiaMicroServerLogDownloader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.sim = microserver_sim.MicroServerSimulator(log_days=3, password='secret').start()
+
+    def tearDown(self):
+        self.sim.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def downloader(self):
+        return columbia_ms.ColumbiaMicroServerLogDownloader(
+            '127.0.0.1', self.sim.port, self.tmp_dir, password='secret', timeout=5)
+
+    def check_files(self):
+        """Check the files downloaded are the same as the simulator's."""
+        for filename, log_date in self.sim.log_dates().items():
+            if log_date == datetime.date.today():
+                continue
+            with open(os.path.join(self.tmp_dir, filename), 'rb') as f:
+                self.assertEqual(f.read(), microserver_sim.make_log(log_date).encode('utf-8'))
+
+    def test_download(self):
+        # Today's file is still being written so it is left out
+        self.assertEqual(self.downloader().download(), (2, 0, 0))
+        self.check_files()
+        requests = self.sim.requests
+        self.assertEqual(self.downloader().download(), (0, 2, 0))
+        # Only the list of files was asked for, with and without the password
+        self.assertEqual(self.sim.requests - requests, 2)
+        # A file changed on disk is downloaded again
+        filenames = sorted(self.sim.log_dates())
+        with open(os.path.join(self.tmp_dir, filenames[0]), 'a') as f:
+            f.write('extra\r\n')
+        os.utime(os.path.join(self.tmp_dir, filenames[1]), (1600000000, 1600000000))
+        self.assertEqual(self.downloader().download(), (2, 0, 0))
+        self.check_files()
+
+    def test_resume_interrupted_download(self):
+        self.sim.truncate = 1.0
+        self.assertEqual(self.downloader().download(), (0, 0, 2))
+        parts = [name for name in os.listdir(self.tmp_dir) if name.endswith('.part')]
+        self.assertEqual(len(parts), 2)
+        self.sim.truncate = 0.0
+        self.assertEqual(self.downloader().download(), (2, 0, 0))
+        self.assertFalse([name for name in os.listdir(self.tmp_dir) if name.endswith('.part')])
+        self.check_files()
+
+
+def write_rain_log(log_dir, log_date, totals):
+    """Write a log file for a day with a rain total each minute from
+    midnight."""
+    start = int(time.mktime(log_date.timetuple()))
+    path = os.path.join(log_dir, log_date.strftime('%Y%m%d.csv'))
+    with open(path, 'w') as f:
+        f.write('mtSampTime,mtRainThisMonth\r\n')
+        for n, total in enumerate(totals):
+            f.write('%s,%s\r\n' % (time.strftime(microserver_sim.TIME_FORMAT, time.localtime(start + n * 60)),
+                                   '' if total is None else total))
+    return path
+
+
+class TestColumbiaMicroServerLogImporter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_rain(self, **stn_dict):
+        importer = columbia_ms.ColumbiaMicroServerLogImporter({}, self.tmp_dir, stn_dict)
+        return [[record.get('rain') for record in records]
+                for path, records in importer.read_logs(None, None, weewx.US)]
+
+    def test_rain_reset(self):
+        write_rain_log(self.tmp_dir, datetime.date(2020, 9, 30), [1.0, 1.25])
+        write_rain_log(self.tmp_dir, datetime.date(2020, 10, 1), [0.0, 0.5, None, 0.5, 0.25, 0.5])
+        # The rain after a drop in the total is unknown, as for loop packets
+        expected = [[None, 0.25], [None, 0.5, None, 0.0, None, 0.25]]
+        for use_numpy in (False, True):
+            self.assertEqual(self.read_rain(use_numpy=use_numpy, log_cache=False), expected)
+        # The same again through the cache, once to fill it and once from it
+        self.assertEqual(self.read_rain(use_numpy=False), expected)
+        self.assertEqual(self.read_rain(use_numpy=False), expected)
+
+    def test_gap_between_files(self):
+        write_rain_log(self.tmp_dir, datetime.date(2020, 9, 10), [1.0, 1.25])
+        write_rain_log(self.tmp_dir, datetime.date(2020, 9, 11), [1.5, 1.5])
+        write_rain_log(self.tmp_dir, datetime.date(2020, 9, 13), [2.0, 2.25])
+        # The rain of the first record of a file comes from the file before
+        # only if that is for the day before.
+        expected = [[None, 0.25], [0.25, 0.0], [None, 0.25]]
+        for use_numpy in (False, True):
+            self.assertEqual(self.read_rain(use_numpy=use_numpy, log_cache=False), expected)
+        self.assertEqual(self.read_rain(use_numpy=False), expected)
+        self.assertEqual(self.read_rain(use_numpy=False), expected)
+
+    @unittest.skipUnless(hasattr(time, 'tzset'), "needs time.tzset")
+    def test_repeated_hour_at_end_of_dst(self):
+        tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'America/New_York'
+        time.tzset()
+        try:
+            path = os.path.join(self.tmp_dir, '20201101.csv')
+            with open(path, 'w') as f:
+                f.write('mtSampTime,mtTemp1\r\n')
+                # The clocks go back at 02:00 so 01:00 to 01:59 come twice
+                for n, clock in enumerate(('00:58', '00:59', '01:00', '01:01', '01:00', '01:01', '02:00')):
+                    f.write('2020/11/01 %s:00,%d\r\n' % (clock, n))
+            for stn_dict in ({'log_cache': False}, {}):
+                importer = columbia_ms.ColumbiaMicroServerLogImporter({}, self.tmp_dir, stn_dict)
+                records = [record for path, records in importer.read_logs(None, None, weewx.US)
+                           for record in records]
+                times = [record['dateTime'] for record in records]
+                self.assertEqual(times, sorted(set(times)))
+                # The first of each repeated time is kept
+                self.assertEqual([record['outTemp'] for record in records], [0.0, 1.0, 2.0, 3.0, 6.0])
+        finally:
+            if tz is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = tz
+            time.tzset()
+
+    def test_cache_rebuilt_when_settings_change(self):
+        log_date = datetime.date(2020, 9, 30)
+        with open(os.path.join(self.tmp_dir, log_date.strftime('%Y%m%d.csv')), 'w') as f:
+            f.write(microserver_sim.make_log(log_date, until=int(time.mktime(log_date.timetuple())) + 600))
+
+        def read(field, **stn_dict):
+            importer = columbia_ms.ColumbiaMicroServerLogImporter({}, self.tmp_dir, stn_dict)
+            return [record.get(field) for path, records in importer.read_logs(None, None, weewx.US)
+                    for record in records]
+
+        mph = read('windSpeed')
+        knots = read('windSpeed', log_units={'wind': 'knots'})
+        self.assertEqual(knots, read('windSpeed', log_units={'wind': 'knots'}, log_cache=False))
+        self.assertNotEqual(knots, mph)
+        self.assertEqual(read('outTemp', sensor_map={'outTemp': 'mtTemp_2'}),
+                         read('extraTemp1'))
+        # Back to the first settings
+        self.assertEqual(read('windSpeed'), mph)
+
+    @unittest.skipUnless(hasattr(weewx.manager, 'open_manager_with_config'), "needs the WeeWX database modules")
+    def test_import_batches(self):
+        config_dict = {
+            'DataBindings': {'wx_binding': {
+                'database': 'archive_sqlite', 'table_name': 'archive',
+                'manager': 'weewx.manager.Manager', 'schema': 'schemas.wview.schema'}},
+            'Databases': {'archive_sqlite': {'database_name': 'weewx.sdb', 'database_type': 'SQLite'}},
+            'DatabaseTypes': {'SQLite': {'driver': 'weedb.sqlite', 'SQLITE_ROOT': self.tmp_dir}},
+        }
+        write_rain_log(self.tmp_dir, datetime.date(2020, 9, 10), [1.0] * 7)
+        write_rain_log(self.tmp_dir, datetime.date(2020, 9, 11), [1.0] * 3)
+        importer = columbia_ms.ColumbiaMicroServerLogImporter(
+            config_dict, self.tmp_dir, {'import_batch_size': 3, 'log_cache': False})
+        batches = []
+        insert = importer._insert
+
+        def record_insert(dbmanager, sql, batch):
+            batches.append(len(batch))
+            return insert(dbmanager, sql, batch)
+
+        importer._insert = record_insert
+        # The first record of the next day is also at the end of this one
+        with open(os.path.join(self.tmp_dir, '20200910.csv'), 'a') as f:
+            f.write('2020/09/11 00:00:00,1.0\r\n')
+        self.assertEqual(importer.import_logs(), 10)
+        # No transaction is bigger than the batch size, even within a file
+        self.assertEqual(batches, [3, 3, 3, 1])
+        # Records already in the archive are skipped
+        self.assertEqual(importer.import_logs(), 0)
+
+
+@unittest.skipIf(numpy is None, "needs NumPy")
+class TestNumpyConversion(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_logs(self, use_numpy, us_units):
+        importer = columbia_ms.ColumbiaMicroServerLogImporter(
+            {}, self.tmp_dir, {'use_numpy': use_numpy, 'log_cache': False, 'log_units': {'wind': 'knots'}})
+        return [records for path, records in importer.read_logs(None, None, us_units)]
+
+    def test_same_records_with_and_without_numpy(self):
+        log_date = datetime.date(2020, 9, 30)
+        with open(os.path.join(self.tmp_dir, log_date.strftime('%Y%m%d.csv')), 'w') as f:
+            f.write(microserver_sim.make_log(log_date))
+        # Missing values, one not a number and a reset of the rain total
+        log_date = datetime.date(2020, 10, 1)
+        lines = microserver_sim.make_log(log_date).split('\r\n')
+        header = lines[0].split(',')
+        for row, name, value in ((3, 'mtTemp1', ''), (4, 'mtWindSpeed', '--'), (4, 'mtRainThisMonth', '99.0'),
+                                 (6, 'mtRainThisMonth', '')):
+            values = lines[row].split(',')
+            values[header.index(name)] = value
+            lines[row] = ','.join(values)
+        with open(os.path.join(self.tmp_dir, log_date.strftime('%Y%m%d.csv')), 'w') as f:
+            f.write('\r\n'.join(lines))
+        for us_units in (weewx.US, weewx.METRICWX):
+            records = self.read_logs(False, us_units)
+            self.assertEqual(self.read_logs(True, us_units), records)
+            self.assertNotIn('outTemp', records[1][2])
+            self.assertNotIn('windSpeed', records[1][3])
+            self.assertGreater(records[1][3]['rain'], 0.0)
+            self.assertNotIn('rain', records[1][4])
+            self.assertNotIn('rainTotal', records[1][5])
+
+    def test_rain_deltas(self):
+        totals = [None, 1.0, 1.5, None, 1.5, 0.25, 0.5, None]
+        for last_total in (None, 0.5, 2.0):
+            deltas, total = columbia_ms.rain_deltas(totals, last_total)
+            deltas_numpy, total_numpy = columbia_ms.rain_deltas_numpy(
+                numpy, numpy.array([numpy.nan if value is None else value for value in totals]), last_total)
+            self.assertEqual(columbia_ms.array_to_list(numpy, deltas_numpy), deltas)
+            self.assertEqual(total_numpy, total)
+
+    def test_numpy_imported_by_importer(self):
+        code = "import sys, columbia_ms; sys.exit('numpy' in sys.modules)"
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([p for p in sys.path if p]))
+        self.assertEqual(subprocess.call([sys.executable, '-c', code], env=env), 0)
+        importer = columbia_ms.ColumbiaMicroServerLogImporter({}, self.tmp_dir, {'use_numpy': False})
+        self.assertIsNone(importer.numpy)
+        importer = columbia_ms.ColumbiaMicroServerLogImporter({}, self.tmp_dir, {})
+        self.assertIs(importer.numpy, numpy)
+
+    def test_convert_array(self):
+        values = numpy.array([32.0, numpy.nan, 212.0])
+        convert = weewx.units.conversionDict['degree_F']['degree_C']
+        self.assertEqual(columbia_ms.array_to_list(numpy, columbia_ms.convert_array(numpy, convert, values)),
+                         [convert(32.0), None, convert(212.0)])
+        # A conversion that only works on single values is applied to each
+
+        def scalar_only(value):
+            return float(value) * 2
+        self.assertEqual(columbia_ms.array_to_list(numpy, columbia_ms.convert_array(numpy, scalar_only, values)),
+                         [64.0, None, 424.0])
+
+
+class TestRainDeltas(unittest.TestCase):
+
+    def test_rain_deltas(self):
+        deltas, last_total = columbia_ms.rain_deltas([1.0, 1.5, None, 1.5, 0.25], 0.5)
+        self.assertEqual(deltas, [0.5, 0.5, None, 0.0, None])
+        self.assertEqual(last_total, 0.25)
+
+    def test_rain_deltas_without_last_total(self):
+        deltas, last_total = columbia_ms.rain_deltas([None, 2.0, 2.5])
+        self.assertEqual(deltas, [None, None, 0.5])
+        self.assertEqual(last_total, 2.5)
+
 
-if '__name__' == '__main__':
+if __name__ == '__main__':
     unittest.main()